@@ -0,0 +1,153 @@
+"""
+Headless rendering of detector images with Crysalis peaks, no Jupyter kernel or browser is needed.
+Every image of a directory is paired with a peak table exported as a text file with the same name
+
+    python -m app.batch images/ -p peaks/ -o rendered/ -s style.json -f png -j 8
+
+The style file is a json dictionary with the keys accepted by Starter, e.g.
+{"def_palette": "Inferno256", "img_rotation": "90", "sym_size": 8, "intensity_max": 500}
+"""
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from app.core.images import load_image
+from app.core.peaks import PeakTable
+from app.core.render import RenderStyle, render_png, render_svg
+
+__all__ = ["find_jobs", "render_file", "run", "main"]
+
+IMAGE_PATTERNS = ("*.tif", "*.tiff", "*.cbf", "*.edf", "*.img", "*.mccd", "*.h5")
+FORMATS = ("png", "svg")
+
+
+def find_jobs(image_dir, peaks_dir=None, out_dir=None, fmt="png", patterns=IMAGE_PATTERNS, peaks_ext=".txt"):
+    """
+    Pairs images with peak tables of the same name
+    :param image_dir:
+    :param peaks_dir: directory with peak tables, the image directory if None
+    :param out_dir: output directory, the image directory if None
+    :param fmt: "png" or "svg"
+    :return: list of (image file, peak file or None, output file)
+    """
+    peaks_dir = image_dir if peaks_dir is None else peaks_dir
+    out_dir = image_dir if out_dir is None else out_dir
+
+    res = []
+    for name in sorted(os.listdir(image_dir)):
+        if not any([fnmatch.fnmatch(name.lower(), el) for el in patterns]):
+            continue
+
+        stem = os.path.splitext(name)[0]
+        peaks = os.path.join(peaks_dir, stem + peaks_ext)
+        res.append((os.path.join(image_dir, name), peaks if os.path.isfile(peaks) else None,
+                    os.path.join(out_dir, f"{stem}.{fmt}")))
+    return res
+
+
+def render_file(job, style=None):
+    """
+    Renders one image, runs in a worker process
+    :param job: (image file, peak file or None, output file)
+    :param style: dictionary of style keys
+    :return: (image file, number of peaks, seconds, error message or None)
+    """
+    fn, peaks_fn, out_fn = job
+
+    ts = time.perf_counter()
+    try:
+        tstyle = RenderStyle(**(style or {}))
+        image = load_image(fn)
+
+        table = None
+        if peaks_fn is not None:
+            with open(peaks_fn, "r") as fh:
+                table, malformed = PeakTable.from_text(fh.read())
+
+        if out_fn.lower().endswith(".svg"):
+            with open(out_fn, "w", encoding="utf-8") as fh:
+                fh.write(render_svg(image.data, table, tstyle))
+        else:
+            with open(out_fn, "wb") as fh:
+                fh.write(render_png(image.data, table, tstyle))
+    except Exception as e:
+        return fn, 0, time.perf_counter() - ts, f"{type(e).__name__}: {e}"
+
+    return fn, 0 if table is None else len(table), time.perf_counter() - ts, None
+
+
+def run(jobs, style=None, workers=None, report=print):
+    """
+    Renders images in parallel
+    :param jobs: list of jobs, see find_jobs()
+    :param style: dictionary of style keys
+    :param workers: number of processes, all cores if None, 1 renders in the current process
+    :param report: function receiving progress messages
+    :return: (number of rendered images, number of failures, images per second)
+    """
+    ts = time.perf_counter()
+
+    ok, failed = 0, 0
+    if workers == 1:
+        results = (render_file(el, style) for el in jobs)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        # images are independent - chunks keep the inter process traffic low
+        chunk = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+        results = pool.map(render_file, jobs, [style] * len(jobs), chunksize=chunk)
+
+    try:
+        for fn, npeaks, dt, error in results:
+            if error is None:
+                ok += 1
+                report(f"{os.path.basename(fn)}: {npeaks} peaks, {dt * 1e3:.0f} ms")
+            else:
+                failed += 1
+                report(f"{os.path.basename(fn)}: failed - {error}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    dt = time.perf_counter() - ts
+    rate = ok / dt if dt > 0 else 0.
+    report(f"Rendered {ok} of {len(jobs)} images in {dt:.2f} s - {rate:.2f} images/s")
+    return ok, failed, rate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.batch", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", help="directory with detector images")
+    parser.add_argument("-p", "--peaks", default=None, help="directory with peak tables, default: image directory")
+    parser.add_argument("-o", "--output", default=None, help="output directory, default: image directory")
+    parser.add_argument("-s", "--style", default=None, help="json file with Starter style keys")
+    parser.add_argument("-f", "--format", default="png", choices=FORMATS)
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes, default: all cores")
+    parser.add_argument("--pattern", action="append", default=None, help=f"image name pattern, default: {IMAGE_PATTERNS}")
+    parser.add_argument("--peaks-ext", default=".txt", help="extension of peak table files")
+    args = parser.parse_args(argv)
+
+    style = {}
+    if args.style is not None:
+        with open(args.style, "r") as fh:
+            style = json.load(fh)
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    jobs = find_jobs(args.images, peaks_dir=args.peaks, out_dir=args.output, fmt=args.format,
+                     patterns=tuple(args.pattern or IMAGE_PATTERNS), peaks_ext=args.peaks_ext)
+    if len(jobs) == 0:
+        print(f"No images found in {args.images}")
+        return 1
+
+    ok, failed, rate = run(jobs, style=style, workers=args.jobs)
+    return 0 if failed == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,43 @@
+import numpy as np
+
 from app.imports import *
 
 from bokeh.layouts import column, row
-import bokeh.palettes as palettes
-from bokeh.models import ColumnDataSource, Div, LinearColorMapper, LabelSet, Range1d, LinearAxis
+from bokeh.models import ColumnDataSource, Div, LinearColorMapper, LogColorMapper, LabelSet, Range1d, LinearAxis, \
+    CDSView, GroupFilter
+from bokeh.palettes import Category10_10
+from bokeh.events import SelectionGeometry, Tap
 
 from bokeh.plotting import figure, show
 
 from tornado import gen
-from functools import partial
+from functools import partial, wraps
 
-from app.imports.clipboard import CrysalisPeak
+from app.core.pyramid import ImagePyramid
+from app.core.peaks import PeakTable
+from app.core.declutter import LabelDeclutter, font_size_px
+from app.core.spatial import PeakIndex
+from app.core.render import prep_palette
+from app.core.timing import timed, timer
 
 __all__ = ["BokehCtrl", "show", "bokeh_app"]
 
 BOKEHCTRL = None
 
+
+def _locked(func):
+    """
+    Runs a method of the controller with its lock, see BokehCtrl.lock
+    :param func:
+    :return:
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 def bokeh_app(doc):
     """
     Sets up bokeh server in combination with Jupyter
@@ -23,6 +46,7 @@ def bokeh_app(doc):
     """
     bc = BokehCtrl.get_instance()
 
+    bc.reset()
     bc.document = doc
 
     layout = column(row(Div(text=f"Bokeh placeholder for document {str(bc.document)}", width=600, height=40), name=bc.NAME_DATA), name=bc.MAIN_LAYOUT)
@@ -39,10 +63,21 @@ class BokehCtrl:
 
     NAME_DATA = "data"
 
+    PATCH_FRACTION = 0.5    # larger changes of the peak table rebuild the point source
+    LABEL_LIMIT = 300       # maximum number of captions shown at once
+    TAP_DISTANCE = 20       # largest distance of a peak picked by a tap, image pixels
+    MASK_PALETTE = ["#00000000", "#ff00ff80"]  # unmasked pixels are transparent
+
+    # markers and line colors of peak groups (twins, domains) if there is more than one group
+    GROUP_MARKERS = ["circle", "square", "triangle", "diamond", "inverted_triangle", "hex", "star", "plus"]
+    GROUP_COLORS = list(Category10_10)
+
     def __init__(self):
         super(BokehCtrl, self).__init__()
 
-        self.lock = threading.Lock
+        # guards the shown state (points, points_diff, orientation, filter_captions, mask) written by the render
+        # thread and read by document callbacks, reentrant - callbacks call each other
+        self.lock = threading.RLock()
         self.document = None
 
         self.pallete = self.MAIN_PALLETE
@@ -53,6 +88,29 @@ class BokehCtrl:
         # figure to keep in memory for future changes
         self.figure = None
 
+        # models of the figure mutated by updates
+        self.color_mapper = None
+        self.img_renderer = None
+        self.pts_source = None
+        self.pts_renderers = {}     # group name -> renderer, all groups share the point source
+        self.labels = None
+
+        # peak groups of the shown table and groups hidden by the user
+        self.groups = []
+        self.group_visible = {}
+
+        # multi-resolution image and the part of it currently shown
+        self.pyramid = None
+        self.img_source = None
+        self.img_tile = None
+        self._range_update = False
+
+        # overlay of masked pixels, downsampled like the image
+        self.mask = None            # oriented boolean mask or None
+        self.mask_pyramid = None
+        self.mask_source = None
+        self.selection_geometry = None  # last box or lasso selection as a polygon in image coordinates
+
         # symbols + captions
         self.cap_xoffset = None
         self.cap_yoffset = None
@@ -68,12 +126,60 @@ class BokehCtrl:
         self.sym_visible = None
         self.sym_linesize = 2
 
+        # generation of the latest render request, older callbacks are skipped
+        self.generation = None
+
         # filtered intensity
         self.filter_captions = 0.
 
         # point related data
-        self.points = []
-        self.pos_names = []
+        self.points = PeakTable()
+        self.points_diff = None     # PeakDiff leading to the current points, if known
+
+        # table shown by the point source and the mapping of its rows
+        self._pts_table = None
+        self._pts_rows = None
+        self._pts_free = None
+        self._points_key = None
+
+        self._symbols_visible = False
+
+        # caption selection
+        self.label_source = None
+        self.declutter = None
+        self._declutter_filter = None   # caption filter the candidates were selected with
+        self._label_rows = None
+        self.orientation = None     # transform of the peak coordinates matching the image
+
+        # spatial index of the shown peaks and the last selected subset
+        self._peak_index = None
+        self._peak_index_key = None
+        self.selection = None
+
+    def reset(self):
+        """
+        Forgets the figure, models cannot be shared between documents
+        :return:
+        """
+        self.figure = None
+        self.pyramid = None
+        self.img_source = None
+        self.img_tile = None
+        self.mask_pyramid = None
+        self.mask_source = None
+        self.color_mapper = None
+        self.img_renderer = None
+        self.pts_source = None
+        self.pts_renderers = {}
+        self.labels = None
+        self._pts_table = None
+        self._points_key = None
+        self.label_source = None
+        self.declutter = None
+        self._label_rows = None
+        self._peak_index = None
+        self._peak_index_key = None
+        self.selection = None
 
     def set_symbol_style(self, type, size, linesize, linecolor, bkgcolor, visible):
         """
@@ -111,13 +217,14 @@ class BokehCtrl:
         self.cap_bkgcolor = bkgcolor
         self.cap_visible = visible
 
+    @_locked
     def add_points(self, data):
         """
-        Sets a list of points to show
-        :param data:
+        Sets points to show
+        :param data: PeakTable
         :return:
         """
-        self.points = list(data)
+        self.points = data
 
     def debug(self, msg):
         if self.parent is not None:
@@ -126,123 +233,563 @@ class BokehCtrl:
         print(msg)
 
     @gen.coroutine
+    @timed("push")
+    @_locked
     def _add_graph(self, new_data):
         """
-        Adds a graph if absent and replaces the old one with a new one
+        Updates the graph, the figure is created once and later changes only mutate its models
         :return:
         """
-        # remove old widget
-        #self.debug(f"Update started {self.document}")
-        data, palette, minimum, maximum, binvert_colormap = new_data
+        pyramid, palette, minimum, maximum, binvert_colormap, blog, mask_pyramid, generation = new_data
 
-        # keep the same zoom in region
-        x_range, y_range = None, None
-        if self.figure is not None:
-            x_range = self.figure.x_range
-            y_range = self.figure.y_range
+        # a newer render is queued
+        if pyramid is None or generation != self.generation:
+            return
 
         self.pallete = palette
 
-        root_layout = self.document.get_model_by_name(self.MAIN_LAYOUT)
-        #self.debug(f"Got Root {root_layout}")
+        if self.figure is None:
+            self._build_figure(pyramid)
+
+        # image - re-sent only when the pixels change
+        bimage = pyramid is not self.pyramid
+        if bimage:
+            self.pyramid = pyramid
+            self.img_source.data = self._get_tile()
+
+        # the mask tile follows the image tile, an image without a mask clears the old one
+        if bimage or mask_pyramid is not self.mask_pyramid:
+            self.mask_pyramid = mask_pyramid
+            self.mask_source.data = self._get_mask_tile()
 
-        sublayouts = root_layout.children
-        #self.debug(f"Got sub layout {sublayouts}")
+        # color mapping - only changed properties are sent to the browser
+        if bool(blog) != isinstance(self.color_mapper, LogColorMapper):
+            mapper = LogColorMapper if blog else LinearColorMapper
+            self.color_mapper = mapper(palette=self.color_mapper.palette)
+            self.img_renderer.glyph.color_mapper = self.color_mapper
 
-        plot = self.document.get_model_by_name(self.NAME_DATA)
-        #self.debug(f"Plot removed {plot}")
-        sublayouts.remove(plot)
+        if blog and minimum is not None and maximum is not None:
+            # logarithmic mapping needs a positive range
+            maximum = max(maximum, 1e-12)
+            minimum = min(max(minimum, maximum * 1e-6), maximum / 2)
 
         tpalette = self.prep_palette(palette, binvert_colormap)
+        if list(self.color_mapper.palette) != list(tpalette):
+            self.color_mapper.palette = tpalette
+        self.color_mapper.update(low=minimum, high=maximum)
+
+        try:
+            self._update_points()
+            self._update_styles()
+            self._update_labels()
+        except Exception as e:
+            self.debug(f"Error: {e}")
+
+    def _build_figure(self, pyramid):
+        """
+        Creates the long-lived figure with the image, symbols and captions and puts it into the layout
+        :param pyramid:
+        :return:
+        """
+        ny, nx = pyramid.shape
+        self.pyramid = pyramid
+
+        self.color_mapper = LinearColorMapper(palette=self.prep_palette(self.pallete))
+
+        # explicit ranges - auto ranging would follow the tile instead of the image
+        x_range = self._hook_range(Range1d(0, nx))
+        y_range = self._hook_range(Range1d(0, ny))
+
+        tp = figure(tooltips=[("x", "$x"), ("y", "$y"), ("value", "@image")], width=1000, height=1000,
+                    x_range=x_range, y_range=y_range,
+                    tools="pan,wheel_zoom,box_zoom,box_select,lasso_select,tap,save,reset,help")
+        self.figure = tp
+
+        # peak queries are answered on the server from the spatial index
+        tp.on_event(SelectionGeometry, self._on_selection)
+        tp.on_event(Tap, self._on_tap)
+
+        self.img_source = ColumnDataSource(data=self._get_tile())
+        self.img_renderer = tp.image(image='image', x='x', y='y', dw='dw', dh='dh', source=self.img_source,
+                                     color_mapper=self.color_mapper, level="image")
+
+        # masked pixels above the image, the image itself is never modified by the mask
+        self.mask_source = ColumnDataSource(data=self._get_mask_tile())
+        tp.image(image='image', x='x', y='y', dw='dw', dh='dh', source=self.mask_source,
+                 color_mapper=LinearColorMapper(palette=self.MASK_PALETTE, low=0, high=1), level="image")
+
+        # ticks
+        tp.yaxis.major_label_text_font_size = "2em"
+        tp.xaxis.major_label_text_font_size = "2em"
+        tp.xaxis.axis_line_width = 2
+        tp.yaxis.axis_line_width = 2
+        tp.xaxis.major_tick_line_width = 2
+        tp.yaxis.major_tick_line_width = 2
+        tp.xaxis.minor_tick_line_width = 2
+        tp.yaxis.minor_tick_line_width = 2
+
+        ar = LinearAxis()
+        ar.minor_tick_line_width = 2
+        ar.major_label_text_font_size = "2em"
+        ar.axis_line_width = 2
+
+        at = LinearAxis()
+        at.minor_tick_line_width = 2
+        at.major_label_text_font_size = "2em"
+        at.axis_line_width = 2
+
+        tp.add_layout(at, 'above')
+        tp.add_layout(ar, 'right')
+
+        tp.grid.grid_line_width = 0
+
+        # symbols of all peaks, renderers of individual groups are added as the groups appear
+        self.pts_source = ColumnDataSource(data=PeakTable().columns())
+        self.pts_renderers = {}
+
+        # captions of a decluttered subset of peaks for the current viewport
+        self.label_source = ColumnDataSource(data=dict(x=[], y=[], names=[]))
+        self.labels = LabelSet(x='x', y='y', text='names', source=self.label_source, visible=False)
+        tp.add_layout(self.labels)
+
+        # replace the placeholder
+        sublayouts = self.document.get_model_by_name(self.MAIN_LAYOUT).children
+        sublayouts.remove(self.document.get_model_by_name(self.NAME_DATA))
+        sublayouts.append(row(tp, name=self.NAME_DATA))
+
+    def _update_points(self):
+        """
+        Updates the source of symbols and captions if the peaks or the caption filter changed.
+        Changes of the peak table are applied as patches when possible
+        :return:
+        """
+        points = None
+        if isinstance(self.points, PeakTable) and len(self.points) > 0:
+            points = self.points
+
+        # tables are immutable - identity of the table tells if the peaks changed
+        # the caption filter is applied to the caption candidates only, the point source keeps all names
+        key = None if self.orientation is None else self.orientation.key
+        if points is self._pts_table and key == self._points_key:
+            return
+
+        diff = None
+        if points is not None and self._pts_table is not None and key == self._points_key:
+            diff = self.points_diff
+            if diff is None or diff.base is not self._pts_table or diff.target is not points:
+                diff = points.diff(self._pts_table)
+
+        if diff is None or not self._patch_points(diff):
+            self._set_points(points)
+
+        self.groups = [] if points is None else points.groups()
+        for el in self.groups:
+            if el not in self.pts_renderers:
+                self.pts_renderers[el] = self._add_group_renderer(el)
+
+        # label candidates changed
+        self.declutter = None
+        self._label_rows = None
+
+        self._pts_table = points
+        self._points_key = key
+
+    def _set_points(self, points):
+        """
+        Replaces the content of the point source
+        :param points: PeakTable or None
+        :return:
+        """
+        if points is None:
+            points = PeakTable()
+
+        with timer("serialize", source="points", rows=len(points)):
+            columns = points.columns(self.orientation)
+        self.pts_source.data = columns
+
+        # peak index of every row of the source, rows of removed peaks are reused
+        self._pts_rows = points["index"].copy()
+        self._pts_free = np.zeros(len(points), dtype=bool)
+
+    def _patch_points(self, diff):
+        """
+        Applies a difference of peak tables to the point source using patch and stream
+        :param diff: PeakDiff
+        :return: False if the source should be rebuilt instead
+        """
+        rows, free = self._pts_rows, self._pts_free
+
+        nfree = int(free.sum()) + len(diff.removed) - len(diff.added)
+        if len(diff) > len(rows) * self.PATCH_FRACTION or nfree > len(rows) * self.PATCH_FRACTION:
+            return False
+
+        # locate rows of the known peaks
+        active = np.flatnonzero(~free)
+        order = np.argsort(rows[active], kind="stable")
+        skeys = rows[active][order]
+
+        def locate(indices):
+            return active[order[np.searchsorted(skeys, indices)]]
+
+        patches = {}
+
+        def add_patch(trows, columns):
+            for k, v in columns.items():
+                patches.setdefault(k, []).extend(zip(trows.tolist(), np.asarray(v).tolist()))
+
+        # removed peaks are hidden
+        rrows = locate(diff.removed)
+        free[rrows] = True
+        add_patch(rrows, PeakTable.blank_columns(len(rrows)))
+
+        # changed peaks get new values
+        add_patch(locate(diff.changed["index"]), diff.changed.columns(self.orientation))
+
+        # added peaks fill free rows first, the rest is appended
+        columns = diff.added.columns(self.orientation)
+        frows = np.flatnonzero(free)[:len(diff.added)]
+        nreuse = len(frows)
+
+        add_patch(frows, {k: v[:nreuse] for k, v in columns.items()})
+        rows[frows] = diff.added["index"][:nreuse]
+        free[frows] = False
+
+        if len(patches) > 0 and len(patches["x"]) > 0:
+            self.pts_source.patch(patches)
+
+        if nreuse < len(diff.added):
+            self.pts_source.stream({k: v[nreuse:] for k, v in columns.items()})
+            self._pts_rows = np.concatenate((rows, diff.added["index"][nreuse:]))
+            self._pts_free = np.concatenate((free, np.zeros(len(diff.added) - nreuse, dtype=bool)))
+
+        return True
+
+    def _add_group_renderer(self, group):
+        """
+        Adds a renderer of one peak group, rows are selected on the client by a filter of the shared source
+        :param group:
+        :return:
+        """
+        view = CDSView(filter=GroupFilter(column_name="group", group=group))
+        return self.figure.scatter(x='x', y='y', source=self.pts_source, view=view, visible=False)
+
+    def _update_styles(self):
+        """
+        Applies symbol and caption styles to the existing renderers
+        :return:
+        """
+        bpoints = len(self.pts_source.data["x"]) > 0
+
+        bsym = bpoints and self._test_symdata() and bool(self.sym_visible)
+        if bsym:
+            bmulti = len(self.groups) > 1
+            # a group keeps its marker and color while the renderer exists
+            for i, (group, renderer) in enumerate(self.pts_renderers.items()):
+                marker, color = self.sym_type, self.sym_linecolor
+                if bmulti:
+                    marker = self.GROUP_MARKERS[i % len(self.GROUP_MARKERS)]
+                    color = self.GROUP_COLORS[i % len(self.GROUP_COLORS)]
+                renderer.glyph.update(marker=marker, size=self.sym_size, fill_color=self.sym_bkgcolor,
+                                      line_color=color, line_width=self.sym_linesize)
+        self._update_group_visibility(bsym)
+
+        bcap = bpoints and self._test_captiondata() and bool(self.cap_visible)
+        if bcap:
+            self.labels.update(x_offset=self.cap_xoffset, y_offset=self.cap_yoffset, text_color=self.cap_color,
+                               text_font=self.cap_font, text_font_size=self.cap_fontsize,
+                               background_fill_color=self.cap_bkgcolor)
+        self.labels.visible = bcap
+
+    def _update_group_visibility(self, bsym=None):
+        """
+        Shows renderers of groups present in the table and not hidden by the user
+        :param bsym: symbols are shown, None - keeps the current state
+        :return:
+        """
+        if bsym is None:
+            bsym = self._symbols_visible
+        self._symbols_visible = bsym
+
+        for group, renderer in self.pts_renderers.items():
+            renderer.visible = bool(bsym) and group in self.groups and self.group_visible.get(group, True)
+
+    def set_caption_filter(self, value):
+        """
+        Hides captions of peaks with intensity not exceeding the value, only the shown captions are sent
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.filter_captions = value
+
+        if self.document is not None and self.figure is not None:
+            self.document.add_next_tick_callback(self._on_labels_changed)
+
+    def update_styles(self):
+        """
+        Applies symbol and caption styles set by set_symbol_style() and set_caption_style() to the existing models
+        :return:
+        """
+        if self.document is not None and self.figure is not None:
+            self.document.add_next_tick_callback(self._on_styles_changed)
+
+    @_locked
+    def _on_styles_changed(self):
+        """
+        Sets properties of glyphs and captions, the font size changes the caption layout
+        :return:
+        """
+        try:
+            self._update_styles()
+            self._update_labels()
+        except Exception as e:
+            self.debug(f"Error: {e}")
+
+    @_locked
+    def _on_labels_changed(self):
+        try:
+            self._update_labels()
+        except Exception as e:
+            self.debug(f"Error: {e}")
+
+    def set_group_visible(self, group, visible):
+        """
+        Shows or hides a peak group, only the renderer flags and the captions change
+        :param group: group name, e.g. g1
+        :param visible:
+        :return:
+        """
+        if self.group_visible.get(group, True) == bool(visible):
+            return
+        self.group_visible[group] = bool(visible)
+
+        if self.document is not None and self.figure is not None:
+            self.document.add_next_tick_callback(self._on_group_visibility)
+
+    @_locked
+    def _on_group_visibility(self):
+        """
+        Applies changed visibility of groups, captions of hidden groups are removed
+        :return:
+        """
+        self._update_group_visibility()
+
+        self.declutter = None
+        self._on_labels_changed()
 
-        if data is not None:
-            # making new plot image
+    def _update_labels(self):
+        """
+        Shows a non-overlapping subset of captions ranked by intensity for the current viewport
+        :return:
+        """
+        if not self.labels.visible or self.pyramid is None:
+            return
 
-            colormapper = LinearColorMapper(
-                palette=tpalette, low=minimum, high=maximum,
-            )
+        if self.declutter is None or self._declutter_filter != self.filter_captions:
+            data = self.pts_source.data
+            names = np.asarray(data["names"], dtype=str)
 
-            tp = figure(tooltips=[("x", "$x"), ("y", "$y"), ("value", "@image")], width=1000, height=1000)
-            self.figure = tp
-            tp.x_range.range_padding = tp.y_range.range_padding = 0
+            # captions of weak peaks and of hidden groups are not candidates
+            bhidden = np.zeros(len(names), dtype=bool)
+            if self.filter_captions is not None:
+                bhidden |= ~(np.asarray(data["intensity"], dtype=np.float64) > self.filter_captions)
 
-            tr = tp.image(image=[data], x=0, y=0, dw=data.shape[0], dh=data.shape[1],
-                          color_mapper=colormapper, level="image")
+            hidden = [k for k, v in self.group_visible.items() if not v]
+            if len(hidden) > 0:
+                bhidden |= np.isin(np.asarray(data["group"], dtype=str), hidden)
 
-            # ticks
-            tp.yaxis.major_label_text_font_size = "2em"
-            tp.xaxis.major_label_text_font_size = "2em"
-            tp.xaxis.major_label_text_font_size = "2em"
-            tp.xaxis.axis_line_width = 2
-            tp.yaxis.axis_line_width = 2
-            tp.xaxis.major_tick_line_width = 2
-            tp.yaxis.major_tick_line_width = 2
-            tp.xaxis.minor_tick_line_width = 2
-            tp.yaxis.minor_tick_line_width = 2
+            self.declutter = LabelDeclutter(data["x"], data["y"], data["intensity"], np.where(bhidden, "", names))
+            self._declutter_filter = self.filter_captions
 
-            ar = LinearAxis()
-            ar.minor_tick_line_width = 2
-            ar.major_label_text_font_size = "2em"
-            ar.minor_tick_line_width = 2
-            ar.axis_line_width = 2
+        x0, x1, y0, y1, sw, sh = self._get_viewport()
+        rows = self.declutter.select(x0, x1, y0, y1, sw, sh, font_size=font_size_px(self.cap_fontsize),
+                                     xoffset=self.cap_xoffset, yoffset=self.cap_yoffset, max_labels=self.LABEL_LIMIT)
 
-            at = LinearAxis()
-            at.minor_tick_line_width = 2
-            at.major_label_text_font_size = "2em"
-            at.minor_tick_line_width = 2
-            at.axis_line_width = 2
+        if self._label_rows is not None and np.array_equal(rows, self._label_rows):
+            return
+        self._label_rows = rows
 
-            tp.add_layout(at, 'above')
-            tp.add_layout(ar, 'right')
+        data = self.pts_source.data
+        self.label_source.data = dict(x=np.asarray(data["x"])[rows], y=np.asarray(data["y"])[rows],
+                                      names=[data["names"][i] for i in rows.tolist()])
 
-            if x_range is not None:
-                tp.x_range = x_range
+    def _get_viewport(self):
+        """
+        Returns the visible region in image coordinates and the size of the plot area in screen pixels
+        :return: (x0, x1, y0, y1, screen_width, screen_height)
+        """
+        tp = self.figure
+        ny, nx = self.pyramid.shape
 
-            if y_range is not None:
-                tp.y_range = y_range
+        x0, x1 = tp.x_range.start, tp.x_range.end
+        y0, y1 = tp.y_range.start, tp.y_range.end
+        if None in (x0, x1, y0, y1):
+            x0, x1, y0, y1 = 0, nx, 0, ny
+
+        # outer size slightly overestimates the plot area, level of detail is chosen conservatively
+        return x0, x1, y0, y1, tp.width, tp.height
+
+    def _get_tile(self):
+        """
+        Prepares data of the image source for the current viewport
+        :return:
+        """
+        with timer("serialize", source="image"):
+            level, data, x, y, dw, dh = self.pyramid.tile(*self._get_viewport())
+        self.img_tile = (level, x, y, dw, dh)
+        return dict(image=[data], x=[x], y=[y], dw=[dw], dh=[dh])
+
+    def _get_mask_tile(self):
+        """
+        Prepares data of the mask source, the tile matches the image tile
+        :return:
+        """
+        if self.mask_pyramid is None or self.pyramid is None:
+            return dict(image=[], x=[], y=[], dw=[], dh=[])
+
+        level, data, x, y, dw, dh = self.mask_pyramid.tile(*self._get_viewport())
+        return dict(image=[data.view(np.uint8)], x=[x], y=[y], dw=[dw], dh=[dh])
+
+    def _hook_range(self, trange):
+        """
+        Attaches the range change hook, ranges are reused between figures, so it is done once per range
+        :param trange:
+        :return:
+        """
+        trange.on_change('start', self._on_range_change)
+        trange.on_change('end', self._on_range_change)
+        return trange
+
+    def _on_range_change(self, attr, old, new):
+        """
+        Range change hook - start and end of both ranges change together, the update is postponed until the next tick
+        :return:
+        """
+        if self._range_update or self.pyramid is None:
+            return
+
+        self._range_update = True
+        self.document.add_next_tick_callback(self._update_view)
+
+    @_locked
+    def _update_view(self):
+        """
+        Updates the parts depending on the viewport.
+        A new tile is pushed only if the current one does not cover the viewport or has a wrong level of detail
+        :return:
+        """
+        self._range_update = False
+        if self.pyramid is None or self.img_source is None:
+            return
 
-            tp.grid.grid_line_width = 0
+        try:
+            self._update_labels()
+        except Exception as e:
+            self.debug(f"Error: {e}")
 
-            # captions
-            if len(self.points) > 0:
-                xs, ys = [], []
-                names = []
-                for point in self.points:
-                    if isinstance(point,CrysalisPeak):
-                        xs.append(point.detx)
-                        ys.append(point.dety)
-                        h,k,l = int(point.h), int(point.k), int(point.l)
+        if self.img_tile is not None and self.pyramid.covers(self.img_tile, *self._get_viewport()):
+            return
 
-                        name = ""
-                        if self.filter_captions < point.intensity:
-                            name = f"({h}, {k}, {l})"
+        self.img_source.data = self._get_tile()
+        if self.mask_pyramid is not None:
+            self.mask_source.data = self._get_mask_tile()
 
-                        names.append(name)
-                        self.pos_names.append(f"{xs[-1]}\t{ys[-1]}\t{h}\t{k}\t{l}")
+    def get_peak_index(self):
+        """
+        Returns the shown peak table and a spatial index over its displayed coordinates, rebuilt when either changes
+        :return: (PeakTable, PeakIndex)
+        """
+        table = self._pts_table if self._pts_table is not None else PeakTable()
+        key = (id(table), None if self.orientation is None else self.orientation.key)
+
+        if self._peak_index is None or key != self._peak_index_key:
+            xs, ys = table["detx"], table["dety"]
+            if self.orientation is not None:
+                xs, ys = self.orientation.apply_points(xs, ys)
+            self._peak_index = (table, PeakIndex(xs, ys))
+            self._peak_index_key = key
+        return self._peak_index
+
+    def nearest_peak(self, x, y, max_distance=None):
+        """
+        Returns the peak closest to a position in image coordinates
+        :param max_distance: peaks farther away are ignored
+        :return: PeakTable with one row or None
+        """
+        table, index = self.get_peak_index()
+        i = index.nearest(x, y, max_distance=max_distance)
+        if i < 0:
+            return None
+        return table[i:i + 1]
 
-                if len(xs) > 0:
-                    pts_data = ColumnDataSource(data=dict(x=xs,
-                                    y=ys, names=names))
+    def peaks_in_box(self, x0, x1, y0, y1):
+        """
+        Returns peaks inside a box in image coordinates
+        :return: PeakTable
+        """
+        table, index = self.get_peak_index()
+        return table[np.sort(index.box(x0, x1, y0, y1))]
 
-                    try:
-                        if self._test_symdata() and self.sym_visible:
-                                tp.scatter(x='x', y='y', size=self.sym_size, source=pts_data, fill_color=self.sym_bkgcolor,
-                                           line_color=self.sym_linecolor, marker=self.sym_type, line_width=self.sym_linesize)
+    def peaks_in_lasso(self, xs, ys):
+        """
+        Returns peaks inside a polygon in image coordinates
+        :return: PeakTable
+        """
+        table, index = self.get_peak_index()
+        return table[np.sort(index.lasso(xs, ys))]
 
+    def peaks_in_radius(self, x, y, radius):
+        """
+        Returns peaks within a distance from a position in image coordinates
+        :return: PeakTable
+        """
+        table, index = self.get_peak_index()
+        return table[np.sort(index.radius(x, y, radius))]
 
-                        if self._test_captiondata() and self.cap_visible:
-                            labels = LabelSet(x='x', y='y', text='names',
-                                              x_offset=self.cap_xoffset, y_offset=self.cap_yoffset, source=pts_data, visible=self.cap_visible, # render_mode='canvas',
-                                              text_color=self.cap_color, text_font=self.cap_font, text_font_size=self.cap_fontsize,
-                                              background_fill_color=self.cap_bkgcolor)
+    @_locked
+    def _on_selection(self, event):
+        """
+        Box and lasso selection hook - reports the summary of the selected peaks
+        :param event:
+        :return:
+        """
+        if not event.final:
+            return
+
+        geometry = event.geometry
+        if geometry["type"] == "rect":
+            x0, x1, y0, y1 = geometry["x0"], geometry["x1"], geometry["y0"], geometry["y1"]
+            self.selection_geometry = ([x0, x1, x1, x0], [y0, y0, y1, y1])
+        elif geometry["type"] == "poly":
+            self.selection_geometry = (list(geometry["x"]), list(geometry["y"]))
+
+        try:
+            if geometry["type"] == "rect":
+                selection = self.peaks_in_box(geometry["x0"], geometry["x1"], geometry["y0"], geometry["y1"])
+            elif geometry["type"] == "poly":
+                selection = self.peaks_in_lasso(geometry["x"], geometry["y"])
+            else:
+                return
+        except Exception as e:
+            self.debug(f"Error: {e}")
+            return
 
-                            tp.add_layout(labels)
-                    except Exception as e:
-                        self.debug(f"Error: {e}")
+        self.selection = selection
+        self.debug(f"Selected peaks: {selection.summary()}")
 
-            sublayouts.append(row(tp, name=self.NAME_DATA))
+    @_locked
+    def _on_tap(self, event):
+        """
+        Tap hook - reports the peak closest to the cursor
+        :param event:
+        :return:
+        """
+        peak = self.nearest_peak(event.x, event.y, max_distance=self.TAP_DISTANCE)
+        if peak is None:
+            return
 
-        #self.debug("Update finished")
+        self.debug(f"Nearest peak: {peak.labels()[0]} #{int(peak['index'][0])} at ({peak['detx'][0]:.1f}, "
+                   f"{peak['dety'][0]:.1f}), intensity {peak['intensity'][0]:g}")
 
     def _test_captiondata(self):
         """
@@ -277,42 +824,59 @@ class BokehCtrl:
         :param pname:
         :return:
         """
-        res = palettes.grey(256)
-
-        if pname == 'Greys256':
-            res = palettes.grey(256)
-        elif pname == 'Inferno256':
-            res = palettes.inferno(256)
-        elif pname == 'Magma256':
-            res = palettes.magma(256)
-        elif pname == 'Plasma256':
-            res = palettes.plasma(256)
-        elif pname == 'Viridis256':
-            res = palettes.viridis(256)
-        elif pname == 'Cividis256':
-            res = palettes.cividis(256)
-        elif pname == 'Turbo256':
-            res = palettes.turbo(256)
-        elif pname == 'Bokeh8':
-            res = palettes.small_palettes['Bokeh'][8]
-        elif pname == 'Spectral11':
-            res = palettes.small_palettes['Spectral'][11]
-        elif pname == 'RdGy11':
-            res = palettes.small_palettes['RdGy'][11]
-        elif pname == 'PiYG11':
-            res = palettes.small_palettes['PiYG'][11]
-
-        if binverse:
-            res = res[::-1]
-        return res
+        return prep_palette(pname, binverse)
 
-    def add_graph(self, data, palette=None, minimum=None, maximum=None, binvertcmap=None):
+    def get_pyramid(self, data):
         """
-        Wrapper adding a callack to bokeh app
+        Returns a multi-resolution representation of the data, it is rebuilt only when the pixels change
         :param data:
         :return:
         """
-        tdata = [data, palette, minimum, maximum, binvertcmap]
+        pyramid = self.pyramid
+        if pyramid is None or pyramid.key != ImagePyramid.key_of(data):
+            pyramid = ImagePyramid(data)
+        return pyramid
+
+    def get_mask_pyramid(self, mask):
+        """
+        Returns a multi-resolution representation of the mask, masked pixels survive downsampling
+        :param mask: oriented boolean mask or None
+        :return:
+        """
+        if mask is None:
+            return None
+
+        pyramid = self.mask_pyramid
+        if pyramid is None or pyramid.key != ImagePyramid.key_of(mask):
+            pyramid = ImagePyramid(mask)
+        return pyramid
+
+    def add_graph(self, data, palette=None, minimum=None, maximum=None, binvertcmap=None, generation=None,
+                  log_scale=False):
+        """
+        Wrapper adding a callack to bokeh app
+        :param data: image or its ImagePyramid, e.g. one cached with the image
+        :param generation: generation of the render request, callbacks of older generations are skipped
+        :param log_scale: logarithmic color map
+        :return:
+        """
+        self.generation = generation
+
+        pyramid = None
+        if isinstance(data, ImagePyramid):
+            pyramid = data
+        elif data is not None:
+            # downsampling is done outside of the document callback
+            pyramid = self.get_pyramid(data)
+
+        with self.lock:
+            mask = self.mask
+
+        mask_pyramid = None
+        if pyramid is not None and mask is not None and mask.shape == pyramid.shape:
+            mask_pyramid = self.get_mask_pyramid(mask)
+
+        tdata = [pyramid, palette, minimum, maximum, binvertcmap, log_scale, mask_pyramid, generation]
 
         #self.debug(f"Adding data {data}, {(palette, minimum, maximum)}")
         self.document.add_next_tick_callback(partial(self._add_graph, new_data=tdata))
@@ -0,0 +1,162 @@
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ["JobQueue", "Job", "JobCancelled"]
+
+
+class JobCancelled(Exception):
+    """
+    Raised by Job.check() when the job was cancelled or superseded
+    """
+
+
+class Job:
+    """
+    Handle of a background job. Cancellation is cooperative - the function checks the job between stages
+    """
+
+    def __init__(self, jid, group=None):
+        super(Job, self).__init__()
+
+        self.id = jid
+        self.group = group
+        self.future = None
+
+        self._cancelled = threading.Event()
+
+    def __repr__(self):
+        return f"Job({self.id}, {self.group!r}{', cancelled' if self.cancelled else ''})"
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """
+        Requests cancellation, a job waiting for a worker does not start at all
+        :return:
+        """
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check(self):
+        """
+        Stage boundary - stops the job if it was cancelled
+        :return:
+        """
+        if self._cancelled.is_set():
+            raise JobCancelled(f"Job {self.id} ({self.group}) was cancelled")
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads for file loads and similar work.
+    Every job gets an increasing id, a new job of a group supersedes (cancels) the older jobs of the same group,
+    so that only the latest upload is decoded to the end and committed to the interface
+    """
+
+    WORKERS = 2     # worker threads
+
+    def __init__(self, workers=None, parent=None):
+        super(JobQueue, self).__init__()
+
+        self.workers = self.WORKERS if workers is None else max(1, int(workers))
+
+        # parent object used for debugging
+        self.parent = parent
+
+        # reentrant - cancelling a queued job runs its done callback at once
+        self.lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._jobs = {}         # id -> job not finished yet
+        self._latest = {}       # group -> id of the latest job
+
+        self._pool = None
+
+    def debug(self, msg):
+        if self.parent is not None:
+            try:
+                self.parent.debug(msg)
+            except AttributeError:
+                pass
+
+    def submit(self, func, *args, group=None, **kwargs):
+        """
+        Runs func(*args, job=job, **kwargs) on a worker thread
+        :param func:
+        :param group: older jobs of the group are cancelled, None - the job supersedes nothing
+        :return: Job
+        """
+        with self.lock:
+            job = Job(next(self._ids), group=group)
+
+            if group is not None:
+                for el in list(self._jobs.values()):
+                    if el.group == group:
+                        el.cancel()
+                self._latest[group] = job.id
+
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+
+            self._jobs[job.id] = job
+            job.future = self._pool.submit(self._run, job, func, args, kwargs)
+
+        # outside of the lock, the callback runs at once if the job has already finished
+        job.future.add_done_callback(lambda future: self._finished(job))
+        return job
+
+    def _finished(self, job):
+        with self.lock:
+            self._jobs.pop(job.id, None)
+
+    def _run(self, job, func, args, kwargs):
+        try:
+            job.check()
+            return func(*args, job=job, **kwargs)
+        except JobCancelled:
+            self.debug(f"Job {job.id} ({job.group}) cancelled")
+        except Exception as e:
+            self.debug(f"Job {job.id} ({job.group}) error: {e}")
+
+    def is_latest(self, job):
+        """
+        Tests if the job is the latest one of its group
+        :param job:
+        :return:
+        """
+        return self._latest.get(job.group) == job.id
+
+    @property
+    def active(self):
+        """
+        Jobs queued or running
+        :return:
+        """
+        with self.lock:
+            return list(self._jobs.values())
+
+    def cancel(self, group=None):
+        """
+        Cancels jobs of a group, None - all jobs
+        :param group:
+        :return:
+        """
+        with self.lock:
+            for el in list(self._jobs.values()):
+                if group is None or el.group == group:
+                    el.cancel()
+
+    def shutdown(self, wait=False):
+        """
+        Cancels all jobs and stops the workers
+        :param wait: waits for running jobs to reach a stage boundary
+        :return:
+        """
+        self.cancel()
+        with self.lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=True)
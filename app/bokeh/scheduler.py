@@ -0,0 +1,107 @@
+import time
+import threading
+
+__all__ = ["RenderScheduler"]
+
+
+class RenderScheduler:
+    """
+    Coalesces render requests. Requests arriving while a render is pending are merged into it,
+    the callback reads the latest state when it finally runs. Renders never overlap - requests arriving
+    while the callback runs are served by one more render after it finishes.
+    Each request increases the generation counter, renders of older generations can be discarded
+    """
+
+    MIN_INTERVAL = 0.1  # minimum time between renders in seconds
+
+    def __init__(self, callback, min_interval=None, parent=None):
+        super(RenderScheduler, self).__init__()
+
+        # callback receiving the generation to render
+        self.callback = callback
+        self.min_interval = self.MIN_INTERVAL if min_interval is None else float(min_interval)
+
+        # parent object used for debugging
+        self.parent = parent
+
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.pending = False
+        self.running = False
+        self.last_render = 0.
+
+        self.timer = None
+
+    def debug(self, msg):
+        if self.parent is not None:
+            try:
+                self.parent.debug(msg)
+            except AttributeError:
+                pass
+
+    def request(self, *args, **kwargs):
+        """
+        Requests a render, arguments are ignored so that the method can serve as a widget callback
+        :return: generation of the request
+        """
+        with self.lock:
+            self.generation += 1
+
+            if not self.pending and not self.running:
+                self._arm()
+
+            return self.generation
+
+    def _arm(self):
+        """
+        Starts the timer of the next render, called with the lock
+        :return:
+        """
+        self.pending = True
+
+        delay = max(0., self.last_render + self.min_interval - time.monotonic())
+        self.timer = threading.Timer(delay, self._run)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def is_current(self, generation):
+        """
+        Tests if the generation corresponds to the latest request
+        :param generation:
+        :return:
+        """
+        return generation == self.generation
+
+    def _run(self):
+        """
+        Runs the callback with the latest generation
+        :return:
+        """
+        with self.lock:
+            self.pending = False
+            self.running = True
+            self.timer = None
+            generation = self.generation
+            self.last_render = time.monotonic()
+
+        try:
+            self.callback(generation)
+        except Exception as e:
+            self.debug(f"Render error: {e}")
+        finally:
+            with self.lock:
+                self.running = False
+                # requested while rendering
+                if self.generation != generation and not self.pending:
+                    self._arm()
+
+    def cancel(self):
+        """
+        Cancels a pending render
+        :return:
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = False
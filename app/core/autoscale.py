@@ -0,0 +1,224 @@
+import math
+import threading
+
+import numpy as np
+
+__all__ = ["IntensityHistogram", "autoscale", "PRESETS"]
+
+# legacy mean based range, percentiles, IRAF zscale-like and a range for the logarithmic color map
+PRESETS = ("mean", "p99", "p99.9", "zscale", "log")
+
+
+class IntensityHistogram:
+    """
+    Intensity histogram with logarithmically spaced bins, suited for images dominated by a few bright Bragg peaks.
+    Large images are first sampled on a strided grid, further interleaved grids are added by refine()
+    until all pixels are counted. Percentiles are interpolated on the cumulative histogram
+    """
+
+    BINS = 4096
+    MAX_SAMPLES = 1 << 18       # pixels of one strided grid
+    ZSCALE_SAMPLES = 1000       # pixels used by the zscale fit
+
+    def __init__(self, data, mask=None, bins=None, max_samples=None):
+        super(IntensityHistogram, self).__init__()
+
+        self.bins = self.BINS if bins is None else int(bins)
+        max_samples = self.MAX_SAMPLES if max_samples is None else int(max_samples)
+
+        data = np.asarray(data)
+        if data.ndim != 2:
+            data = data.reshape(-1, data.shape[-1]) if data.ndim > 2 else data.reshape(1, -1)
+        self._data = data
+        self._mask = None if mask is None else np.asarray(mask).reshape(data.shape)
+
+        # interleaved strided grids, together they cover every pixel once
+        self._stride = max(1, int(math.ceil(math.sqrt(data.size / max(1, max_samples)))))
+        self._pending = [(i, j) for i in range(self._stride) for j in range(self._stride)]
+
+        self._lock = threading.Lock()
+        self._refine_lock = threading.Lock()
+        self._cumulative = None
+        self._zscale = None
+
+        self.count = 0
+        self.total = 0.
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+
+        sample = self._sample(*self._pending.pop(0))
+        self.min, self.max = (float(sample.min()), float(sample.max())) if sample.size > 0 else (0., 0.)
+
+        # log spacing above the minimum - fine bins for the background, coarse ones for the peaks
+        self._log_range = math.log1p(self.max - self.min)
+        self.bin_edges = self.min + np.expm1(np.linspace(0., self._log_range, self.bins + 1))
+
+        self._zsample = np.sort(sample[np.linspace(0, sample.size - 1, min(sample.size, self.ZSCALE_SAMPLES))
+                                .astype(np.intp)]) if sample.size > 0 else sample
+        self._add(sample)
+
+    def _sample(self, i, j):
+        """
+        Finite and unmasked pixels of one strided grid
+        :return:
+        """
+        s = self._stride
+        res = self._data[i::s, j::s]
+
+        valid = None
+        if self._mask is not None:
+            valid = ~self._mask[i::s, j::s]
+        if np.issubdtype(res.dtype, np.floating):
+            finite = np.isfinite(res)
+            valid = finite if valid is None else valid & finite
+        return (res if valid is None else res[valid]).ravel()
+
+    def _add(self, sample):
+        """
+        Adds a sample to the histogram, readers see either the old or the new counts
+        :param sample:
+        :return:
+        """
+        if sample.size == 0:
+            return
+
+        # values outside of the initial range go to the edge bins, the true extrema are tracked
+        scale = self.bins / self._log_range if self._log_range > 0 else 0.
+        idx = np.log1p(np.maximum(sample.astype(np.float64) - self.bin_edges[0], 0.))
+        idx *= scale
+        idx = idx.astype(np.intp)
+        np.minimum(idx, self.bins - 1, out=idx)
+
+        counts = self.counts + np.bincount(idx, minlength=self.bins)
+        with self._lock:
+            self.counts = counts
+            self.count += sample.size
+            self.total += float(sample.sum(dtype=np.float64))
+            self.min, self.max = min(self.min, float(sample.min())), max(self.max, float(sample.max()))
+            self._cumulative = None
+
+    @property
+    def is_complete(self):
+        return len(self._pending) == 0
+
+    @property
+    def fraction(self):
+        """
+        Fraction of the pixel grids counted so far
+        :return:
+        """
+        return 1. - len(self._pending) / self._stride ** 2
+
+    def refine(self, steps=None):
+        """
+        Counts further strided grids
+        :param steps: number of grids, None - all remaining ones
+        :return: True if all pixels are counted
+        """
+        with self._refine_lock:
+            n = len(self._pending) if steps is None else int(steps)
+            for _ in range(n):
+                if len(self._pending) == 0:
+                    break
+                self._add(self._sample(*self._pending[0]))
+                self._pending.pop(0)
+            return self.is_complete
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.
+
+    def percentile(self, q):
+        """
+        Estimates percentile(s) by interpolation on the cumulative histogram
+        :param q: percentile or a sequence of percentiles in the range 0-100
+        :return:
+        """
+        with self._lock:
+            if self._cumulative is None:
+                self._cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+            cum = self._cumulative
+            edges = self.bin_edges
+            lo, hi = self.min, self.max
+
+        target = np.clip(np.asarray(q, dtype=np.float64), 0., 100.) / 100. * cum[-1]
+        res = np.clip(np.interp(target, cum, edges), lo, hi)
+        if res.ndim == 0:
+            return float(res)
+        return res
+
+    def mode(self):
+        """
+        Most frequent intensity - the background level for diffraction images
+        :return:
+        """
+        with self._lock:
+            counts = self.counts
+        density = counts / np.maximum(np.diff(self.bin_edges), 1e-12)
+        i = int(np.argmax(density))
+        return float(0.5 * (self.bin_edges[i] + self.bin_edges[i + 1]))
+
+    def zscale(self, contrast=0.25, krej=2.5, max_iterations=5):
+        """
+        IRAF zscale-like range - a line is fitted to the sorted sample with iterative rejection of outliers,
+        the range spans the line slope divided by the contrast around the median
+        :return: (z1, z2)
+        """
+        if self._zscale is not None:
+            return self._zscale
+
+        samples = self._zsample.astype(np.float64)
+        npix = samples.size
+        if npix < 2:
+            self._zscale = (self.min, self.max)
+            return self._zscale
+
+        x = np.arange(npix, dtype=np.float64)
+        center = npix // 2
+        median = float(samples[center])
+
+        good = np.ones(npix, dtype=bool)
+        slope = 0.
+        for _ in range(max_iterations):
+            slope, intercept = np.polyfit(x[good], samples[good], 1)
+            residuals = samples - (slope * x + intercept)
+            sigma = residuals[good].std()
+
+            tgood = np.abs(residuals) < krej * max(sigma, 1e-12)
+            if tgood.sum() < npix // 2 or np.array_equal(tgood, good):
+                break
+            good = tgood
+
+        slope /= contrast
+        self._zscale = (max(self.min, median - center * slope), min(self.max, median + (npix - 1 - center) * slope))
+        return self._zscale
+
+
+def autoscale(hist, preset="mean"):
+    """
+    Suggests the range of the color map
+    :param hist: IntensityHistogram
+    :param preset: one of PRESETS
+    :return: (minimum, maximum, logarithmic color map)
+    """
+    if preset == "mean":
+        lo, hi, blog = 0., 3. * hist.mean, False
+    elif preset == "p99":
+        (lo, hi), blog = hist.percentile((1., 99.)), False
+    elif preset == "p99.9":
+        (lo, hi), blog = hist.percentile((0.1, 99.9)), False
+    elif preset == "zscale":
+        (lo, hi), blog = hist.zscale(), False
+    elif preset == "log":
+        # from the background up to the brightest peaks, the minimum has to be positive
+        lo, hi, blog = hist.mode(), hist.percentile(99.999), True
+        if lo <= 0:
+            lo = hist.percentile(50.)
+        if lo <= 0:
+            lo = min(1., hi * 1e-3) if hi > 0 else 1.
+    else:
+        raise ValueError(f"preset must be one of {PRESETS}")
+
+    lo, hi = float(lo), float(hi)
+    if hi <= lo:
+        hi = lo + 1.
+    return lo, hi, blog
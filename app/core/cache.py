@@ -0,0 +1,139 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+__all__ = ["ImageCache", "content_key"]
+
+
+def content_key(content):
+    """
+    Identity of raw file content, the same bytes uploaded again map to the same key.
+    sha1 is used for speed (hardware accelerated on most CPUs), not for security
+    :param content: bytes, bytearray or memoryview
+    :return:
+    """
+    return hashlib.sha1(content, usedforsecurity=False).hexdigest()
+
+
+class ImageCache:
+    """
+    LRU cache of decoded images (frame stacks) together with everything derived from them - statistics,
+    histograms, oriented copies, pyramid levels. Entries report their size by nbytes, which grows as derived
+    products are added, so the byte budget is checked on every access.
+    The most recently used entry is never evicted, even if it alone exceeds the budget
+    """
+
+    MAX_BYTES = 1 << 30     # memory budget in bytes
+
+    def __init__(self, max_bytes=None, on_evict=None):
+        """
+        :param max_bytes: memory budget, None - class default
+        :param on_evict: called with (key, value) for every evicted entry, e.g. to close files
+        """
+        super(ImageCache, self).__init__()
+
+        self.max_bytes = self.MAX_BYTES if max_bytes is None else int(max_bytes)
+        self.on_evict = on_evict
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def holds(self, value):
+        """
+        Tests if the object is one of the cached values
+        :param value:
+        :return:
+        """
+        with self._lock:
+            return any([el is value for el in self._cache.values()])
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return self._nbytes()
+
+    def _nbytes(self):
+        return sum([getattr(el, "nbytes", 0) for el in self._cache.values()])
+
+    def get(self, key):
+        """
+        Returns a cached value and marks it as recently used
+        :param key:
+        :return: value or None
+        """
+        with self._lock:
+            res = self._cache.get(key)
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache.move_to_end(key)
+        return res
+
+    def put(self, key, value):
+        """
+        Adds a value as the most recently used one, older entries are evicted to fit the budget
+        :param key:
+        :param value:
+        :return:
+        """
+        with self._lock:
+            old = self._cache.pop(key, None)
+            self._cache[key] = value
+            evicted = self._evict()
+
+        if old is not None and old is not value:
+            evicted.insert(0, (key, old))
+        self._notify(evicted)
+
+    def trim(self):
+        """
+        Evicts entries exceeding the budget, derived products of cached images may have grown since they were added
+        :return:
+        """
+        with self._lock:
+            evicted = self._evict()
+        self._notify(evicted)
+
+    def _evict(self):
+        res = []
+        total = self._nbytes()
+        while total > self.max_bytes and len(self._cache) > 1:
+            key, value = self._cache.popitem(last=False)
+            total -= getattr(value, "nbytes", 0)
+            res.append((key, value))
+        self.evictions += len(res)
+        return res
+
+    def _notify(self, evicted):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            self.on_evict(key, value)
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._cache.items())
+            self._cache.clear()
+        self._notify(evicted)
+
+    def format_info(self):
+        """
+        Returns a short string with the cache usage and hit/miss counters
+        :return:
+        """
+        with self._lock:
+            nbytes, count = self._nbytes(), len(self._cache)
+        return (f"{count} images, {nbytes / (1 << 20):.1f}/{self.max_bytes / (1 << 20):.0f} MB; "
+                f"hits: {self.hits}; misses: {self.misses}; evictions: {self.evictions}")
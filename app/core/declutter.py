@@ -0,0 +1,124 @@
+import re
+
+import numpy as np
+
+__all__ = ["LabelDeclutter", "font_size_px"]
+
+
+def font_size_px(value, default=16.):
+    """
+    Converts a css font size ("12px", "1.5em", "10pt") into pixels
+    :param value:
+    :return:
+    """
+    m = re.match(r"^\s*([\d.]+)\s*(px|em|rem|pt|%)?\s*$", str(value))
+    if m is None:
+        return default
+
+    v, unit = float(m.group(1)), m.group(2)
+    if unit in ("em", "rem"):
+        v *= default
+    elif unit == "pt":
+        v *= 4. / 3.
+    elif unit == "%":
+        v *= default / 100.
+    return v
+
+
+class LabelDeclutter:
+    """
+    Selects a non-overlapping subset of labels for a viewport, labels are ranked by priority (e.g. intensity).
+    Candidates are first reduced to the best one per grid cell of the label size,
+    the remaining ones are placed greedily testing neighbouring cells only
+    """
+
+    MAX_LABELS = 300
+    CHAR_WIDTH = 0.6    # average character width relative to the font size
+
+    def __init__(self, x, y, priority, names):
+        super(LabelDeclutter, self).__init__()
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        priority = np.asarray(priority, dtype=np.float64)
+        names = np.asarray(names, dtype=str)
+
+        lengths = np.char.str_len(names) if len(names) > 0 else np.zeros(0, dtype=int)
+        valid = np.isfinite(x) & np.isfinite(y) & (lengths > 0)
+
+        # candidates sorted by decreasing priority once
+        idx = np.flatnonzero(valid)
+        order = np.argsort(-np.nan_to_num(priority[idx], nan=-np.inf), kind="stable")
+        self.index = idx[order]
+        self.x = x[self.index]
+        self.y = y[self.index]
+        self.lengths = lengths[self.index]
+
+    def __len__(self):
+        return len(self.index)
+
+    def select(self, x0, x1, y0, y1, screen_width, screen_height, font_size=16., xoffset=0, yoffset=0,
+               max_labels=None):
+        """
+        Selects labels for the viewport
+        :param x0: viewport in data coordinates
+        :param x1:
+        :param y0:
+        :param y1:
+        :param screen_width: viewport size in screen pixels
+        :param screen_height:
+        :param font_size: font size in pixels
+        :param xoffset: label offset in screen pixels
+        :param yoffset:
+        :param max_labels:
+        :return: indices of the selected labels in the arrays passed to the constructor
+        """
+        max_labels = self.MAX_LABELS if max_labels is None else int(max_labels)
+        if len(self) == 0 or x1 == x0 or y1 == y0:
+            return np.zeros(0, dtype=np.intp)
+
+        # screen coordinates of the label boxes
+        sx = (self.x - x0) * (screen_width / (x1 - x0)) + xoffset
+        sy = (self.y - y0) * (screen_height / (y1 - y0)) + yoffset
+        widths = self.lengths * font_size * self.CHAR_WIDTH
+        height = font_size * 1.2
+
+        inside = (sx + widths > 0) & (sx < screen_width) & (sy + height > 0) & (sy < screen_height)
+        cand = np.flatnonzero(inside)
+        if len(cand) == 0:
+            return np.zeros(0, dtype=np.intp)
+
+        # best candidate per grid cell, cells are as large as the widest label
+        cw, ch = max(1., float(widths[cand].max())), height
+        cx = np.floor(sx[cand] / cw).astype(np.int64)
+        cy = np.floor(sy[cand] / ch).astype(np.int64)
+        ncx = int(screen_width // cw) + 3
+        cells = (cy + 1) * ncx + (cx + 1)
+        _, first = np.unique(cells, return_index=True)
+        cand = cand[np.sort(first)]
+
+        # greedy placement in the order of priority
+        placed = {}
+        res = []
+        for i, tx, ty, tw, tcx, tcy in zip(cand.tolist(), sx[cand].tolist(), sy[cand].tolist(), widths[cand].tolist(),
+                                           np.floor(sx[cand] / cw).astype(np.int64).tolist(),
+                                           np.floor(sy[cand] / ch).astype(np.int64).tolist()):
+            boverlap = False
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    other = placed.get((tcx + dx, tcy + dy))
+                    if other is not None:
+                        ox, oy, ow = other
+                        if tx < ox + ow and ox < tx + tw and ty < oy + height and oy < ty + height:
+                            boverlap = True
+                            break
+                if boverlap:
+                    break
+
+            if not boverlap:
+                placed[(tcx, tcy)] = (tx, ty, tw)
+                res.append(i)
+                if len(res) >= max_labels:
+                    break
+
+        return self.index[np.asarray(res, dtype=np.intp)]
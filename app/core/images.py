@@ -0,0 +1,262 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.core.stats import ImageStats
+from app.core.autoscale import IntensityHistogram
+from app.core.orientation import OrientationCache
+from app.core.pyramid import ImagePyramid
+from app.core.timing import timer
+
+__all__ = ["LoadedImage", "upload_content", "load_image"]
+
+
+class LoadedImage:
+    """
+    Decoded detector image together with information on how it was obtained
+    """
+
+    def __init__(self, data, filename=None, decoder=None, timings=None):
+        super(LoadedImage, self).__init__()
+
+        self.data = data
+        self.filename = filename
+
+        # "file", "frame" for frames of a stack, "projection"
+        self.decoder = decoder
+
+        # stage name -> duration in seconds
+        self.timings = {} if timings is None else dict(timings)
+
+        # derived products cached for the lifetime of the image
+        self._lock = threading.Lock()
+        self._stats = None
+        self._oriented = None
+        self._masked_stats = (None, None)
+        self._histogram = (None, None)
+        self._pyramids = OrderedDict()
+
+        # copy of the pixels in shared memory, created by the first offloaded computation
+        self._shared = None
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the image and its derived products
+        :return:
+        """
+        with self._lock:
+            res = self.data.nbytes
+            if self._oriented is not None:
+                res += self._oriented.nbytes
+            # the finest level is the oriented image itself
+            res += sum([el.nbytes - el.levels[0].nbytes for el in self._pyramids.values()])
+            return res
+
+    def _share(self, offload):
+        """
+        Places the pixels in shared memory, called with the lock. The shared copy replaces the array,
+        so that the image is not kept in memory twice
+        :param offload: OffloadEngine
+        :return: SharedArray
+        """
+        if self._shared is None:
+            self._shared = offload.share(self.data)
+            self.data = self._shared.array
+        return self._shared
+
+    def _compute_stats(self, mask=None, offload=None):
+        """
+        Computes statistics in the calling thread or in a worker process, called with the lock
+        :param mask: boolean array or None
+        :param offload: OffloadEngine or None
+        :return: ImageStats
+        """
+        if offload is None:
+            return ImageStats(self.data, mask=mask)
+        return offload.stats(self._share(offload), mask=mask)
+
+    @property
+    def stats(self):
+        """
+        Statistics of the image, computed once on the first access
+        :return: ImageStats
+        """
+        return self.full_stats()
+
+    def full_stats(self, offload=None):
+        """
+        Statistics of all pixels, computed once
+        :param offload: OffloadEngine computing the statistics in a worker process, None - in the calling thread
+        :return: ImageStats
+        """
+        with self._lock:
+            if self._stats is None:
+                with timer("stats", shape=self.data.shape) as t:
+                    self._stats = self._compute_stats(offload=offload)
+                self.timings["stats"] = t.seconds
+            return self._stats
+
+    def masked_stats(self, mask=None, offload=None):
+        """
+        Statistics of pixels not excluded by a mask, the result for the latest mask state is cached
+        :param mask: DetectorMask or None
+        :param offload: OffloadEngine or None
+        :return: ImageStats
+        """
+        if mask is None or mask.is_empty:
+            return self.full_stats(offload)
+
+        with self._lock:
+            key, stats = self._masked_stats
+            if key != mask.key:
+                with timer("stats", shape=self.data.shape, masked=True) as t:
+                    stats = self._compute_stats(mask.data, offload)
+                self.timings["masked_stats"] = t.seconds
+                self._masked_stats = (mask.key, stats)
+            return stats
+
+    def histogram(self, mask=None):
+        """
+        Intensity histogram used by autoscaling, built from a subsample and cached for the latest mask state
+        :param mask: DetectorMask or None
+        :return: IntensityHistogram
+        """
+        key = None if mask is None or mask.is_empty else mask.key
+        with self._lock:
+            tkey, res = self._histogram
+            if res is None or tkey != key:
+                with timer("histogram", shape=self.data.shape) as t:
+                    res = IntensityHistogram(self.data, mask=None if key is None else mask.data)
+                self.timings["histogram"] = t.seconds
+                self._histogram = (key, res)
+            return res
+
+    def oriented(self, rotation=0, flip="None"):
+        """
+        Returns the image rotated and flipped, recently used orientations are cached
+        :param rotation: counterclockwise rotation in degrees
+        :param flip: "None", "H" or "V"
+        :return:
+        """
+        with self._lock:
+            if self._oriented is None:
+                self._oriented = OrientationCache(self.data)
+            return self._oriented.get(rotation, flip)
+
+    def pyramid(self, rotation=0, flip="None", offload=None):
+        """
+        Returns the multi-resolution representation of the oriented image, pyramids of recently used
+        orientations are cached together with the oriented copies
+        :param rotation:
+        :param flip:
+        :param offload: OffloadEngine orienting and downsampling in a worker process, None - in the calling thread
+        :return: ImagePyramid
+        """
+        if offload is not None:
+            return self._offload_pyramid(rotation, flip, offload)
+
+        data = self.oriented(rotation, flip)
+        key = ImagePyramid.key_of(data)
+
+        with self._lock:
+            res = self._pyramids.get(key)
+            if res is None:
+                with timer("pyramid", shape=data.shape) as t:
+                    res = ImagePyramid(data)
+                self.timings["pyramid"] = t.seconds
+                self._add_pyramid(res)
+            else:
+                self._pyramids.move_to_end(key)
+            return res
+
+    def _add_pyramid(self, pyramid):
+        """
+        Caches a pyramid, called with the lock
+        :param pyramid:
+        :return:
+        """
+        self._pyramids[pyramid.key] = pyramid
+        while len(self._pyramids) > OrientationCache.MAX_ENTRIES:
+            self._pyramids.popitem(last=False)
+
+    def _offload_pyramid(self, rotation, flip, offload):
+        """
+        Returns a cached pyramid or computes the oriented copy and the levels in a worker process,
+        the results are written into shared memory allocated here
+        :return: ImagePyramid
+        """
+        with self._lock:
+            if self._oriented is None:
+                self._oriented = OrientationCache(self.data)
+
+            data = self._oriented.peek(rotation, flip)
+            res = None if data is None else self._pyramids.get(ImagePyramid.key_of(data))
+            if res is not None:
+                self._pyramids.move_to_end(res.key)
+                return res
+
+            shared = self._share(offload)
+
+        # the image stays accessible while the worker computes, e.g. for the statistics or the cache budget
+        with timer("pyramid", shape=shared.array.shape, offload=True) as t:
+            data, res = offload.pyramid(shared, rotation, flip)
+
+        with self._lock:
+            self.timings["pyramid"] = t.seconds
+
+            # the shared copy may have replaced the array the orientation cache refers to
+            if self._oriented.data is not self.data:
+                self._oriented = OrientationCache(self.data)
+            self._oriented.put(rotation, flip, data)
+            self._add_pyramid(res)
+            return res
+
+    def format_timings(self):
+        """
+        Returns a short string with timings of individual stages in ms
+        :return:
+        """
+        return "; ".join([f"{k}: {v*1e3:.1f} ms" for k, v in self.timings.items()])
+
+
+def _read_fabio(source):
+    """
+    Opens an image with fabio and forces reading of the data while the file is still open
+    :param source: filename or a file object
+    :return:
+    """
+    # imported on first use, fabio loads all its format readers
+    import fabio.openimage
+
+    with fabio.openimage.openimage(source) as fh:
+        return np.asarray(fh.data)
+
+
+def load_image(filename):
+    """
+    Reads an image file from the disk
+    :param filename:
+    :return: LoadedImage
+    """
+    with timer("decode", filename=filename) as t:
+        data = _read_fabio(filename)
+    return LoadedImage(data, filename=filename, decoder="file", timings={"decode": t.seconds})
+
+
+def upload_content(upload):
+    """
+    Extracts filename and content from an entry of the FileUpload value
+    :param upload:
+    :return: (filename, content)
+    """
+    if "content" in upload:
+        return upload.get("name", ""), upload["content"]
+
+    filename = tuple(upload.keys())[0]
+    return filename, upload[filename]["content"]
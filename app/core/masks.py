@@ -0,0 +1,261 @@
+import os
+import threading
+
+import numpy as np
+
+from app.core.orientation import OrientationCache
+from app.core.spatial import points_in_polygon
+
+__all__ = ["DetectorMask", "MaskStore", "detect_hot_pixels"]
+
+
+def detect_hot_pixels(data, threshold=None, nsigma=None, size=3, mask=None, chunk_size=1 << 20):
+    """
+    Finds hot pixels - pixels above an absolute threshold and isolated single-pixel spikes.
+    A spike is brighter than all its neighbours, stands out of their median and the median itself is at the level
+    of the background measured on a ring further away, so that the center of a sharp Bragg peak is not a spike.
+    The medians are evaluated only for candidate pixels brighter than all their neighbours, the test is vectorized
+    :param data: image
+    :param threshold: pixels above the value are hot, e.g. the overflow value of the detector
+    :param nsigma: excess over the local median in units of poisson noise, None - no local test
+    :param size: size of the neighbourhood, odd
+    :param mask: pixels already excluded
+    :param chunk_size: number of pixels processed at once
+    :return: boolean array of the image shape
+    """
+    data = np.asarray(data)
+    ny, nx = data.shape
+    res = np.zeros(data.shape, dtype=bool)
+
+    half = max(1, int(size) // 2)
+    rows = max(1, chunk_size // max(1, nx))
+
+    # neighbourhood offsets without the center
+    dy, dx = np.mgrid[-half:half + 1, -half:half + 1]
+    center = dy.size // 2
+    dy, dx = np.delete(dy.ravel(), center), np.delete(dx.ravel(), center)
+
+    # background ring outside of the neighbourhood, a peak spreading over the neighbours does not reach it
+    pad = half + 2
+    ry, rx = np.mgrid[-pad:pad + 1, -pad:pad + 1]
+    ring = np.maximum(np.abs(ry), np.abs(rx)).ravel() == pad
+    ry, rx = ry.ravel()[ring], rx.ravel()[ring]
+
+    for i in range(0, ny, rows):
+        block = data[i:i + rows]
+
+        if threshold is not None:
+            res[i:i + rows] |= block > threshold
+
+        if nsigma is None:
+            continue
+
+        # local maxima of the block rows are candidates, edges replicate the border pixels
+        r0, r1 = max(0, i - pad), min(ny, i + rows + pad)
+        padded = np.pad(data[r0:r1], ((pad - (i - r0), pad - (r1 - min(ny, i + rows))), (pad, pad)),
+                        mode="edge")
+        cand = np.ones(block.shape, dtype=bool)
+        for oy, ox in zip(dy.tolist(), dx.tolist()):
+            cand &= block > padded[pad + oy:pad + oy + block.shape[0], pad + ox:pad + ox + nx]
+
+        cy, cx = np.nonzero(cand)
+        if len(cy) == 0:
+            continue
+
+        neighbours = padded[cy[:, None] + pad + dy, cx[:, None] + pad + dx].astype(np.float64)
+        median = np.median(neighbours, axis=1)
+        background = np.median(padded[cy[:, None] + pad + ry, cx[:, None] + pad + rx].astype(np.float64), axis=1)
+        value = block[cy, cx].astype(np.float64)
+
+        hot = value - median > nsigma * np.sqrt(np.maximum(median, 1.))
+        hot &= median - background <= nsigma * np.sqrt(np.maximum(background, 1.))
+        res[cy[hot] + i, cx[hot]] = True
+
+    if mask is not None:
+        res &= ~mask
+    return res
+
+
+class DetectorMask:
+    """
+    Boolean mask of excluded detector pixels (True - excluded): gasket shadows, the beamstop, hot pixels.
+    Every change increments the version, derived products (oriented copies, masked statistics) are keyed by it
+    """
+
+    def __init__(self, shape, data=None):
+        super(DetectorMask, self).__init__()
+
+        self.shape = tuple(shape[:2])
+
+        self._lock = threading.Lock()
+        self.version = 0
+        self.data = np.zeros(self.shape, dtype=bool)
+        self._oriented = None
+
+        # polygons in detector coordinates, kept for information
+        self.polygons = []
+
+        if data is not None:
+            self.update(data, replace=True)
+
+    @property
+    def key(self):
+        return id(self), self.version
+
+    @property
+    def count(self):
+        return int(np.count_nonzero(self.data))
+
+    @property
+    def is_empty(self):
+        return not self.data.any()
+
+    def _changed(self, data):
+        data.flags.writeable = False
+        self.data = data
+        self.version += 1
+        self._oriented = None
+
+    def update(self, data, replace=False):
+        """
+        Adds pixels to the mask or replaces it
+        :param data: boolean array of the detector shape
+        :param replace:
+        :return:
+        """
+        data = np.asarray(data, dtype=bool)
+        if data.shape != self.shape:
+            raise ValueError(f"mask shape {data.shape} does not match the detector shape {self.shape}")
+
+        with self._lock:
+            self._changed(data.copy() if replace else self.data | data)
+
+    def clear(self):
+        with self._lock:
+            self.polygons = []
+            self._changed(np.zeros(self.shape, dtype=bool))
+
+    def add_polygon(self, xs, ys):
+        """
+        Masks pixels with centers inside a polygon given in detector coordinates
+        :param xs:
+        :param ys:
+        :return: number of masked pixels
+        """
+        xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+        if len(xs) < 3:
+            return 0
+
+        ny, nx = self.shape
+        x0, x1 = max(0, int(np.floor(xs.min()))), min(nx, int(np.ceil(xs.max())))
+        y0, y1 = max(0, int(np.floor(ys.min()))), min(ny, int(np.ceil(ys.max())))
+        if x1 <= x0 or y1 <= y0:
+            return 0
+
+        # only the bounding box is rasterized
+        cx = np.arange(x0, x1) + 0.5
+        cy = np.arange(y0, y1)[:, None] + 0.5
+        inside = points_in_polygon(cx, cy, xs, ys)
+
+        with self._lock:
+            data = self.data.copy()
+            data[y0:y1, x0:x1] |= inside
+            self.polygons.append((xs, ys))
+            self._changed(data)
+        return int(np.count_nonzero(inside))
+
+    def add_hot_pixels(self, image, threshold=None, nsigma=None, size=3):
+        """
+        Masks hot pixels of an image, see detect_hot_pixels()
+        :return: number of newly masked pixels
+        """
+        hot = detect_hot_pixels(image, threshold=threshold, nsigma=nsigma, size=size, mask=self.data)
+        self.update(hot)
+        return int(np.count_nonzero(hot))
+
+    def oriented(self, rotation=0, flip="None"):
+        """
+        Returns the mask oriented as the image, copies are cached until the mask changes
+        :return:
+        """
+        with self._lock:
+            if self._oriented is None:
+                self._oriented = OrientationCache(self.data)
+            return self._oriented.get(rotation, flip)
+
+    def save(self, filename):
+        """
+        Saves the mask - numpy (.npy, .npz) or an image format known to fabio (non-zero - masked)
+        :param filename:
+        :return:
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == ".npy":
+            np.save(filename, self.data)
+        elif ext == ".npz":
+            np.savez_compressed(filename, mask=self.data)
+        else:
+            import fabio
+
+            image = fabio.factory(ext.lstrip(".") + "image")
+            image.data = self.data.astype(np.uint8)
+            image.write(filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a mask saved by save() or by other software
+        :param filename:
+        :return: DetectorMask
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == ".npy":
+            data = np.load(filename)
+        elif ext == ".npz":
+            with np.load(filename) as fh:
+                data = fh["mask"] if "mask" in fh else fh[fh.files[0]]
+        else:
+            import fabio
+
+            with fabio.open(filename) as fh:
+                data = np.asarray(fh.data)
+
+        data = np.asarray(data) != 0
+        return cls(data.shape, data)
+
+
+class MaskStore:
+    """
+    Masks of detectors identified by their shape, images of the same detector share the mask
+    """
+
+    def __init__(self):
+        super(MaskStore, self).__init__()
+
+        self._lock = threading.Lock()
+        self.masks = {}
+
+    def get(self, shape, create=True):
+        """
+        Returns the mask for a detector shape
+        :param shape:
+        :param create: create an empty mask if there is none
+        :return: DetectorMask or None
+        """
+        shape = tuple(shape[:2])
+        with self._lock:
+            res = self.masks.get(shape)
+            if res is None and create:
+                res = self.masks[shape] = DetectorMask(shape)
+            return res
+
+    def load(self, filename):
+        """
+        Loads a mask, it replaces the mask of the same detector shape
+        :param filename:
+        :return: DetectorMask
+        """
+        mask = DetectorMask.load(filename)
+        with self._lock:
+            self.masks[mask.shape] = mask
+        return mask
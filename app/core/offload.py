@@ -0,0 +1,247 @@
+import threading
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from app.core.stats import ImageStats
+from app.core.orientation import Orientation
+from app.core.pyramid import ImagePyramid
+
+__all__ = ["OffloadEngine", "SharedArray", "START_METHOD"]
+
+# start method of worker processes - forking the kernel could copy locks held by its threads into the workers
+START_METHOD = "spawn"
+
+# blocks whose arrays were released, they are closed on the next allocation - a block cannot be closed
+# from the finalizer of its array because the array still holds the buffer at that moment
+_released = []
+_released_lock = threading.Lock()
+
+
+def _release(shm, unlink):
+    """
+    Finalizer of an array in shared memory
+    :return:
+    """
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    with _released_lock:
+        _released.append(shm)
+
+
+def _collect():
+    """
+    Closes blocks of released arrays, the memory is returned to the system once every process closed the block
+    :return:
+    """
+    with _released_lock:
+        pending, _released[:] = list(_released), []
+
+    for shm in pending:
+        try:
+            shm.close()
+        except BufferError:
+            with _released_lock:
+                _released.append(shm)
+
+
+class SharedArray:
+    """
+    Array in a shared memory block, processes exchange the small handle (name, shape, dtype) instead of the pixels.
+    The owner unlinks the block when the array and all its views are garbage collected
+    """
+
+    def __init__(self, shm, shape, dtype, owner=False):
+        super(SharedArray, self).__init__()
+
+        self.shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        if owner:
+            weakref.finalize(self.array, _release, shm, True)
+
+    @property
+    def handle(self):
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    @classmethod
+    def create(cls, shape, dtype):
+        """
+        Allocates a new block owned by the calling process
+        :param shape:
+        :param dtype:
+        :return:
+        """
+        _collect()
+
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        return cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype, owner=True)
+
+    @classmethod
+    def copy_of(cls, data):
+        """
+        Copies an array into a new block
+        :param data:
+        :return:
+        """
+        res = cls.create(data.shape, data.dtype)
+        np.copyto(res.array, data)
+        return res
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Opens a block created by another process, has to be closed after use
+        :param handle: (name, shape, dtype)
+        :return:
+        """
+        name, shape, dtype = handle
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype)
+
+    def close(self):
+        """
+        Closes an attached block, views of the array must not be used afterwards
+        :return:
+        """
+        self.array = None
+        self.shm.close()
+
+
+def _attached(func, handles, *args):
+    """
+    Runs func(*args, *arrays) on arrays of attached blocks, blocks are closed after the call
+    :param func:
+    :param handles: block handles, None entries are passed as None
+    :return:
+    """
+    blocks = [None if el is None else SharedArray.attach(el) for el in handles]
+    try:
+        return func(*args, *[None if el is None else el.array for el in blocks])
+    finally:
+        for el in blocks:
+            if el is not None:
+                try:
+                    el.close()
+                except BufferError:
+                    # views are still referenced by a traceback, the block is closed with the process
+                    pass
+
+
+def _stats(kwargs, data, mask):
+    return ImageStats(data, mask=mask, **kwargs)
+
+
+def _pyramid(orientation, data, oriented, *levels):
+    """
+    Orients the image into the oriented block and downsamples it into the level blocks
+    :return:
+    """
+    rotation, flip = orientation
+
+    prev = data
+    if oriented is not None:
+        np.copyto(oriented, Orientation(data.shape, rotation, flip).view_image(data))
+        prev = oriented
+
+    for level in levels:
+        np.copyto(level, ImagePyramid._downsample(prev))
+        prev = level
+
+
+def _run_stats(handle, mask_handle, kwargs):
+    return _attached(_stats, [handle, mask_handle], kwargs)
+
+
+def _run_pyramid(handles, orientation):
+    _attached(_pyramid, handles, orientation)
+
+
+class OffloadEngine:
+    """
+    Computes derived products of images (statistics, oriented copies, pyramid levels) in worker processes,
+    so that the GIL of the notebook kernel stays free for the event loop.
+    The image is copied into shared memory once, workers read it from there and write large results
+    into blocks allocated by the calling process - only handles and small results are pickled
+    """
+
+    WORKERS = 2     # worker processes
+
+    def __init__(self, workers=None):
+        super(OffloadEngine, self).__init__()
+
+        self.workers = self.WORKERS if workers is None else max(1, int(workers))
+
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _submit(self, func, *args):
+        from concurrent.futures import ProcessPoolExecutor
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(START_METHOD))
+            future = self._pool.submit(func, *args)
+        return future.result()
+
+    @staticmethod
+    def share(data):
+        """
+        Copies an image into shared memory
+        :param data:
+        :return: SharedArray
+        """
+        return SharedArray.copy_of(np.ascontiguousarray(data))
+
+    def stats(self, shared, mask=None, **kwargs):
+        """
+        Statistics of a shared image
+        :param shared: SharedArray
+        :param mask: boolean array, True - excluded
+        :param kwargs: parameters of ImageStats
+        :return: ImageStats
+        """
+        tmask = None if mask is None else SharedArray.copy_of(np.asarray(mask, dtype=bool))
+        return self._submit(_run_stats, shared.handle, None if tmask is None else tmask.handle, kwargs)
+
+    def pyramid(self, shared, rotation=0, flip="None", min_size=None):
+        """
+        Oriented copy of a shared image and its pyramid
+        :param shared: SharedArray
+        :param rotation:
+        :param flip:
+        :param min_size:
+        :return: (oriented image, ImagePyramid), the oriented image is the shared array itself for the identity
+        """
+        orientation = Orientation(shared.array.shape, rotation, flip)
+
+        oriented = None if orientation.is_identity else SharedArray.create(orientation.shape, shared.array.dtype)
+        levels = [SharedArray.create(el, shared.array.dtype)
+                  for el in ImagePyramid.level_shapes(orientation.shape, min_size)]
+
+        handles = [shared.handle, None if oriented is None else oriented.handle] + [el.handle for el in levels]
+        self._submit(_run_pyramid, handles, (rotation, flip))
+
+        data = shared.array if oriented is None else oriented.array
+        return data, ImagePyramid(data, min_size=min_size, levels=[el.array for el in levels])
+
+    def close(self):
+        """
+        Stops worker processes
+        :return:
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+        _collect()
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from app.core.timing import timer
+
+__all__ = ["Orientation", "OrientationCache"]
+
+
+class Orientation:
+    """
+    Rotation (counterclockwise, multiples of 90 degrees) followed by an optional flip of an image.
+    The transform is described by an affine matrix acting on continuous image coordinates,
+    pixel (row, col) covers x in [col, col+1] and y in [row, row+1]
+    """
+
+    ROTATIONS = (0, 90, 180, 270)
+    FLIPS = ("None", "H", "V")
+
+    def __init__(self, shape, rotation=0, flip="None"):
+        super(Orientation, self).__init__()
+
+        self.rotation = int(rotation) % 360
+        if self.rotation not in self.ROTATIONS:
+            raise ValueError(f"rotation must be one of {self.ROTATIONS}")
+
+        flip = "None" if flip is None else str(flip)
+        self.flip = flip.upper() if len(flip) == 1 else "None"
+
+        self.in_shape = tuple(shape[:2])
+        self.matrix, self.shape = self._build_matrix()
+
+    def _build_matrix(self):
+        """
+        Composes the affine matrix and the output shape
+        :return:
+        """
+        ny, nx = self.in_shape
+        res = np.eye(3)
+
+        # each np.rot90 step maps (x, y) -> (y, nx - x)
+        for _ in range(self.rotation // 90):
+            step = np.array([[0., 1., 0.], [-1., 0., nx], [0., 0., 1.]])
+            res = step @ res
+            ny, nx = nx, ny
+
+        if self.flip == "V":
+            res = np.array([[1., 0., 0.], [0., -1., ny], [0., 0., 1.]]) @ res
+        elif self.flip == "H":
+            res = np.array([[-1., 0., nx], [0., 1., 0.], [0., 0., 1.]]) @ res
+
+        return res, (ny, nx)
+
+    @property
+    def key(self):
+        """
+        Key identifying the transform, equivalent combinations (e.g. 180 + H and V) share it
+        :return:
+        """
+        return self.in_shape, tuple(np.rint(self.matrix).astype(int).ravel().tolist())
+
+    @property
+    def is_identity(self):
+        return np.array_equal(self.matrix, np.eye(3))
+
+    def view_image(self, data):
+        """
+        Returns an oriented view of the image without copying the pixels
+        :param data:
+        :return:
+        """
+        res = data
+        if self.rotation > 0:
+            res = np.rot90(res, k=self.rotation // 90)
+        if self.flip == "V":
+            res = np.flipud(res)
+        elif self.flip == "H":
+            res = np.fliplr(res)
+        return res
+
+    def apply_image(self, data):
+        """
+        Returns an oriented C contiguous copy of the image, the image itself for the identity
+        :param data:
+        :return:
+        """
+        if self.is_identity:
+            return data
+        return np.ascontiguousarray(self.view_image(data))
+
+    def apply_points(self, x, y):
+        """
+        Transforms point coordinates with a single affine operation
+        :param x:
+        :param y:
+        :return: (x, y) as float arrays
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        m = self.matrix
+        return m[0, 0] * x + m[0, 1] * y + m[0, 2], m[1, 0] * x + m[1, 1] * y + m[1, 2]
+
+    def invert_points(self, x, y):
+        """
+        Transforms coordinates of the oriented image back to the original image
+        :param x:
+        :param y:
+        :return: (x, y) as float arrays
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        m = np.linalg.inv(self.matrix)
+        return m[0, 0] * x + m[0, 1] * y + m[0, 2], m[1, 0] * x + m[1, 1] * y + m[1, 2]
+
+
+class OrientationCache:
+    """
+    Keeps oriented copies of one image for recently used orientations
+    """
+
+    MAX_ENTRIES = 2
+
+    def __init__(self, data, max_entries=None):
+        super(OrientationCache, self).__init__()
+
+        self.data = data
+        self.max_entries = self.MAX_ENTRIES if max_entries is None else int(max_entries)
+        self.cache = OrderedDict()
+
+    @property
+    def nbytes(self):
+        return sum([el.nbytes for el in self.cache.values() if el is not self.data])
+
+    def get(self, rotation, flip):
+        """
+        Returns the oriented image, equivalent orientations return the same array object
+        :param rotation:
+        :param flip:
+        :return:
+        """
+        orientation = Orientation(self.data.shape, rotation, flip)
+        key = orientation.key
+
+        res = self.cache.get(key)
+        if res is None:
+            with timer("transform", shape=self.data.shape, orientation=key):
+                res = orientation.apply_image(self.data)
+            self.put(rotation, flip, res)
+        else:
+            self.cache.move_to_end(key)
+        return res
+
+    def peek(self, rotation, flip):
+        """
+        Returns the oriented image if it is cached
+        :param rotation:
+        :param flip:
+        :return: array or None
+        """
+        orientation = Orientation(self.data.shape, rotation, flip)
+        if orientation.is_identity:
+            return self.data
+        return self.cache.get(orientation.key)
+
+    def put(self, rotation, flip, data):
+        """
+        Adds an oriented image computed elsewhere, e.g. by a worker process
+        :param rotation:
+        :param flip:
+        :param data:
+        :return:
+        """
+        self.cache[Orientation(self.data.shape, rotation, flip).key] = data
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
@@ -0,0 +1,310 @@
+import io
+import re
+
+import numpy as np
+
+__all__ = ["CrysalisPeak", "PeakTable", "PeakDiff", "PEAK_DTYPE", "PEAK_FIELDS", "parse_peak_table"]
+
+# columns of the Crysalis peak table (pt e, detector coordinates)
+PEAK_DTYPE = np.dtype([
+    ("index", np.int64),
+    ("h", np.float64), ("k", np.float64), ("l", np.float64),
+    ("detx", np.float64), ("dety", np.float64),
+    ("dspacing", np.float64), ("intensity", np.float64),
+    ("indexing", "U4"), ("group", "U8"), ("profile", "U8"),
+])
+
+PEAK_FIELDS = PEAK_DTYPE.names
+
+_NUM = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_ROW = re.compile(r"^\s*[-+]?\d+" + (r"\s+" + _NUM) * 7 + r"(?:\s+\S+){3}\s*$")
+
+
+class CrysalisPeak:
+    """
+    Class holding information on individual crysalis points
+    """
+
+    def __init__(self, data):
+        super(CrysalisPeak, self).__init__()
+
+        # initialize points of the data
+        (self.index, self.h, self.k, self.l, self.detx, self.dety, self.dspacing, self.intensity,
+         self.indexing, self.group, self.profile) = data
+
+        (self.index, self.h, self.k, self.l, self.detx, self.dety, self.dspacing, self.intensity,
+         self.indexing, self.group, self.profile) = (
+            int(self.index), float(self.h), float(self.k), float(self.l),
+            int(self.detx), int(self.dety),
+            float(self.dspacing), float(self.intensity),
+            self.indexing, self.group, self.profile)
+
+    def _test_indexing(self, value, test):
+        res = False
+
+        for el in test:
+            if el in value.lower():
+                res = True
+                break
+        return res
+
+    def is_skipped(self):
+        return self._test_indexing(self.indexing, 's')
+
+    def is_wrong(self):
+        return self._test_indexing(self.indexing, 'w')
+
+    def is_bad(self):
+        return self._test_indexing(self.indexing, 'ws')
+
+
+def _load_rows(lines):
+    """
+    Converts rows of the table into a structured array in bulk
+    :param lines: list of strings
+    :return:
+    """
+    if len(lines) == 0:
+        return np.zeros(0, dtype=PEAK_DTYPE)
+    return np.atleast_1d(np.loadtxt(lines, dtype=PEAK_DTYPE, comments=None, ndmin=1))
+
+
+def parse_peak_table(text):
+    """
+    Parses the text of the Crysalis peak table into a structured array.
+    The whole table is converted at once; only if this fails the lines are validated individually
+    and the malformed ones are reported
+    :param text: table text as copied from Crysalis
+    :return: (table, malformed) - structured array of PEAK_DTYPE and a list of (line number, line) tuples
+    """
+    lines = text.splitlines()
+
+    try:
+        return _load_rows(lines), []
+    except ValueError:
+        pass
+
+    good, malformed = [], []
+    for i, line in enumerate(lines):
+        if _ROW.match(line):
+            good.append(line)
+        elif len(line.strip()) > 0:
+            malformed.append((i + 1, line))
+
+    return _load_rows(good), malformed
+
+
+class PeakTable:
+    """
+    Immutable columnar table of Crysalis peaks backed by a structured array of PEAK_DTYPE
+    """
+
+    __slots__ = ("data", "_labels")
+
+    def __init__(self, data=None):
+        if data is None:
+            data = np.zeros(0, dtype=PEAK_DTYPE)
+
+        data = np.asarray(data)
+        if data.dtype != PEAK_DTYPE:
+            data = data.astype(PEAK_DTYPE)
+
+        # a read-only view, the array of the caller stays writeable
+        data = data.view()
+        data.flags.writeable = False
+
+        self.data = data
+        self._labels = None
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Parses the text of the Crysalis peak table
+        :param text:
+        :return: (PeakTable, malformed lines)
+        """
+        data, malformed = parse_peak_table(text)
+        return cls(data), malformed
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        """
+        Returns a column for a field name or a new table for a mask or index array
+        :param item:
+        :return:
+        """
+        if isinstance(item, str):
+            return self.data[item]
+        return PeakTable(self.data[item])
+
+    def snapshot(self):
+        """
+        Tables are immutable - a snapshot is the table itself
+        :return:
+        """
+        return self
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def intensity_range(self):
+        """
+        Returns minimum and maximum of the intensity
+        :return:
+        """
+        if len(self) == 0:
+            return 0., 0.
+        intensity = self.data["intensity"]
+        return float(intensity.min()), float(intensity.max())
+
+    def _indexing_mask(self, flags):
+        """
+        Mask of peaks having any of the flags in the indexing column
+        :param flags:
+        :return:
+        """
+        indexing = np.char.lower(self.data["indexing"])
+        res = np.zeros(len(self), dtype=bool)
+        for el in flags:
+            res |= np.char.find(indexing, el) >= 0
+        return res
+
+    def skipped_mask(self):
+        return self._indexing_mask("s")
+
+    def wrong_mask(self):
+        return self._indexing_mask("w")
+
+    def bad_mask(self):
+        return self._indexing_mask("ws")
+
+    def intensity_mask(self, threshold):
+        """
+        Mask of peaks with intensity above the threshold
+        :param threshold:
+        :return:
+        """
+        if threshold is None:
+            return np.ones(len(self), dtype=bool)
+        return self.data["intensity"] > threshold
+
+    def groups(self):
+        """
+        Returns names of the twin or domain groups present in the table (g1, g2, ...)
+        :return: sorted list of strings
+        """
+        return [el for el in np.unique(self.data["group"]).tolist() if len(el) > 0]
+
+    def summary(self):
+        """
+        Summary statistics of the table - count, intensity distribution and ranges of the hkl indices
+        :return: dictionary
+        """
+        res = dict(count=len(self))
+        if len(self) == 0:
+            return res
+
+        intensity = self.data["intensity"]
+        q25, q50, q75 = np.percentile(intensity, (25, 50, 75)).tolist()
+        res.update(intensity_min=float(intensity.min()), intensity_max=float(intensity.max()),
+                   intensity_mean=float(intensity.mean()), intensity_q25=q25, intensity_median=q50, intensity_q75=q75)
+        for el in ("h", "k", "l"):
+            res[el] = (int(self.data[el].min()), int(self.data[el].max()))
+        return res
+
+    def labels(self):
+        """
+        Returns "(h, k, l)" captions of all peaks, formatted once per table
+        :return:
+        """
+        if self._labels is None:
+            hkl = np.stack([self.data[el].astype(np.int64) for el in ("h", "k", "l")])
+
+            # only distinct indices are converted to strings
+            values, inverse = np.unique(hkl, return_inverse=True)
+            h, k, l = np.array([str(el) for el in values.tolist()], dtype=str)[inverse.reshape(hkl.shape)]
+
+            res = np.char.add("(", h)
+            for el in (", ", k, ", ", l, ")"):
+                res = np.char.add(res, el)
+            self._labels = res
+        return self._labels
+
+    def columns(self, orientation=None, filter_captions=None):
+        """
+        Prepares columns for a ColumnDataSource
+        :param orientation: Orientation applied to the detector coordinates
+        :param filter_captions: captions of peaks with intensity not exceeding the value are empty
+        :return: dictionary of arrays
+        """
+        xs, ys = self.data["detx"], self.data["dety"]
+        if orientation is not None:
+            xs, ys = orientation.apply_points(xs, ys)
+
+        # names as a list - patching a fixed width string array could truncate captions
+        names = np.where(self.intensity_mask(filter_captions), self.labels(), "").tolist()
+        return dict(x=np.array(xs, dtype=np.float64), y=np.array(ys, dtype=np.float64), names=names,
+                    intensity=np.array(self.data["intensity"], dtype=np.float64), group=self.data["group"].tolist())
+
+    @staticmethod
+    def blank_columns(n):
+        """
+        Columns of n hidden rows, see columns()
+        :param n:
+        :return:
+        """
+        return dict(x=np.full(n, np.nan), y=np.full(n, np.nan), names=[""] * n, intensity=np.full(n, np.nan),
+                    group=[""] * n)
+
+    def diff(self, previous):
+        """
+        Compares the table with a previous one using the peak index column as a key
+        :param previous: PeakTable
+        :return: PeakDiff or None if the index column is not unique
+        """
+        new, old = self.data, previous.data
+        new_keys, old_keys = new["index"], old["index"]
+
+        if len(np.unique(new_keys)) != len(new_keys) or len(np.unique(old_keys)) != len(old_keys):
+            return None
+
+        common, inew, iold = np.intersect1d(new_keys, old_keys, assume_unique=True, return_indices=True)
+
+        added = np.ones(len(new), dtype=bool)
+        added[inew] = False
+        removed = np.ones(len(old), dtype=bool)
+        removed[iold] = False
+
+        changed = inew[new[inew] != old[iold]]
+
+        return PeakDiff(previous, self, self[added], old_keys[removed], self[changed])
+
+
+class PeakDiff:
+    """
+    Difference between two peak tables keyed on the peak index
+    """
+
+    __slots__ = ("base", "target", "added", "removed", "changed")
+
+    def __init__(self, base, target, added, removed, changed):
+        # tables the difference was computed for
+        self.base = base
+        self.target = target
+
+        self.added = added          # PeakTable of new rows
+        self.removed = removed      # array of indices of removed rows
+        self.changed = changed      # PeakTable of modified rows, new values
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    @property
+    def is_empty(self):
+        return len(self) == 0
+
+    def __repr__(self):
+        return f"PeakDiff(added={len(self.added)}, removed={len(self.removed)}, changed={len(self.changed)})"
@@ -0,0 +1,174 @@
+import os
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+from app.core.images import LoadedImage
+from app.core.offload import START_METHOD
+from app.core.timing import timer
+
+__all__ = ["ProjectionEngine", "reduce_frames", "OPERATORS"]
+
+OPERATORS = ("sum", "max", "mean")
+
+
+def reduce_frames(frames, operator="sum"):
+    """
+    Reduces frames one by one, only the accumulator and the current frame are kept in memory
+    :param frames: iterable of arrays
+    :param operator: "sum", "max" or "mean"
+    :return: (accumulator, number of frames) - sums for "sum" and "mean", maxima for "max"
+    """
+    acc, count = None, 0
+    for data in frames:
+        if operator == "max":
+            if acc is None:
+                acc = np.array(data, copy=True)
+            else:
+                np.maximum(acc, data, out=acc)
+        else:
+            if acc is None:
+                acc = np.zeros(data.shape, dtype=np.float64)
+            acc += data
+        count += 1
+    return acc, count
+
+
+def _merge(a, b, operator):
+    """
+    Combines two partial reductions
+    :return:
+    """
+    if a[0] is None:
+        return b
+    if b[0] is None:
+        return a
+
+    if operator == "max":
+        np.maximum(a[0], b[0], out=a[0])
+    else:
+        np.add(a[0], b[0], out=a[0])
+    return a[0], a[1] + b[1]
+
+
+def _read_frames(paths, start, stop):
+    """
+    Yields frames of a file range, runs in worker processes which open the files on their own
+    :param paths: multi-frame filename or a list of single frame files
+    :return:
+    """
+    import fabio
+
+    if isinstance(paths, (list, tuple)):
+        for fn in paths[start:stop]:
+            with fabio.open(fn) as fh:
+                yield np.asarray(fh.data)
+    else:
+        with fabio.open(paths) as fh:
+            for index in range(start, stop):
+                frame = fh if index == 0 else fh.getframe(index)
+                yield np.asarray(frame.data)
+
+
+def _reduce_range(paths, start, stop, operator):
+    return reduce_frames(_read_frames(paths, start, stop), operator)
+
+
+class ProjectionEngine:
+    """
+    Reduces a range of frames into one image, e.g. an oscillation image covering a wider slice of the reciprocal space.
+    Frames on the disk are split into chunks reduced by a process pool, results are cached by (files, range, operator)
+    """
+
+    MAX_ENTRIES = 4         # cached projections
+    MIN_PARALLEL = 8        # shorter ranges are reduced in the calling process
+    CHUNKS_PER_WORKER = 2   # chunks per process, evens out differences of reading speed
+
+    def __init__(self, workers=None, max_entries=None):
+        super(ProjectionEngine, self).__init__()
+
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.max_entries = self.MAX_ENTRIES if max_entries is None else int(max_entries)
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._pool = None
+
+    def project(self, stack, start=0, stop=None, operator="sum"):
+        """
+        Returns the projection of frames [start, stop) of a stack
+        :param stack: FrameStack
+        :param start:
+        :param stop: end of the range, exclusive, None - last frame
+        :param operator: "sum", "max" or "mean"
+        :return: LoadedImage
+        """
+        operator = str(operator).lower()
+        if operator not in OPERATORS:
+            raise ValueError(f"operator must be one of {OPERATORS}")
+
+        stop = len(stack) if stop is None else min(int(stop), len(stack))
+        start = max(0, int(start))
+        if stop <= start:
+            raise ValueError(f"empty frame range {start}..{stop}")
+
+        key = (stack.key, start, stop, operator)
+        with self._lock:
+            res = self._cache.get(key)
+            if res is not None:
+                self._cache.move_to_end(key)
+                return res
+
+        with timer("projection", frames=stop - start, operator=operator) as t:
+            paths = stack.paths
+            if paths is None or self.workers < 2 or stop - start < self.MIN_PARALLEL:
+                acc, count = reduce_frames(stack.iter_frames(start, stop), operator)
+            else:
+                acc, count = self._reduce_parallel(paths, start, stop, operator)
+
+            if operator == "mean":
+                acc /= count
+
+        res = LoadedImage(acc, filename=f"{stack.filename} [{operator} {start}..{stop - 1}]", decoder="projection",
+                          timings={"projection": t.seconds})
+
+        with self._lock:
+            self._cache[key] = res
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return res
+
+    def _reduce_parallel(self, paths, start, stop, operator):
+        """
+        Splits the range into chunks reduced by worker processes, partial results are merged as they arrive
+        :return: (accumulator, number of frames)
+        """
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context(START_METHOD))
+
+        nchunks = min(stop - start, self.workers * self.CHUNKS_PER_WORKER)
+        bounds = np.linspace(start, stop, nchunks + 1).astype(int).tolist()
+
+        futures = [self._pool.submit(_reduce_range, paths, a, b, operator) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        res = (None, 0)
+        for future in as_completed(futures):
+            res = _merge(res, future.result(), operator)
+        return res
+
+    def close(self):
+        """
+        Stops worker processes and drops cached projections
+        :return:
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        with self._lock:
+            self._cache.clear()
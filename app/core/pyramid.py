@@ -0,0 +1,161 @@
+import math
+
+import numpy as np
+
+__all__ = ["ImagePyramid"]
+
+
+class ImagePyramid:
+    """
+    Multi-resolution representation of an image.
+    Every level is downsampled by 2 using max-pooling, so that isolated Bragg peaks survive downsampling
+    """
+
+    MIN_SIZE = 256      # the coarsest level does not exceed this size
+    MARGIN = 0.5        # fraction of the viewport added on each side of a tile
+
+    def __init__(self, data, min_size=None, levels=None):
+        """
+        :param data: image of the finest level
+        :param min_size:
+        :param levels: coarser levels computed elsewhere, e.g. by a worker process, None - computed here
+        """
+        super(ImagePyramid, self).__init__()
+
+        self.min_size = self.MIN_SIZE if min_size is None else int(min_size)
+        self.key = self.key_of(data)
+
+        self.levels = [data]
+        if levels is not None:
+            self.levels.extend(levels)
+        else:
+            while max(self.levels[-1].shape) > self.min_size:
+                self.levels.append(self._downsample(self.levels[-1]))
+
+    @staticmethod
+    def key_of(data):
+        """
+        Cheap identity of the pixels of an array - views of the same unmodified buffer
+        with the same layout share the key
+        :param data:
+        :return:
+        """
+        base = data
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+        return id(base), data.__array_interface__['data'][0], data.shape, data.strides, data.dtype.str
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    @property
+    def nbytes(self):
+        return sum([el.nbytes for el in self.levels])
+
+    @classmethod
+    def level_shapes(cls, shape, min_size=None):
+        """
+        Shapes of the coarser levels of an image, allows to allocate them in advance
+        :param shape:
+        :param min_size:
+        :return: list of (ny, nx)
+        """
+        min_size = cls.MIN_SIZE if min_size is None else int(min_size)
+
+        res = []
+        ny, nx = shape
+        while max(ny, nx) > min_size:
+            ny, nx = (ny + 1) // 2, (nx + 1) // 2
+            res.append((ny, nx))
+        return res
+
+    @staticmethod
+    def _downsample(data):
+        """
+        Reduces the image by 2 in both directions using max pooling, odd sizes are padded by the edge values
+        :param data:
+        :return:
+        """
+        ny, nx = data.shape
+        py, px = ny % 2, nx % 2
+        if py or px:
+            data = np.pad(data, ((0, py), (0, px)), mode="edge")
+            ny, nx = data.shape
+        return data.reshape(ny // 2, 2, nx // 2, 2).max(axis=(1, 3))
+
+    def select_level(self, width, height, screen_width, screen_height):
+        """
+        Selects the coarsest level still providing at least one data pixel per screen pixel
+        :param width: viewport width in native pixels
+        :param height: viewport height in native pixels
+        :param screen_width: viewport width in screen pixels
+        :param screen_height: viewport height in screen pixels
+        :return:
+        """
+        factor = max(width / max(1, screen_width), height / max(1, screen_height))
+        if factor < 2.:
+            return 0
+        return min(len(self.levels) - 1, int(math.floor(math.log2(factor))))
+
+    def tile(self, x0, x1, y0, y1, screen_width, screen_height, margin=None):
+        """
+        Returns a part of a pyramid level covering the viewport, coordinates are given in native pixels
+        :param x0:
+        :param x1:
+        :param y0:
+        :param y1:
+        :param screen_width:
+        :param screen_height:
+        :param margin: fraction of the viewport added on each side
+        :return: (level, data, x, y, dw, dh)
+        """
+        margin = self.MARGIN if margin is None else margin
+
+        ny, nx = self.shape
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+
+        level = self.select_level(x1 - x0, y1 - y0, screen_width, screen_height)
+        scale = 2 ** level
+        ldata = self.levels[level]
+
+        mx, my = (x1 - x0) * margin, (y1 - y0) * margin
+        c0 = int(max(0, math.floor((x0 - mx) / scale)))
+        c1 = int(min(ldata.shape[1], math.ceil((x1 + mx) / scale)))
+        r0 = int(max(0, math.floor((y0 - my) / scale)))
+        r1 = int(min(ldata.shape[0], math.ceil((y1 + my) / scale)))
+
+        # viewport outside of the image - show the whole coarsest level
+        if c1 <= c0 or r1 <= r0:
+            level = len(self.levels) - 1
+            scale = 2 ** level
+            ldata = self.levels[level]
+            c0, r0 = 0, 0
+            r1, c1 = ldata.shape
+
+        data = np.ascontiguousarray(ldata[r0:r1, c0:c1])
+        return level, data, c0 * scale, r0 * scale, (c1 - c0) * scale, (r1 - r0) * scale
+
+    def covers(self, tile, x0, x1, y0, y1, screen_width, screen_height):
+        """
+        Tests if a tile previously returned by tile() is still suitable for the viewport
+        :param tile: (level, x, y, dw, dh)
+        :return:
+        """
+        level, x, y, dw, dh = tile
+        ny, nx = self.shape
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+
+        # nothing of the image is visible
+        if x1 <= 0 or y1 <= 0 or x0 >= nx or y0 >= ny:
+            return True
+
+        # the level depends on the whole viewport as in tile(), only its part inside of the image needs data
+        if level != self.select_level(x1 - x0, y1 - y0, screen_width, screen_height):
+            return False
+
+        x0, x1 = max(0, x0), min(nx, x1)
+        y0, y1 = max(0, y0), min(ny, y1)
+        return x <= x0 and y <= y0 and x + dw >= x1 and y + dh >= y1
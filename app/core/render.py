@@ -0,0 +1,314 @@
+import io
+import re
+import base64
+from functools import lru_cache
+from html import escape
+
+import numpy as np
+
+from app.core.orientation import Orientation
+from app.core.peaks import PeakTable
+from app.core.declutter import LabelDeclutter, font_size_px
+
+__all__ = ["RenderStyle", "prep_palette", "render_png", "render_svg", "render_overlay"]
+
+PNG_COMPRESSION = 1     # zlib level - detector noise hardly compresses, higher levels mostly cost time
+
+
+def prep_palette(pname, binverse=False):
+    """
+    Prepares a palette based on a name
+    :param pname:
+    :return:
+    """
+    # imported on first use - the rest of the module does not need bokeh
+    import bokeh.palettes as palettes
+
+    res = palettes.grey(256)
+
+    if pname == 'Greys256':
+        res = palettes.grey(256)
+    elif pname == 'Inferno256':
+        res = palettes.inferno(256)
+    elif pname == 'Magma256':
+        res = palettes.magma(256)
+    elif pname == 'Plasma256':
+        res = palettes.plasma(256)
+    elif pname == 'Viridis256':
+        res = palettes.viridis(256)
+    elif pname == 'Cividis256':
+        res = palettes.cividis(256)
+    elif pname == 'Turbo256':
+        res = palettes.turbo(256)
+    elif pname == 'Bokeh8':
+        res = palettes.small_palettes['Bokeh'][8]
+    elif pname == 'Spectral11':
+        res = palettes.small_palettes['Spectral'][11]
+    elif pname == 'RdGy11':
+        res = palettes.small_palettes['RdGy'][11]
+    elif pname == 'PiYG11':
+        res = palettes.small_palettes['PiYG'][11]
+
+    if binverse:
+        res = res[::-1]
+    return res
+
+
+class RenderStyle:
+    """
+    Presentation of an image with peaks outside of the notebook.
+    Accepts the same keys as Starter, e.g. RenderStyle(def_palette="Inferno256", sym_size=8, img_rotation="90")
+    """
+
+    DEF_PALETTE = 'Greys256'
+    INVERT_PALETTE = True
+
+    # styles for captions and symbols
+    CAP_XOFFSET = 5
+    CAP_YOFFSET = 5
+    CAP_FONTSIZE = "1em"
+    CAP_FONT = "Arial"
+    CAP_COLOR = "rgba(255,255,255,1)"
+    CAP_BKGCOLOR = "rgba(0,0,0,0.1)"
+    CAP_VISIBLE = True
+    SYM_TYPE = "circle"
+    SYM_SIZE = 10
+    SYM_LINECOLOR = "rgba(255,255,255,0.9)"
+    SYM_LINESIZE = 2
+    SYM_BKGCOLOR = "rgba(255,255,255,0)"
+    SYM_VISIBLE = True
+
+    IMG_ROTATION = "0"
+    IMG_FLIP = "None"
+
+    # intensity range of the color map, None - autoscale from the image mean as the Autoscale button does
+    INTENSITY_MIN = None
+    INTENSITY_MAX = None
+
+    # captions of peaks with intensity not exceeding the value are hidden
+    FILTER_CAPTIONS = 0.
+
+    def __init__(self, *args, **kwargs):
+        super(RenderStyle, self).__init__()
+        self._prep_parameters(*args, **kwargs)
+
+    def _prep_parameters(self, *args, **kwargs):
+        """
+        Prepares parameters passed as values, unknown keys are ignored
+        :return:
+        """
+        for k, v in kwargs.items():
+            if hasattr(self, k.upper()):
+                setattr(self, k.upper(), v)
+
+    def orientation(self, shape):
+        return Orientation(shape, int(self.IMG_ROTATION), self.IMG_FLIP)
+
+    def intensity_range(self, data):
+        """
+        Returns the range of the color map for the image
+        :param data:
+        :return:
+        """
+        mi, ma = self.INTENSITY_MIN, self.INTENSITY_MAX
+        if mi is None or ma is None:
+            # NaN pixels of float frames and masked projections are left out
+            mean = float(np.nanmean(data, dtype=np.float64)) if np.issubdtype(data.dtype, np.floating) \
+                else float(np.mean(data, dtype=np.float64))
+            mean = mean if np.isfinite(mean) else 0.
+            mi = 0. if mi is None else mi
+            ma = 3. * mean if ma is None else ma
+        return float(mi), float(ma)
+
+
+def parse_color(value):
+    """
+    Converts a css color into an RGBA tuple, also accepts rgba() with a fractional alpha channel
+    :param value:
+    :return:
+    """
+    from PIL import ImageColor
+
+    m = re.match(r"^\s*rgba\(\s*([\d.]+)\s*,\s*([\d.]+)\s*,\s*([\d.]+)\s*,\s*([\d.]+)\s*\)\s*$", str(value))
+    if m is not None:
+        r, g, b, a = [float(el) for el in m.groups()]
+        return int(r), int(g), int(b), int(round(min(a, 1.) * 255))
+
+    res = ImageColor.getrgb(str(value))
+    if len(res) == 3:
+        res = (*res, 255)
+    return res
+
+
+@lru_cache(maxsize=16)
+def _load_font(name, size):
+    """
+    Loads a truetype font by its family name, the Pillow default font is used if it is not found
+    :param name:
+    :param size:
+    :return:
+    """
+    from PIL import ImageFont
+
+    for el in (name, f"{name}.ttf", f"{name.lower().replace(' ', '')}.ttf", f"{name.replace(' ', '')}.ttf"):
+        try:
+            return ImageFont.truetype(el, size)
+        except (IOError, OSError):
+            pass
+    return ImageFont.load_default(size)
+
+
+def render_overlay(data, table, style):
+    """
+    Prepares everything shown on the figure in output pixel coordinates (origin at the top left corner)
+    :param data: image
+    :param table: PeakTable or None
+    :param style: RenderStyle
+    :return: (rgb image, dictionary of symbol and caption data)
+    """
+    orientation = style.orientation(data.shape)
+    image = orientation.apply_image(data)
+    ny, nx = image.shape
+
+    # color mapping as done by LinearColorMapper - values outside of the range take the edge colors
+    lut = np.array([parse_color(el)[:3] for el in prep_palette(style.DEF_PALETTE, style.INVERT_PALETTE)],
+                   dtype=np.uint8)
+    mi, ma = style.intensity_range(data)
+    mi = mi if np.isfinite(mi) else 0.
+    scale = len(lut) / (ma - mi) if np.isfinite(ma) and ma > mi else 0.
+
+    # NaN pixels take the low edge color, infinite ones the edge colors, the index is clipped before the cast
+    index = np.nan_to_num((image.astype(np.float32) - mi) * scale, nan=0., posinf=len(lut) - 1, neginf=0.)
+    index = np.clip(index, 0, len(lut) - 1).astype(np.intp)
+
+    # bokeh draws the first row at the bottom
+    rgb = lut[index[::-1]]
+
+    if table is None:
+        table = PeakTable()
+    columns = table.columns(orientation, style.FILTER_CAPTIONS)
+    xs, ys = columns["x"], ny - columns["y"]
+
+    # captions are decluttered for the whole image shown at its native resolution
+    font_size = font_size_px(style.CAP_FONTSIZE)
+    rows = np.zeros(0, dtype=np.intp)
+    if style.CAP_VISIBLE and len(table) > 0:
+        declutter = LabelDeclutter(columns["x"], columns["y"], columns["intensity"], columns["names"])
+        rows = declutter.select(0, nx, 0, ny, nx, ny, font_size=font_size,
+                                xoffset=style.CAP_XOFFSET, yoffset=style.CAP_YOFFSET)
+
+    overlay = dict(x=xs, y=ys, labels=[(float(xs[i]) + style.CAP_XOFFSET, float(ys[i]) - style.CAP_YOFFSET,
+                                        columns["names"][i]) for i in rows.tolist()],
+                   font_size=font_size)
+    return rgb, overlay
+
+
+def _symbol_path(kind, x, y, r):
+    """
+    Vertices of a symbol, a list of closed polygons or line segments
+    :return: (polygon or None, segments)
+    """
+    if kind == "square":
+        return [(x - r, y - r), (x + r, y - r), (x + r, y + r), (x - r, y + r)], []
+    if kind == "triangle":
+        return [(x, y - r), (x + r * 0.866, y + r * 0.5), (x - r * 0.866, y + r * 0.5)], []
+    if kind == "cross":
+        return None, [((x - r, y), (x + r, y)), ((x, y - r), (x, y + r))]
+    return None, []
+
+
+def render_png(data, table, style, fmt="PNG"):
+    """
+    Renders the image with peak symbols and captions with Pillow
+    :param data: image
+    :param table: PeakTable or None
+    :param style: RenderStyle
+    :param fmt: Pillow output format
+    :return: encoded image
+    """
+    from PIL import Image, ImageDraw
+
+    rgb, overlay = render_overlay(data, table, style)
+
+    img = Image.fromarray(rgb, mode="RGB").convert("RGBA")
+    layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+
+    if style.SYM_VISIBLE:
+        r = float(style.SYM_SIZE) / 2
+        fill, line, width = parse_color(style.SYM_BKGCOLOR), parse_color(style.SYM_LINECOLOR), int(style.SYM_LINESIZE)
+        kind = str(style.SYM_TYPE).lower()
+
+        for x, y in zip(overlay["x"].tolist(), overlay["y"].tolist()):
+            if not (np.isfinite(x) and np.isfinite(y)):
+                continue
+            polygon, segments = _symbol_path(kind, x, y, r)
+            if polygon is not None:
+                draw.polygon(polygon, fill=fill, outline=line, width=width)
+            elif len(segments) > 0:
+                for el in segments:
+                    draw.line(el, fill=line, width=width)
+            else:
+                draw.ellipse((x - r, y - r, x + r, y + r), fill=fill, outline=line, width=width)
+
+    if len(overlay["labels"]) > 0:
+        font = _load_font(str(style.CAP_FONT), int(round(overlay["font_size"])))
+        color, bkgcolor = parse_color(style.CAP_COLOR), parse_color(style.CAP_BKGCOLOR)
+        for x, y, text in overlay["labels"]:
+            draw.rectangle(draw.textbbox((x, y), text, font=font, anchor="ld"), fill=bkgcolor)
+            draw.text((x, y), text, font=font, fill=color, anchor="ld")
+
+    res = io.BytesIO()
+    options = dict(compress_level=PNG_COMPRESSION) if fmt.upper() == "PNG" else {}
+    Image.alpha_composite(img, layer).convert("RGB").save(res, format=fmt, **options)
+    return res.getvalue()
+
+
+def render_svg(data, table, style):
+    """
+    Renders the image as an embedded PNG with vector symbols and captions
+    :param data: image
+    :param table: PeakTable or None
+    :param style: RenderStyle
+    :return: svg document
+    """
+    from PIL import Image
+
+    rgb, overlay = render_overlay(data, table, style)
+    ny, nx = rgb.shape[:2]
+
+    buf = io.BytesIO()
+    Image.fromarray(rgb, mode="RGB").save(buf, format="PNG", compress_level=PNG_COMPRESSION)
+    href = base64.b64encode(buf.getvalue()).decode("ascii")
+
+    res = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{nx}" height="{ny}" viewBox="0 0 {nx} {ny}">',
+           f'<image width="{nx}" height="{ny}" href="data:image/png;base64,{href}"/>']
+
+    if style.SYM_VISIBLE:
+        r = float(style.SYM_SIZE) / 2
+        kind = str(style.SYM_TYPE).lower()
+        res.append(f'<g fill="{escape(str(style.SYM_BKGCOLOR))}" stroke="{escape(str(style.SYM_LINECOLOR))}" '
+                   f'stroke-width="{style.SYM_LINESIZE}">')
+        for x, y in zip(overlay["x"].tolist(), overlay["y"].tolist()):
+            if not (np.isfinite(x) and np.isfinite(y)):
+                continue
+            polygon, segments = _symbol_path(kind, x, y, r)
+            if polygon is not None:
+                points = " ".join([f"{px:.2f},{py:.2f}" for px, py in polygon])
+                res.append(f'<polygon points="{points}"/>')
+            elif len(segments) > 0:
+                path = " ".join([f"M{a[0]:.2f},{a[1]:.2f} L{b[0]:.2f},{b[1]:.2f}" for a, b in segments])
+                res.append(f'<path d="{path}"/>')
+            else:
+                res.append(f'<circle cx="{x:.2f}" cy="{y:.2f}" r="{r:.2f}"/>')
+        res.append('</g>')
+
+    if len(overlay["labels"]) > 0:
+        res.append(f'<g font-family="{escape(str(style.CAP_FONT))}" font-size="{overlay["font_size"]:.1f}px" '
+                   f'fill="{escape(str(style.CAP_COLOR))}">')
+        for x, y, text in overlay["labels"]:
+            res.append(f'<text x="{x:.2f}" y="{y:.2f}">{escape(text)}</text>')
+        res.append('</g>')
+
+    res.append('</svg>')
+    return "\n".join(res)
@@ -0,0 +1,166 @@
+import math
+
+import numpy as np
+
+__all__ = ["PeakIndex", "points_in_polygon"]
+
+
+def points_in_polygon(x, y, px, py):
+    """
+    Tests points against a polygon (even-odd rule), one vectorized pass per polygon edge
+    :param x: point coordinates
+    :param y:
+    :param px: polygon vertices
+    :param py:
+    :return: boolean mask
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    px, py = np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64)
+
+    inside = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+    if len(px) < 3:
+        return inside
+
+    for xa, ya, xb, yb in zip(px, py, np.roll(px, 1), np.roll(py, 1)):
+        if ya == yb:
+            continue
+        cross = (ya > y) != (yb > y)
+        xcross = (xb - xa) * (y - ya) / (yb - ya) + xa
+        inside ^= cross & (x < xcross)
+    return inside
+
+
+class PeakIndex:
+    """
+    Uniform grid over point coordinates stored in a compressed (CSR like) layout.
+    Points of a grid row form one contiguous slice, so box queries cost one slice per row of cells
+    """
+
+    POINTS_PER_CELL = 4     # average occupation of a cell used to choose the cell size
+
+    def __init__(self, x, y, cell_size=None):
+        super(PeakIndex, self).__init__()
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.size = len(x)
+
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+
+        if len(valid) > 0:
+            self.x0, self.y0 = float(x[valid].min()), float(y[valid].min())
+            width = float(x[valid].max()) - self.x0
+            height = float(y[valid].max()) - self.y0
+        else:
+            self.x0, self.y0, width, height = 0., 0., 0., 0.
+
+        if cell_size is None:
+            area = max(width, 1.) * max(height, 1.)
+            cell_size = math.sqrt(area * self.POINTS_PER_CELL / max(1, len(valid)))
+        self.cell = max(float(cell_size), 1e-9)
+
+        self.ncx = int(width // self.cell) + 1
+        self.ncy = int(height // self.cell) + 1
+
+        cx, cy = self._cell_of(x[valid], y[valid])
+        cells = cy * self.ncx + cx
+
+        order = np.argsort(cells, kind="stable")
+        self.index = valid[order]
+        self.xs = x[self.index]
+        self.ys = y[self.index]
+        self.starts = np.searchsorted(cells[order], np.arange(self.ncx * self.ncy + 1))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _cell_of(self, x, y):
+        cx = np.clip(np.floor((np.asarray(x) - self.x0) / self.cell), 0, self.ncx - 1).astype(np.int64)
+        cy = np.clip(np.floor((np.asarray(y) - self.y0) / self.cell), 0, self.ncy - 1).astype(np.int64)
+        return cx, cy
+
+    def _candidates(self, x0, x1, y0, y1):
+        """
+        Positions (in the sorted order) of points in cells overlapping the box
+        :return:
+        """
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+
+        if len(self) == 0 or x1 < self.x0 or y1 < self.y0 or \
+                x0 > self.x0 + self.ncx * self.cell or y0 > self.y0 + self.ncy * self.cell:
+            return np.zeros(0, dtype=np.intp)
+
+        (cx0, cx1), (cy0, cy1) = self._cell_of((x0, x1), (y0, y1))
+        rows = np.arange(cy0, cy1 + 1) * self.ncx
+        starts, ends = self.starts[rows + cx0], self.starts[rows + cx1 + 1]
+
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts.tolist(), ends.tolist()) if e > s] or
+                              [np.zeros(0, dtype=np.intp)])
+
+    def box(self, x0, x1, y0, y1):
+        """
+        Indices of points inside the box
+        :return:
+        """
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+
+        pos = self._candidates(x0, x1, y0, y1)
+        xs, ys = self.xs[pos], self.ys[pos]
+        return self.index[pos[(xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)]]
+
+    def radius(self, x, y, r):
+        """
+        Indices of points within the distance r
+        :return:
+        """
+        pos = self._candidates(x - r, x + r, y - r, y + r)
+        d2 = (self.xs[pos] - x) ** 2 + (self.ys[pos] - y) ** 2
+        return self.index[pos[d2 <= r * r]]
+
+    def lasso(self, px, py):
+        """
+        Indices of points inside a polygon (even-odd rule)
+        :param px: polygon vertices
+        :param py:
+        :return:
+        """
+        px, py = np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64)
+        if len(px) < 3:
+            return np.zeros(0, dtype=np.intp)
+
+        pos = self._candidates(px.min(), px.max(), py.min(), py.max())
+        return self.index[pos[points_in_polygon(self.xs[pos], self.ys[pos], px, py)]]
+
+    def nearest(self, x, y, max_distance=None):
+        """
+        Index of the point closest to (x, y), searching rings of cells around the position
+        :param max_distance: points farther away are ignored
+        :return: index or -1
+        """
+        if len(self) == 0:
+            return -1
+
+        limit = math.inf if max_distance is None else float(max_distance)
+        # distance from the position to the grid, rings beyond it are searched as needed
+        dx = max(self.x0 - x, 0., x - (self.x0 + self.ncx * self.cell))
+        dy = max(self.y0 - y, 0., y - (self.y0 + self.ncy * self.cell))
+        rmax = max(self.ncx, self.ncy) + int(math.hypot(dx, dy) // self.cell) + 1
+
+        best, best_d = -1, limit
+        ring = 0
+        while ring <= rmax:
+            half = (ring + 0.5) * self.cell
+            pos = self._candidates(x - half, x + half, y - half, y + half)
+            if len(pos) > 0:
+                d = np.hypot(self.xs[pos] - x, self.ys[pos] - y)
+                i = int(np.argmin(d))
+                if d[i] <= best_d:
+                    best, best_d = int(self.index[pos[i]]), float(d[i])
+
+            # every point closer than the inner radius of the searched square was seen
+            if best >= 0 and best_d <= ring * self.cell or (ring * self.cell > limit):
+                break
+            ring = ring * 2 + 1 if best < 0 else ring + 1
+        return best
@@ -0,0 +1,356 @@
+import io
+import os
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from queue import Queue, Empty
+
+import numpy as np
+
+from app.core.images import LoadedImage
+from app.core.cache import content_key
+from app.core.timing import timer
+
+__all__ = ["FrameStack"]
+
+
+class FrameStack:
+    """
+    Lazy access to frames of a multi-frame file (esperanto, edf, tif stacks) or of a series of single frame files (cbf).
+    Only requested frames are decoded, recently used ones are kept in a bounded LRU cache
+    and the neighbours of the requested frame are read ahead in a background thread
+    """
+
+    CACHE_FRAMES = 8    # decoded frames kept in memory
+    PREFETCH = 2        # frames read ahead on both sides of the requested one
+
+    STOP_MSG = None
+
+    def __init__(self, source=None, filenames=None, filename=None, cache_frames=None, prefetch=None, tmp_file=None,
+                 content_key=None):
+        """
+        :param source: filename or a file object of a multi-frame file
+        :param filenames: list of single frame files, used instead of the source
+        :param filename: name shown for the stack
+        :param tmp_file: temporary file removed with the stack
+        :param content_key: hash of the file content for stacks opened from memory
+        """
+        super(FrameStack, self).__init__()
+
+        self.filename = filename
+        self.cache_frames = max(1, self.CACHE_FRAMES if cache_frames is None else int(cache_frames))
+        self.prefetch = max(0, self.PREFETCH if prefetch is None else int(prefetch))
+
+        self._tmp_file = tmp_file
+        self._content_key = content_key
+
+        # size of the file content read as a stream, the reader keeps it in memory for the lifetime of the stack
+        self._source_nbytes = 0
+
+        # how content in memory was opened - "stream" or "file" for the temporary file fallback,
+        # durations of the opening stages and the error of the stream reader which caused the fallback
+        self.decoder = None
+        self.timings = {}
+        self.fallback = None
+        self._filenames = None if filenames is None else list(filenames)
+
+        # file of a multi-frame stack if it is on the disk, other processes can read it on their own
+        self._path = source if isinstance(source, (str, os.PathLike)) else None
+
+        # fabio objects are not thread safe, reading is serialized
+        self._read_lock = threading.Lock()
+        self._header = None
+        if self._filenames is None:
+            import fabio
+
+            self._header = fabio.open(source)
+            self.nframes = max(1, int(getattr(self._header, "nframes", 1) or 1))
+        else:
+            self.nframes = len(self._filenames)
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self._requests = Queue()
+        self._th_prefetch = None
+        if self.nframes > 1 and self.prefetch > 0:
+            self._th_prefetch = threading.Thread(target=self._prefetch_loop, args=[])
+            self._th_prefetch.daemon = True
+            self._th_prefetch.start()
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """
+        Opens a multi-frame file, frames are read from the disk when requested
+        :param filename:
+        :return:
+        """
+        return cls(filename, filename=filename, **kwargs)
+
+    @classmethod
+    def from_series(cls, filenames, **kwargs):
+        """
+        Combines single frame files into a stack
+        :param filenames:
+        :return:
+        """
+        filenames = sorted(filenames)
+        return cls(filenames=filenames, filename=filenames[0] if len(filenames) > 0 else None, **kwargs)
+
+    @classmethod
+    def from_content(cls, content, filename=None, tmp_dir=None, **kwargs):
+        """
+        Opens a stack from the raw file content, e.g. an uploaded file.
+        The content is read as a stream, a temporary file is kept for the lifetime of the stack if fabio needs a real file
+        :param content:
+        :param filename: original filename, used for the extension of the temporary file
+        :param tmp_dir:
+        :return:
+        """
+        if kwargs.get("content_key") is None:
+            kwargs["content_key"] = content_key(content)
+
+        timings = {}
+
+        ts = time.perf_counter()
+        stream = io.BytesIO(content)
+        timings["buffer"] = time.perf_counter() - ts
+
+        stack = None
+        ts = time.perf_counter()
+        try:
+            # some readers open a stream but fail on reading the data, e.g. edf
+            stack = cls(stream, filename=filename, **kwargs)
+            stack._source_nbytes = len(content)
+            stack.get(0)
+            timings["open"] = time.perf_counter() - ts
+
+            stack.decoder, stack.timings = "stream", timings
+            return stack
+        except Exception as e:
+            timings["decode_failed"] = time.perf_counter() - ts
+            fallback = f"{type(e).__name__}: {e}"
+            if stack is not None:
+                stack.close()
+
+        ts = time.perf_counter()
+        suffix = "" if filename is None else os.path.splitext(filename)[1]
+        fd, tmp_file = tempfile.mkstemp(suffix=suffix, dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(content)
+            timings["write"] = time.perf_counter() - ts
+
+            ts = time.perf_counter()
+            stack = cls(tmp_file, filename=filename, tmp_file=tmp_file, **kwargs)
+            timings["open"] = time.perf_counter() - ts
+        except Exception:
+            cls._remove(tmp_file)
+            raise
+
+        stack.decoder, stack.timings, stack.fallback = "file", timings, fallback
+        return stack
+
+    def __len__(self):
+        return self.nframes
+
+    def format_timings(self):
+        """
+        Returns a short string with the way the content was opened and durations of the stages in ms
+        :return:
+        """
+        res = "; ".join([f"{k}: {v * 1e3:.1f} ms" for k, v in self.timings.items()])
+        return res if self.decoder is None else f"{self.decoder}; {res}"
+
+    @property
+    def paths(self):
+        """
+        Files holding the frames - a filename of a multi-frame file, a list for a series, None for in memory data
+        :return:
+        """
+        if self._filenames is not None:
+            return list(self._filenames)
+        return self._path
+
+    @property
+    def key(self):
+        """
+        Identity of the frames, changes when the files change
+        :return:
+        """
+        if self._content_key is not None:
+            return ("content", self._content_key)
+
+        paths = self.paths
+        if paths is None:
+            return ("memory", id(self))
+        return self.key_of(paths)
+
+    @staticmethod
+    def key_of(paths):
+        """
+        Identity of files on the disk - absolute paths, sizes and modification times
+        :param paths: filename or a list of filenames
+        :return:
+        """
+        res = []
+        for fn in ([paths] if not isinstance(paths, (list, tuple)) else sorted(paths)):
+            st = os.stat(fn)
+            res.append((os.path.abspath(fn), st.st_size, st.st_mtime_ns))
+        return tuple(res)
+
+    def iter_frames(self, start=0, stop=None):
+        """
+        Yields frame data of a range without putting them into the cache
+        :param start:
+        :param stop: end of the range, exclusive
+        :return:
+        """
+        stop = self.nframes if stop is None else min(int(stop), self.nframes)
+        for index in range(max(0, int(start)), stop):
+            res = self._cached(index, count=False)
+            if res is None:
+                with self._read_lock:
+                    res = self._read(index)
+            yield res.data
+
+    def get(self, index):
+        """
+        Returns a frame, neighbouring frames are read ahead
+        :param index:
+        :return: LoadedImage
+        """
+        index = int(index)
+        if not 0 <= index < self.nframes:
+            raise IndexError(f"frame {index} is out of range 0..{self.nframes - 1}")
+
+        res = self._cached(index)
+        if res is None:
+            with self._read_lock:
+                # the frame could have been prefetched while waiting
+                res = self._cached(index, count=False)
+                if res is None:
+                    res = self._read(index)
+                    self._store(index, res)
+
+        if self._th_prefetch is not None:
+            self._requests.put(index)
+        return res
+
+    def _cached(self, index, count=True):
+        with self._lock:
+            res = self._cache.get(index)
+            if res is not None:
+                self._cache.move_to_end(index)
+            if count:
+                if res is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return res
+
+    def _store(self, index, image):
+        with self._lock:
+            self._cache[index] = image
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_frames:
+                self._cache.popitem(last=False)
+
+    def _read(self, index):
+        """
+        Decodes a single frame, has to be called with the read lock
+        :param index:
+        :return: LoadedImage
+        """
+        with timer("decode", filename=self.filename, frame=index) as t:
+            if self._filenames is not None:
+                import fabio
+
+                fn = self._filenames[index]
+                with fabio.open(fn) as fh:
+                    data = np.asarray(fh.data)
+            else:
+                fn = self.filename
+                frame = self._header if index == 0 else self._header.getframe(index)
+                data = np.asarray(frame.data)
+
+        return LoadedImage(data, filename=fn, decoder="frame", timings={"decode": t.seconds})
+
+    def _prefetch_loop(self):
+        """
+        Reads neighbours of the latest requested frame, requests of frames scrolled past are dropped
+        :return:
+        """
+        while True:
+            index = self._requests.get()
+            # only the latest request matters
+            try:
+                while True:
+                    index = self._requests.get(block=False)
+            except Empty:
+                pass
+
+            if index is self.STOP_MSG:
+                break
+
+            # the cache has to hold the requested frame together with its neighbours
+            depth = min(self.prefetch, (self.cache_frames - 1) // 2)
+            for step in range(1, depth + 1):
+                for tindex in (index + step, index - step):
+                    if not 0 <= tindex < self.nframes or not self._requests.empty():
+                        continue
+
+                    with self._read_lock:
+                        if self._cached(tindex, count=False) is not None:
+                            continue
+                        try:
+                            self._store(tindex, self._read(tindex))
+                        except Exception:
+                            pass
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the stack - cached frames and the content of a stack read from memory
+        :return:
+        """
+        with self._lock:
+            images = list(self._cache.values())
+        return self._source_nbytes + sum([el.nbytes for el in images])
+
+    def close(self):
+        """
+        Stops the prefetch thread, releases cached frames and the temporary file
+        :return:
+        """
+        if self._th_prefetch is not None and self._th_prefetch.is_alive():
+            self._requests.put(self.STOP_MSG)
+            self._th_prefetch.join()
+        self._th_prefetch = None
+
+        with self._lock:
+            self._cache.clear()
+
+        with self._read_lock:
+            if self._header is not None:
+                try:
+                    self._header.close()
+                except Exception:
+                    pass
+                self._header = None
+            self._source_nbytes = 0
+
+        if self._tmp_file is not None:
+            self._remove(self._tmp_file)
+            self._tmp_file = None
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except (IOError, OSError):
+            pass
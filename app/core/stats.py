@@ -0,0 +1,158 @@
+import numpy as np
+
+__all__ = ["ImageStats"]
+
+
+class ImageStats:
+    """
+    Statistics of an image computed by streaming over row blocks.
+    The image is never copied as a whole, temporary arrays are limited to the size of a block.
+    Pixels of an optional mask (True - excluded) are skipped block by block as well
+    """
+
+    CHUNK_SIZE = 1 << 20    # number of elements processed at once
+    HISTOGRAM_BINS = 1024
+
+    def __init__(self, data, bins=None, chunk_size=None, mask=None):
+        super(ImageStats, self).__init__()
+
+        self.bins = self.HISTOGRAM_BINS if bins is None else int(bins)
+        self.chunk_size = self.CHUNK_SIZE if chunk_size is None else int(chunk_size)
+
+        self.shape = data.shape
+        self.dtype = data.dtype
+
+        self.size = 0       # number of finite values
+        self.min = 0.
+        self.max = 0.
+        self.mean = 0.
+
+        # sum of values not exceeding the mean divided by the total number of values
+        self.below_mean = 0.
+
+        self.histogram = np.zeros(self.bins, dtype=np.int64)
+        self.bin_edges = np.linspace(0., 1., self.bins + 1)
+
+        self._cumulative = None
+
+        self._compute(data, mask)
+
+    @staticmethod
+    def _as_2d(data):
+        data = np.asarray(data)
+        if data.ndim == 0:
+            return data.reshape(1, 1)
+        elif data.ndim == 1:
+            return data.reshape(1, -1)
+        elif data.ndim > 2:
+            return data.reshape(data.shape[0], -1)
+        return data
+
+    def _chunks(self, data, mask=None):
+        """
+        Yields views of row blocks of the image, NaN and inf values and masked pixels are removed
+        :param data:
+        :param mask: boolean array of the image shape, True - pixel is excluded
+        :return:
+        """
+        data = self._as_2d(data)
+        if mask is not None:
+            mask = self._as_2d(mask)
+
+        rows = max(1, self.chunk_size // max(1, data.shape[1]))
+        bfloat = np.issubdtype(data.dtype, np.floating)
+
+        for i in range(0, data.shape[0], rows):
+            chunk = data[i:i + rows]
+
+            valid = None
+            if mask is not None:
+                valid = ~mask[i:i + rows]
+            if bfloat:
+                finite = np.isfinite(chunk)
+                if not finite.all():
+                    valid = finite if valid is None else valid & finite
+
+            if valid is not None:
+                chunk = chunk[valid]
+            yield chunk
+
+    def _compute(self, data, mask=None):
+        """
+        Computes the statistics: extrema and sum during the first pass, histogram and
+        the below mean sum during the second one
+        :param data:
+        :return:
+        """
+        mi, ma = None, None
+        total, count = 0., 0
+
+        for chunk in self._chunks(data, mask):
+            if chunk.size == 0:
+                continue
+            tmi, tma = chunk.min(), chunk.max()
+            mi = tmi if mi is None else min(mi, tmi)
+            ma = tma if ma is None else max(ma, tma)
+            total += float(chunk.sum(dtype=np.float64))
+            count += chunk.size
+
+        if count == 0:
+            return
+
+        self.size = count
+        self.min, self.max = float(mi), float(ma)
+        self.mean = total / count
+
+        width = self.max - self.min
+        scale = self.bins / width if width > 0 else 0.
+        self.bin_edges = np.linspace(self.min, self.max if width > 0 else self.min + 1., self.bins + 1)
+
+        # float32 arithmetic is sufficient for bin indices unless the image is float64
+        ftype = np.float64 if self.dtype == np.float64 else np.float32
+        fmin, fscale = ftype(self.min), ftype(scale)
+
+        below = 0.
+        for chunk in self._chunks(data, mask):
+            if chunk.size == 0:
+                continue
+            flat = chunk.ravel()
+
+            # masked sum as a dot product - considerably faster than sum(where=...), accumulated in float64,
+            # float32 loses precision over millions of pixels with counts up to 2^20
+            values = flat.astype(np.float64, copy=False)
+            below += float(np.dot(values, (values <= self.mean).astype(np.float64)))
+
+            if flat.dtype != ftype:
+                flat = flat.astype(ftype)
+            idx = np.subtract(flat, fmin)
+            idx *= fscale
+            idx = idx.astype(np.intp)
+            np.minimum(idx, self.bins - 1, out=idx)
+            self.histogram += np.bincount(idx, minlength=self.bins)
+
+        self.below_mean = below / count
+
+    def percentile(self, q):
+        """
+        Estimates percentile(s) from the histogram using linear interpolation within bins
+        :param q: percentile or a sequence of percentiles in the range 0-100
+        :return:
+        """
+        if self._cumulative is None:
+            self._cumulative = np.concatenate(([0], np.cumsum(self.histogram)))
+
+        cum = self._cumulative
+        target = np.clip(np.asarray(q, dtype=np.float64), 0., 100.) / 100. * cum[-1]
+        res = np.interp(target, cum, self.bin_edges)
+
+        if res.ndim == 0:
+            return float(res)
+        return res
+
+    def as_dict(self):
+        """
+        Returns scalar statistics as a dictionary
+        :return:
+        """
+        return {"min": self.min, "max": self.max, "mean": self.mean, "below_mean": self.below_mean,
+                "size": self.size}
@@ -0,0 +1,209 @@
+import json
+import time
+import threading
+from collections import deque
+from functools import wraps
+
+import numpy as np
+
+__all__ = ["Timings", "TIMINGS", "timer", "timed"]
+
+
+class _Timer:
+    """
+    Context manager measuring one execution of a stage
+    """
+
+    __slots__ = ("owner", "stage", "info", "start", "seconds")
+
+    def __init__(self, owner, stage, info):
+        self.owner = owner
+        self.stage = stage
+        self.info = info
+        self.start = None
+        self.seconds = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.seconds = time.perf_counter() - self.start
+        if exc_type is None:
+            self.owner.record(self.stage, self.seconds, **self.info)
+        return False
+
+
+class Timings:
+    """
+    Durations of pipeline stages (decode, stats, transform, parse, serialize, push).
+    Recent events are kept in a ring buffer, every stage has counters and a histogram with bins growing by a factor of 2,
+    so that the memory does not grow with the session. Events can be appended to a json lines file
+    """
+
+    RING_SIZE = 1000        # recent events kept in memory
+    HIST_MIN = 1e-5         # upper edge of the first histogram bin in seconds
+    HIST_BINS = 24          # the last bin collects everything above ~80 s
+    LOG_FLUSH = 1.          # seconds between flushes of the log file
+
+    def __init__(self, ring_size=None, log_file=None):
+        super(Timings, self).__init__()
+
+        self._lock = threading.Lock()
+        self.events = deque(maxlen=self.RING_SIZE if ring_size is None else int(ring_size))
+        self.stages = {}
+
+        # incremented on every record, consumers refresh their views only when it changes
+        self.version = 0
+
+        self.edges = self.HIST_MIN * 2. ** np.arange(self.HIST_BINS)
+
+        self._log = None
+        self._log_flushed = 0.
+        if log_file is not None:
+            self.open_log(log_file)
+
+    def record(self, stage, seconds, **info):
+        """
+        Adds a measured duration
+        :param stage: name of the stage
+        :param seconds:
+        :param info: additional values written to the log file, e.g. image shape
+        :return:
+        """
+        ts = time.time()
+        ibin = min(int(np.searchsorted(self.edges, seconds)), self.HIST_BINS - 1)
+
+        with self._lock:
+            st = self.stages.get(stage)
+            if st is None:
+                st = self.stages[stage] = dict(count=0, total=0., min=seconds, max=seconds, last=seconds,
+                                               hist=[0] * self.HIST_BINS)
+            st["count"] += 1
+            st["total"] += seconds
+            st["min"] = min(st["min"], seconds)
+            st["max"] = max(st["max"], seconds)
+            st["last"] = seconds
+            st["hist"][ibin] += 1
+
+            self.events.append((ts, stage, seconds))
+            self.version += 1
+
+            if self._log is not None:
+                self._log.write(json.dumps(dict(time=ts, stage=stage, seconds=seconds, **info), default=str) + "\n")
+                if ts - self._log_flushed > self.LOG_FLUSH:
+                    self._log.flush()
+                    self._log_flushed = ts
+
+    def timer(self, stage, **info):
+        """
+        Context manager timing a block, the duration is available as the seconds attribute afterwards
+        :param stage:
+        :param info: additional values for the log file
+        :return:
+        """
+        return _Timer(self, stage, info)
+
+    def timed(self, stage):
+        """
+        Decorator timing every call of a function
+        :param stage:
+        :return:
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _percentile(self, hist, q):
+        """
+        Upper edge of the histogram bin holding the percentile
+        :return:
+        """
+        cum = np.cumsum(hist)
+        i = int(np.searchsorted(cum, q / 100. * cum[-1]))
+        return float(self.edges[min(i, len(self.edges) - 1)])
+
+    def summary(self):
+        """
+        Statistics of all stages
+        :return: {stage: {count, total, mean, min, max, last, p50, p95}}
+        """
+        with self._lock:
+            stages = {k: dict(v, hist=list(v["hist"])) for k, v in self.stages.items()}
+
+        res = {}
+        for k, v in stages.items():
+            hist = v.pop("hist")
+            v["mean"] = v["total"] / v["count"]
+            v["p50"], v["p95"] = self._percentile(hist, 50.), self._percentile(hist, 95.)
+            res[k] = v
+        return res
+
+    def recent(self, n=None):
+        """
+        Returns the latest events
+        :param n: number of events, None - all kept
+        :return: list of (time, stage, seconds)
+        """
+        with self._lock:
+            res = list(self.events)
+        return res if n is None else res[-n:]
+
+    def format_table(self):
+        """
+        Returns a compact text table of the stage statistics in ms
+        :return:
+        """
+        res = [f"{'stage':<12}{'count':>7}{'last':>9}{'mean':>9}{'p50<':>9}{'p95<':>9}{'max':>9}"]
+        for k, v in sorted(self.summary().items()):
+            res.append(f"{k:<12}{v['count']:>7}" + "".join([f"{v[el] * 1e3:>9.1f}"
+                                                             for el in ("last", "mean", "p50", "p95", "max")]))
+        return "\n".join(res)
+
+    def reset(self):
+        with self._lock:
+            self.events.clear()
+            self.stages.clear()
+            self.version += 1
+
+    def open_log(self, filename):
+        """
+        Appends following events to a json lines file
+        :param filename:
+        :return:
+        """
+        log = open(filename, "a", encoding="utf-8")
+        with self._lock:
+            old, self._log = self._log, log
+        if old is not None:
+            old.close()
+
+    def close_log(self):
+        with self._lock:
+            old, self._log = self._log, None
+        if old is not None:
+            old.close()
+
+
+# timings shared by the whole application
+TIMINGS = Timings()
+
+
+def timer(stage, **info):
+    """
+    Times a block with the shared timings, see Timings.timer()
+    :return:
+    """
+    return TIMINGS.timer(stage, **info)
+
+
+def timed(stage):
+    """
+    Times every call of a function with the shared timings, see Timings.timed()
+    :return:
+    """
+    return TIMINGS.timed(stage)
@@ -8,9 +8,7 @@ import logging
 
 import threading
 
-from IPython.display import display
-from ipywidgets import Button, Layout, HBox, VBox, FileUpload, Output, Label, GridBox, HTML, Dropdown, \
-    FloatRangeSlider, ToggleButtons, Checkbox, Accordion, Text, IntText, ToggleButtons,FloatSlider
+from importlib import import_module as _import_module
 
 """
 logging.basicConfig(level=logging.INFO,
@@ -18,12 +16,57 @@ logging.basicConfig(level=logging.INFO,
                         datefmt='%Y-%m-%d %H:%M:%S')
 """
 
-import asyncio
-import numpy as np
-
 from .keys import *
 
-from bokeh.io import output_notebook, show
-output_notebook()
+# heavy modules are imported on the first access of a name, importing app.imports.* submodules stays cheap:
+# name -> (module, attribute or None for the module itself)
+_LAZY = {
+    "asyncio": ("asyncio", None),
+    "np": ("numpy", None),
+    "fabio": ("fabio", None),
+    "display": ("IPython.display", "display"),
+    "output_notebook": ("bokeh.io", "output_notebook"),
+    "show": ("bokeh.io", "show"),
+}
+
+for _name in ("Button", "Layout", "HBox", "VBox", "FileUpload", "Output", "Label", "GridBox", "HTML", "Dropdown",
+              "FloatRangeSlider", "ToggleButtons", "Checkbox", "Accordion", "Text", "IntText", "FloatSlider",
+              "IntSlider", "IntRangeSlider", "FloatText", "SelectMultiple"):
+    _LAZY[_name] = ("ipywidgets", _name)
+
+
+def __getattr__(name):
+    try:
+        module, attr = _LAZY[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    res = _import_module(module)
+    if attr is not None:
+        res = getattr(res, attr)
+
+    globals()[name] = res
+    return res
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+
+_NOTEBOOK = False
+
+
+def init_notebook():
+    """
+    Loads BokehJS into the notebook, called once before the first figure is shown
+    :return:
+    """
+    global _NOTEBOOK
+
+    if not _NOTEBOOK:
+        _NOTEBOOK = True
+        __getattr__("output_notebook")()
+
 
-import fabio
\ No newline at end of file
+# lazy names are left out - a star import would load all of them at once, they are imported where they are used
+__all__ = [el for el in globals() if not el.startswith("_")]
@@ -1,11 +1,13 @@
 import time
-import re
 
 import threading
-import win32clipboard
 
 from queue import Queue, Empty
 
+from app.core.peaks import CrysalisPeak, PeakTable
+from app.core.timing import timed
+from app.imports.sources import make_source, fingerprint
+
 test = """
        1        3       -4        3   678  1347  1.32681      6927     i  g1       1 
        2        5       -1      -14   310   808  0.80747      1714     i  g1       1 
@@ -14,22 +16,29 @@ test = """
 
 class ClipboardWatchdog:
     """
-    Class watching content of a clipboard. Relies on win32clipboard, part of pywin32
+    Class watching content of a peak source. By default the windows clipboard is used (win32clipboard, part of pywin32),
+    other sources are files, a local socket or python code (see app.imports.sources)
     """
 
     DELAY = 1.  # delay between test cycles
+    MAX_DELAY = 5.  # longest delay between test cycles when nothing changes
+    BACKOFF = 1.5   # increase of the delay after an idle cycle
 
     STOP_MSG = "quit"
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, source=None):
         super(ClipboardWatchdog, self).__init__()
 
         # parent object
         self.parent = parent
 
+        # source of the data - "clipboard", "file:<path>", "socket:<port>", "memory" or a PeakSource
+        self.source = make_source(source)
+
         # data lock
         self.data_lock = threading.Lock()
         self.data = None
+        self.fingerprint = None
 
         # queue to stop clipboard if necessary
         self.qstop_thread = Queue()
@@ -55,7 +64,7 @@ class ClipboardWatchdog:
         """
         Starts polling of a thread checking the clipoard values
         """
-        self.debug("Starting clipboard polling")
+        self.debug(f"Starting polling of {self.source}")
 
         # stops last running thread if it was alive
         self.stop_polling()
@@ -71,7 +80,7 @@ class ClipboardWatchdog:
         """
         bnew = False
 
-        if self.data != data:
+        if self.test_new(data):
             self.data = data
             bnew = True
 
@@ -86,6 +95,19 @@ class ClipboardWatchdog:
             except AttributeError:
                 pass
 
+    def test_new(self, data):
+        """
+        Tests if the data differs from the last processed data by comparing size and content hash
+        :param data:
+        :return:
+        """
+        tfingerprint = fingerprint(data)
+        if tfingerprint == self.fingerprint:
+            return False
+
+        self.fingerprint = tfingerprint
+        return True
+
     def preprocess(self, data):
         """
         Dummy function to be adjusted fro different tasks
@@ -94,8 +116,16 @@ class ClipboardWatchdog:
 
     def _track_clipboard(self):
         """
-        Major thread watching clipboard content
+        Major thread watching the source content.
+        Polled sources are checked less often while nothing changes, event driven sources wake up on new data
         """
+        try:
+            self.source.start()
+        except Exception as e:
+            self.debug(f"Polling of {self.source} failed: {e}")
+            return
+
+        delay = self.DELAY
         while True:
             # performes a test on a thread quit event
             if self.test_quit():
@@ -103,29 +133,49 @@ class ClipboardWatchdog:
 
             ts = time.time()
 
-            data = ""
-
+            data = None
             try:
-                # make a snapshot only
-                win32clipboard.OpenClipboard()
-                data = win32clipboard.GetClipboardData()
-                win32clipboard.CloseClipboard()
-            except TypeError:
-                pass
+                # event driven sources wait at most one cycle, so that a quit event is noticed
+                data = self.source.read(timeout=self.DELAY)
+            except Exception as e:
+                self.debug(f"Reading of {self.source} failed: {e}")
 
+            bchanged = False
             if isinstance(data, str):
                 with self.data_lock:
+                    tfingerprint = self.fingerprint
                     self.process_data(data)
+                    bchanged = tfingerprint != self.fingerprint
 
-            # performes a test on a thread quit event
-            if self.test_quit():
-                break
+            # adaptive back off while the source is idle
+            if bchanged:
+                delay = self.DELAY
+            else:
+                delay = min(self.MAX_DELAY, delay * self.BACKOFF)
+
+            if not self.source.EVENT_DRIVEN:
+                # waiting for the next cycle or a quit event
+                dt = delay - (time.time() - ts)
+                if dt > 0 and self.wait_quit(dt):
+                    break
 
-            # make a fixed interval between tests
-            dt = self.DELAY - (time.time() - ts)
-            if dt > 0:
-                time.sleep(dt)
-        self.debug("Clipboard polling stopped")
+        self.source.stop()
+        self.debug("Polling stopped")
+
+    def wait_quit(self, timeout):
+        """
+        Waits for a thread quit event
+        :param timeout:
+        :return: True if the thread should quit
+        """
+        res = False
+        try:
+            self.qstop_thread.get(timeout=timeout)
+            self.qstop_thread.task_done()
+            res = True
+        except Empty:
+            pass
+        return res
 
     def test_quit(self):
         """
@@ -144,58 +194,27 @@ class ClipboardWatchdog:
         self.stop_polling()
 
 
-class CrysalisPeak:
-    """
-    Class holding information on individual crysalis points
-    """
-
-    def __init__(self, data):
-        super(CrysalisPeak, self).__init__()
-
-        # initialize points of the data
-        (self.index, self.h, self.k, self.l, self.detx, self.dety, self.dspacing, self.intensity,
-         self.indexing, self.group, self.profile) = data
-
-        (self.index, self.h, self.k, self.l, self.detx, self.dety, self.dspacing, self.intensity,
-         self.indexing, self.group, self.profile) = (
-            int(self.index), float(self.h), float(self.k), float(self.l),
-            int(self.detx), int(self.dety),
-            float(self.dspacing), float(self.intensity),
-            self.indexing, self.group, self.profile)
-
-    def _test_indexing(self, value, test):
-        res = False
-
-        for el in test:
-            if test in value.lower():
-                res = True
-                break
-
-    def is_skipped(self):
-        return self._test_indexing(self.indexing, 's')
-
-    def is_wrong(self):
-        return self._test_indexing(self.indexing, 'w')
-
-    def is_bad(self):
-        return self._test_indexing(self.indexing, 'ws')
-
-
 class CrysalisPeaksCW(ClipboardWatchdog):
     """
     Class watching for copied table of crysalis peaks e.g.:
     1        3       -4        3   678  1347  1.32681      6927     i  g1       1
 
     """
-    TEST_CRYSALIS_PEAKS = None
+
+    def __init__(self, parent=None, source=None):
+        super(CrysalisPeaksCW, self).__init__(parent=parent, source=source)
+
+        # last valid table of peaks
+        self.table = None
 
     def process_data(self, data):
         """
-        Processes data if necessary and updates the parent class if necessary
+        Processes data if necessary and updates the parent class if necessary.
+        The parent receives [table, min intensity, max intensity, difference to the previous table]
         """
         bnew = False
 
-        if self.data != data:
+        if self.test_new(data):
             self.data = data
             bnew = True
 
@@ -203,7 +222,18 @@ class CrysalisPeaksCW(ClipboardWatchdog):
             if data is None:
                 return
 
-            self.debug(f"New data length is {len(data[0])};")
+            table = data[0]
+            diff = None
+            if self.table is not None:
+                diff = table.diff(self.table)
+
+                # e.g. only the formatting of the text changed
+                if diff is not None and diff.is_empty:
+                    return
+            self.table = table
+
+            data.append(diff)
+            self.debug(f"New data length is {len(table)}; {diff if diff is not None else 'full update'}")
 
             if self.parent is not None:
                 try:
@@ -211,52 +241,26 @@ class CrysalisPeaksCW(ClipboardWatchdog):
                 except AttributeError:
                     pass
 
-    def test_crysalis_peaks(self, data):
-        """
-        Actual test if the information stored in a clipboard is valid
-        """
-        res = False
-
-        if self.TEST_CRYSALIS_PEAKS is None:
-            fmt = "^" + "\s+([^\s]+)" * 11 + "[\r\n\ \t]+$"
-            self.TEST_CRYSALIS_PEAKS = re.compile(fmt, re.I + re.MULTILINE)
-
-        p = self.TEST_CRYSALIS_PEAKS
-        m = p.match(data)
-        if m:
-            res = True
-        return res
-
+    @timed("parse")
     def preprocess(self, data):
         """
-        Performs a  test of data, retrieves information and returns it as a list of peak classes
+        Performs a  test of data, retrieves information and returns it as a table of peaks
         None is returned when data is considered to be invalid
         """
-        res = data
-        mi, ma = None, None     # min and max values
+        res = None
 
         try:
-            if not self.test_crysalis_peaks(data):
-                raise ValueError("data is not crysalis peak data")
-
-            res = []
-            p = self.TEST_CRYSALIS_PEAKS
-            m = p.findall(data)
+            table, malformed = PeakTable.from_text(data)
 
-            for el in m:
-                tpts = CrysalisPeak(el)
+            if len(malformed) > 0:
+                line_no, line = malformed[0]
+                self.debug(f"Skipped {len(malformed)} malformed lines, first at line {line_no}: {line.strip()[:40]}")
 
-                if mi is None or mi < tpts.intensity:
-                    mi = tpts.intensity
-                if ma is None or ma > tpts.intensity:
-                    ma = tpts.intensity
-
-                res.append(tpts)
+            if len(table) == 0:
+                raise ValueError("data is not crysalis peak data")
 
-            if len(res) > 0:
-                # self.debug("Data is valid")
-                res = [res, mi, ma]
+            res = [table, *table.intensity_range()]
         except ValueError as e:
             self.debug(f"Data is invalid: {e}")
             res = None
-        return res
\ No newline at end of file
+        return res
@@ -0,0 +1,259 @@
+import os
+import socket
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+
+from queue import Queue, Empty
+
+__all__ = ["PeakSource", "Win32ClipboardSource", "FileSource", "SocketSource", "MemorySource", "make_source",
+           "fingerprint"]
+
+
+def fingerprint(data):
+    """
+    Cheap identity of a text - its size and a content hash
+    :param data:
+    :return:
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8", errors="surrogatepass")
+    return len(data), hashlib.blake2b(data, digest_size=16).digest()
+
+
+class PeakSource(ABC):
+    """
+    Source of peak table text.
+    Polled sources return the current content from read() or None if it certainly did not change,
+    event driven sources block in read() until new content arrives
+    """
+
+    EVENT_DRIVEN = False
+
+    def __init__(self):
+        super(PeakSource, self).__init__()
+
+    def start(self):
+        """
+        Prepares the source before polling
+        :return:
+        """
+        pass
+
+    def stop(self):
+        """
+        Releases resources of the source
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def read(self, timeout=None):
+        """
+        Returns the content of the source or None
+        :param timeout: maximum waiting time for event driven sources
+        :return:
+        """
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class Win32ClipboardSource(PeakSource):
+    """
+    Windows clipboard accessed through pywin32, the clipboard is read only if its sequence number changed
+    """
+
+    def __init__(self):
+        super(Win32ClipboardSource, self).__init__()
+
+        self.win32clipboard = None
+        self.sequence = None
+
+    def start(self):
+        # imported on first use - the module exists only under windows
+        import win32clipboard
+        self.win32clipboard = win32clipboard
+        self.sequence = None
+
+    def read(self, timeout=None):
+        cb = self.win32clipboard
+
+        sequence = cb.GetClipboardSequenceNumber()
+        if sequence == self.sequence:
+            return None
+
+        data = None
+        try:
+            # make a snapshot only
+            cb.OpenClipboard()
+            try:
+                data = cb.GetClipboardData()
+            finally:
+                cb.CloseClipboard()
+        except TypeError:
+            # content which is not text is not opened again until the clipboard changes
+            pass
+        self.sequence = sequence
+        return data
+
+
+class FileSource(PeakSource):
+    """
+    Peak table exported into a file, the file is read only if its size or modification time changed
+    """
+
+    def __init__(self, path, encoding="utf-8"):
+        super(FileSource, self).__init__()
+
+        self.path = path
+        self.encoding = encoding
+        self.stat = None
+
+    def start(self):
+        self.stat = None
+
+    def read(self, timeout=None):
+        try:
+            st = os.stat(self.path)
+        except (IOError, OSError):
+            return None
+
+        tstat = (st.st_size, st.st_mtime_ns)
+        if tstat == self.stat:
+            return None
+
+        try:
+            with open(self.path, "r", encoding=self.encoding, errors="replace") as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return None
+
+        self.stat = tstat
+        return data
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.path})"
+
+
+class MemorySource(PeakSource):
+    """
+    Source fed from python code, e.g. for tests or other tools running in the same kernel
+    """
+
+    EVENT_DRIVEN = True
+
+    def __init__(self):
+        super(MemorySource, self).__init__()
+        self.queue = Queue()
+
+    def push(self, data):
+        """
+        Adds new content
+        :param data:
+        :return:
+        """
+        self.queue.put(data)
+
+    def read(self, timeout=None):
+        try:
+            data = self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+        # only the latest content matters
+        while True:
+            try:
+                data = self.queue.get(block=False)
+            except Empty:
+                break
+        return data
+
+
+class SocketSource(MemorySource):
+    """
+    Local TCP listener, every connection transfers one complete peak table, e.g.:
+    python -c "import socket,sys; s=socket.create_connection(('127.0.0.1', 8765)); s.sendall(open(sys.argv[1],'rb').read())" table.txt
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, port, host="127.0.0.1", encoding="utf-8"):
+        super(SocketSource, self).__init__()
+
+        self.host = host
+        self.port = int(port)
+        self.encoding = encoding
+
+        self.server = None
+        self.th_server = None
+
+    def start(self):
+        if self.server is not None:
+            return
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(1)
+
+        self.th_server = threading.Thread(target=self._serve, args=[self.server])
+        self.th_server.daemon = True
+        self.th_server.start()
+
+    def stop(self):
+        server, self.server = self.server, None
+        if server is not None:
+            try:
+                server.close()
+            except OSError:
+                pass
+
+    def _serve(self, server):
+        """
+        Accepts connections until the server socket is closed
+        :param server:
+        :return:
+        """
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+
+            chunks = []
+            with conn:
+                while True:
+                    chunk = conn.recv(self.BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            self.push(b"".join(chunks).decode(self.encoding, errors="replace"))
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.host}:{self.port})"
+
+
+def make_source(spec):
+    """
+    Creates a source from a short description:
+    "clipboard", "file:<path>", "socket:<port>" or "memory"
+    :param spec: description or a PeakSource
+    :return:
+    """
+    if isinstance(spec, PeakSource):
+        return spec
+
+    spec = "clipboard" if spec is None else str(spec)
+    kind, _, value = spec.partition(":")
+    kind = kind.strip().lower()
+
+    if kind == "clipboard":
+        return Win32ClipboardSource()
+    elif kind == "file":
+        return FileSource(value)
+    elif kind == "socket":
+        return SocketSource(value)
+    elif kind == "memory":
+        return MemorySource()
+    raise ValueError(f"unknown peak source: {spec}")
@@ -1,13 +1,29 @@
-import copy
+import html
+import asyncio
+from collections import deque
 
 import numpy as np
 
-from app.imports import *
+from IPython.display import display
+from ipywidgets import Button, Layout, HBox, VBox, FileUpload, Output, HTML, Dropdown, FloatRangeSlider, \
+    ToggleButtons, Checkbox, Accordion, Text, IntText, FloatSlider, IntSlider, IntRangeSlider, FloatText, SelectMultiple
 
-import fabio.tifimage
+from app.imports import *
 
 import app.bokeh.app_peaks as app
+from app.bokeh.scheduler import RenderScheduler
+from app.bokeh.jobs import JobQueue
 from app.imports.clipboard import CrysalisPeaksCW
+from app.core.images import upload_content
+from app.core.stack import FrameStack
+from app.core.cache import ImageCache, content_key
+from app.core.projection import ProjectionEngine
+from app.core.offload import OffloadEngine
+from app.core.masks import MaskStore
+from app.core.autoscale import autoscale
+from app.core.orientation import Orientation
+from app.core.peaks import PeakTable
+from app.core.timing import TIMINGS
 
 class Starter:
 
@@ -25,6 +41,8 @@ class Starter:
     KEY_VALUE = "value"
 
     DEBUG = True
+    DEBUG_INTERVAL = 0.25   # shortest time between updates of the output and the timings panel in seconds
+    TIMING_LOG = None       # json lines file receiving durations of the pipeline stages, None - no file
 
     # parameters for default values
     CAP_XOFFSET = 5
@@ -44,12 +62,36 @@ class Starter:
     IMG_ROTATION = "0"
     IMG_FLIP = "None"
 
+    RENDER_INTERVAL = 0.1   # minimum time between graph updates in seconds
+    LOAD_WORKERS = 2        # threads decoding uploaded files, a new upload cancels the older ones
+
+    IMAGE_CACHE_BYTES = 1 << 30     # memory budget of recently opened images with their derived data
+
+    PROJECTIONS = ["Frame", "Sum", "Max", "Mean"]
+    PROJECTION_WORKERS = None   # processes reducing frame ranges, None - all cores
+    OFFLOAD_WORKERS = 0         # processes computing statistics and pyramids from shared memory, 0 - kernel threads
+
+    AUTOSCALE = "mean"      # autoscale preset - "mean", "p99", "p99.9", "zscale" or "log"
+    AUTOSCALE_PRESETS = [("Mean x3", "mean"), ("Percentile 99%", "p99"), ("Percentile 99.9%", "p99.9"),
+                         ("ZScale", "zscale"), ("Log", "log")]
+    LOG_SCALE = False
+
+    MASK_APPLY = True
+    MASK_FILE = "mask.npy"
+    HOT_PIXEL_NSIGMA = 10.      # excess over the local median in units of poisson noise
+    HOT_PIXEL_THRESHOLD = 0.    # pixels above the value are masked, 0 - only the local test
+
+    PEAK_SOURCE = "clipboard"   # "clipboard", "file:<path>", "socket:<port>" or "memory"
+
     def __init__(self, *args, **kwargs):
         """
         Initialization
         """
         super(Starter, self).__init__()
 
+        # BokehJS is loaded into the notebook with the first application, not on import
+        init_notebook()
+
         self._prep_parameters(*args, **kwargs)
 
         #if palette is not None and palette in self.DEF_PALETTES:
@@ -67,6 +109,9 @@ class Starter:
         # graph controls
         self.btn_update = None
         self.btn_autoscale = None
+        self.cmb_autoscale = None
+        self.cb_log = None
+        self._th_histogram = None
         self.bgraph_controls = False
         self.cmb_palette = None
         self.cb_pallete = None
@@ -78,6 +123,15 @@ class Starter:
         self.img_flip = None
         self.img_rotation = None
 
+        # frame navigation of multi-frame files
+        self.sld_frame = None
+        self.frame_index = 0
+
+        # projection of a frame range
+        self.cmb_projection = None
+        self.rng_frames = None
+        self.shown_kind = None
+
         # clipboard control
         self.btn_clipboard = None
 
@@ -99,24 +153,59 @@ class Starter:
 
         self.acc_caption = None
 
-        # output widget
+        # twin or domain groups of the peak table shown as separate layers
+        self.sel_groups = None
+
+        # detector masks shared by images of the same shape
+        self.masks = MaskStore()
+        self.acc_mask = None
+        self.cb_mask = None
+        self.ft_hot_threshold = None
+        self.txt_mask_file = None
+
+        # output widget, messages are collected and shown in batches
         self.lbl_output = Output()
-        self._output = []
+        self._output = deque(maxlen=self.OUTPUT_LINES)
+        self._output_lock = threading.Lock()
+        self._th_output = None
+
+        # durations of the pipeline stages
+        self.acc_timings = None
+        self.lbl_timings = None
+        self._timings_version = None
+        if self.TIMING_LOG:
+            TIMINGS.open_log(self.TIMING_LOG)
 
         # last data loaded
         self.last_data = None
         self.last_image = None
+        self.stack = None
+
+        # recently opened stacks by content hash or file identity, reopening them skips decoding
+        self.images = ImageCache(self.IMAGE_CACHE_BYTES, on_evict=self._image_evicted)
 
         # filenames
         self.base_dir = os.path.dirname(__file__)
         self.tmp_dir = os.path.join(self.base_dir, "tmp")
-        self.tmp_file = os.path.join(self.tmp_dir, "tmp.tif")
 
         # bokeh controller
         self.bc = None
 
+        # reduces frame ranges into oscillation images
+        self.projector = ProjectionEngine(workers=self.PROJECTION_WORKERS)
+
+        # optional worker processes for derived products of images, keeps the GIL free for the event loop
+        self.offload = OffloadEngine(workers=self.OFFLOAD_WORKERS) if self.OFFLOAD_WORKERS else None
+
+        # merges bursts of graph updates into a single render
+        self.scheduler = RenderScheduler(self._render_graph, min_interval=self.RENDER_INTERVAL, parent=self)
+
+        # background file loads, only the latest upload is shown
+        self.jobs = JobQueue(workers=self.LOAD_WORKERS, parent=self)
+
         # point storage
         self.point_storage = []
+        self.point_diff = None
 
         try:
             os.makedirs(self.tmp_dir)
@@ -128,7 +217,7 @@ class Starter:
         self._init_bokeh()
 
         # peak watch dog
-        self.crysalis_wdog = CrysalisPeaksCW(parent=self)
+        self.crysalis_wdog = CrysalisPeaksCW(parent=self, source=self.PEAK_SOURCE)
 
     def _prep_parameters(self, *args, **kwargs):
         """
@@ -164,21 +253,30 @@ class Starter:
         #graph controls
         self._init_graphcontrols()
 
+        # mask controls
+        self._init_maskcontrols()
+
+        # timings panel
+        self._init_timings()
+
 
         # placing inside a layout
         display(self.lbl_filename)
-        display(HBox([self.btn_filename, self.btn_update, self.btn_autoscale]))
+        display(HBox([self.btn_filename, self.btn_update, self.btn_autoscale, self.cmb_autoscale]))
         display(HBox([self.btn_clipboard, self.img_rotation, self.img_flip]))
 
         # controls of the caption
         display(self.acc_caption)
+        display(self.acc_mask)
 
         # controls of the image
-        display(HBox([self.cmb_palette, self.cb_pallete]))
+        display(HBox([self.cmb_palette, self.cb_pallete, self.cb_log]))
         display(HBox([self.range_intensity]))
+        display(HBox([self.sld_frame, self.cmb_projection, self.rng_frames]))
 
         # output for debuggine and etc
         display(self.lbl_output)
+        display(self.acc_timings)
 
         asyncio.ensure_future(self._fn())
 
@@ -189,9 +287,9 @@ class Starter:
         """
         # file upload button + label
         self.btn_filename = FileUpload(
-            accept='.tif',  # Accepted file extension e.g. '.txt', '.pdf', 'image/*', 'image/*,.pdf'
+            accept='.tif,.tiff,.cbf,.edf,.esperanto,.esper',  # Accepted file extension e.g. '.txt', '.pdf', 'image/*', 'image/*,.pdf'
             multiple=False,  # True to accept multiple files upload else False
-            description='Load image file (*.tif) file:',
+            description='Load image file (*.tif, *.cbf, *.edf, *.esperanto) file:',
             layout=Layout(flex='0 1 auto', min_height='40px', width='200px'),
         )
 
@@ -236,12 +334,14 @@ class Starter:
             description="Line color:",
             layout=Layout(width="20em"),
             tooltip="Controls line color of the symbols",
+            continuous_update=False,
         )
         self.sym_bkgcolor = mw5 = Text(
             value=self.SYM_BKGCOLOR,
             description="Fill color:",
             layout=Layout(width="20em"),
             tooltip="Controls fill color of the symbols",
+            continuous_update=False,
         )
 
         self.sym_visible = mw6 = Checkbox(
@@ -271,6 +371,7 @@ class Starter:
             description="Font size:",
             layout=Layout(width="12em"),
             tooltip="Controls fill color of the symbols",
+            continuous_update=False,
         )
         flist = ["Arial", "Helvetica", "Tahoma", "Verdana", "Times New Roman"]
 
@@ -289,12 +390,14 @@ class Starter:
             description="Text color:",
             layout=Layout(width="15em"),
             tooltip="Controls text color of the caption",
+            continuous_update=False,
         )
         self.cap_bkgcolor = cw6 = Text(
             value=self.CAP_BKGCOLOR,
             description="Background color:",
             layout=Layout(width="15em"),
             tooltip="Controls background color of the caption",
+            continuous_update=False,
         )
         self.cap_visible = cw7 = Checkbox(
             value=self.CAP_VISIBLE,
@@ -318,16 +421,93 @@ class Starter:
             layout=Layout(width='50%')
         )
 
-        self.range_peakintensity.observe(self.action_default)
+        # captions and styles are updated on the figure directly, the image is not rendered again
+        self.range_peakintensity.observe(self.action_caption_filter, 'value')
+        for el in (mw1, mw2, mw3, mw4, mw5, mw6, cw1, cw2, cw3, cw4, cw5, cw6, cw7):
+            el.observe(self.action_style, 'value')
+
+        self.sel_groups = SelectMultiple(
+            options=[],
+            value=[],
+            description="Shown groups:",
+            rows=4,
+            tooltip="Groups of peaks (twins, domains) shown on the image",
+        )
+
+        self.sel_groups.observe(self.action_groups, 'value')
 
         self.acc_caption = accordion = Accordion(children=[
             HBox([self.range_peakintensity]),
             HBox([cw1, cw2, cw3, cw4, cw5, cw6, cw7]),
             HBox([mw1, mw2, mw3, mw4, mw5, mw6]),
+            HBox([self.sel_groups]),
         ])
         accordion.set_title(0, 'Filter caption intensity')
         accordion.set_title(1, 'Caption Style')
         accordion.set_title(2, 'Symbol Style')
+        accordion.set_title(3, 'Peak Groups')
+
+    def _init_timings(self):
+        """
+        Initializes the panel with durations of the pipeline stages
+        :return:
+        """
+        self.lbl_timings = HTML("")
+
+        self.acc_timings = Accordion(children=[self.lbl_timings])
+        self.acc_timings.set_title(0, 'Timings')
+        self.acc_timings.selected_index = None
+
+    def _init_maskcontrols(self):
+        """
+        Initializes controls of the detector mask
+        :return:
+        """
+        self.cb_mask = Checkbox(
+            value=bool(self.MASK_APPLY),
+            description='Apply mask',
+            disabled=False,
+            tooltip="Excludes masked pixels from statistics and marks them on the image",
+        )
+        self.cb_mask.observe(self.action_mask_apply, 'value')
+
+        self.ft_hot_threshold = FloatText(
+            value=self.HOT_PIXEL_THRESHOLD,
+            description='Hot above:',
+            disabled=False,
+            tooltip="Pixels above the value are masked as hot pixels, 0 - local median test only",
+        )
+
+        btn_hot = Button(description="Mask hot pixels",
+                         tooltip="Masks pixels standing out of their neighbourhood",
+                         layout=Layout(flex='0 1 auto', min_height='40px', width='200px'))
+        btn_hot.on_click(self.action_mask_hot)
+
+        btn_selection = Button(description="Mask selection",
+                               tooltip="Masks the last box or lasso selection of the figure",
+                               layout=Layout(flex='0 1 auto', min_height='40px', width='200px'))
+        btn_selection.on_click(self.action_mask_selection)
+
+        self.txt_mask_file = Text(
+            value=self.MASK_FILE,
+            description='Mask file:',
+            disabled=False,
+            tooltip="Mask file (.npy, .npz, .edf, .tif)",
+        )
+
+        buttons = []
+        for name, tooltip, action in (("Load", "Loads the mask file", self.action_mask_load),
+                                      ("Save", "Saves the mask of the current detector", self.action_mask_save),
+                                      ("Clear", "Clears the mask of the current detector", self.action_mask_clear)):
+            el = Button(description=name, tooltip=tooltip, layout=Layout(flex='0 1 auto', min_height='40px', width='100px'))
+            el.on_click(action)
+            buttons.append(el)
+
+        self.acc_mask = accordion = Accordion(children=[
+            VBox([HBox([self.cb_mask, self.ft_hot_threshold, btn_hot, btn_selection]),
+                  HBox([self.txt_mask_file, *buttons])]),
+        ])
+        accordion.set_title(0, 'Detector mask')
 
     def _init_graphcontrols(self):
         """
@@ -415,6 +595,70 @@ class Starter:
                                  )
         self.btn_autoscale.on_click(self.action_autoscale)
 
+        v = self.AUTOSCALE
+        if v not in [el[1] for el in self.AUTOSCALE_PRESETS]:
+            self.AUTOSCALE = v = self.AUTOSCALE_PRESETS[0][1]
+
+        self.cmb_autoscale = Dropdown(
+            options=self.AUTOSCALE_PRESETS,
+            value=v,
+            description='Autoscale:',
+            disabled=False,
+            tooltip="Preset used by the Autoscale button",
+        )
+
+        self.cb_log = Checkbox(
+            value=bool(self.LOG_SCALE),
+            description='Log scale',
+            disabled=False,
+            tooltip="Logarithmic color map",
+        )
+
+        self.cb_log.observe(self.action_default)
+
+        self.sld_frame = IntSlider(
+            value=0,
+            min=0,
+            max=0,
+            step=1,
+            description='Frame:',
+            disabled=True,
+            continuous_update=True,
+            orientation='horizontal',
+            tooltip="Selects a frame of a multi-frame file",
+            readout=True,
+            layout=Layout(width='50%', display='none')
+        )
+
+        self.sld_frame.observe(self.action_frame, 'value')
+
+        self.cmb_projection = Dropdown(
+            options=self.PROJECTIONS,
+            value=self.PROJECTIONS[0],
+            description='Show:',
+            disabled=True,
+            tooltip="Shows a single frame or a projection of the frame range",
+            layout=Layout(width='20%', display='none')
+        )
+
+        self.cmb_projection.observe(self.action_projection, 'value')
+
+        self.rng_frames = IntRangeSlider(
+            value=[0, 0],
+            min=0,
+            max=0,
+            step=1,
+            description='Frame range:',
+            disabled=True,
+            continuous_update=False,
+            orientation='horizontal',
+            tooltip="Range of frames reduced into one image",
+            readout=True,
+            layout=Layout(width='30%', display='none')
+        )
+
+        self.rng_frames.observe(self.action_projection, 'value')
+
         self.cb_pallete = Checkbox(
             value=self.INVERT_PALETTE,
             description='Invert the pallete',
@@ -445,18 +689,31 @@ class Starter:
 
     def action_autoscale(self, *args, **kwargs):
         """
-        Autoscales the graph using the mean value
+        Autoscales the graph using the cached intensity histogram and the selected preset
         :return:
         """
-        if self.last_image is not None:
-            data = self.last_image.data
-            avrg = np.average(data)
-            mi, ma = self.range_intensity.min, self.range_intensity.max
-            tvi, tva = 0, 3*avrg
-            tvi, tva = max(mi, tvi), min(tva,ma)
-            self.range_intensity.value = [tvi, tva]
+        image = self.last_image
+        if image is None:
+            return
 
-            # self.reload_graph()
+        hist = image.histogram(self.get_mask(image.shape))
+        tvi, tva, blog = autoscale(hist, self.cmb_autoscale.value)
+
+        # the slider is extended if the preset reaches beyond it, e.g. up to the brightest peaks
+        mi, ma = self.range_intensity.min, self.range_intensity.max
+        if tva > ma:
+            self.range_intensity.max = tva
+        if tvi < mi:
+            self.range_intensity.min = tvi
+
+        self.cb_log.value = blog
+        self.range_intensity.value = [tvi, tva]
+
+        # the subsampled histogram is completed in the background for the following clicks
+        if not hist.is_complete and (self._th_histogram is None or not self._th_histogram.is_alive()):
+            self._th_histogram = threading.Thread(target=hist.refine, args=[])
+            self._th_histogram.daemon = True
+            self._th_histogram.start()
 
     def action_intensity(self, change):
         """
@@ -473,6 +730,97 @@ class Starter:
             (self.range_intensity_min, self.range_intensity_max) = change[self.KEY_NEW]
             self.reload_graph()
 
+    def action_frame(self, change):
+        """
+        Action processing changes of the frame slider, frames are decoded by the render thread
+        :param change:
+        :return:
+        """
+        if self.block_update:
+            return
+
+        with self.lock:
+            self.frame_index = change[self.KEY_NEW]
+
+        self.reload_graph()
+
+    def action_projection(self, change):
+        """
+        Action processing changes of the projection operator and of the frame range
+        :param change:
+        :return:
+        """
+        if self.block_update:
+            return
+
+        self.reload_graph()
+
+    def action_caption_filter(self, change):
+        """
+        Hides captions of weak peaks, only the shown captions are updated
+        :param change:
+        :return:
+        """
+        if self.bc is not None:
+            self.bc.set_caption_filter(change[self.KEY_NEW])
+
+    def action_style(self, change):
+        """
+        Applies caption and symbol styles to the figure
+        :param change:
+        :return:
+        """
+        if self.bc is not None:
+            self._set_styles()
+            self.bc.update_styles()
+
+    def _set_styles(self):
+        """
+        Passes values of the caption and symbol style widgets to the bokeh controller
+        :return:
+        """
+        # collect data from caption and symbol styles
+        sym_data = (self.sym_type.value, self.sym_size.value, self.sym_linesize.value, self.sym_linecolor.value,
+                    self.sym_bkgcolor.value, self.sym_visible.value)
+
+        self.bc.set_symbol_style(*sym_data)
+
+        cap_data = (
+            self.cap_xoffset.value, self.cap_yoffset.value, self.cap_font.value, self.cap_fontsize.value,
+            self.cap_color.value, self.cap_bkgcolor.value, self.cap_visible.value)
+
+        self.bc.set_caption_style(*cap_data)
+
+    def action_groups(self, change):
+        """
+        Shows or hides peak groups, the image and the peaks are not sent again
+        :param change:
+        :return:
+        """
+        if self.bc is None:
+            return
+
+        shown = set(self.sel_groups.value)
+        for el in self.sel_groups.options:
+            self.bc.set_group_visible(el, el in shown)
+
+    def _update_groups(self, table):
+        """
+        Updates the group selector for a new peak table, groups hidden before stay hidden
+        :param table: PeakTable
+        :return:
+        """
+        if not isinstance(self.sel_groups, SelectMultiple):
+            return
+
+        groups = table.groups()
+        if list(self.sel_groups.options) == groups:
+            return
+
+        hidden = set(self.sel_groups.options) - set(self.sel_groups.value)
+        self.sel_groups.options = groups
+        self.sel_groups.value = [el for el in groups if el not in hidden]
+
     def action_default(self, change):
         """
         Default implementation of an action
@@ -546,17 +894,15 @@ class Starter:
             tdata = None
 
             if isinstance(change.new, dict):
-                fn = tuple(change.new.keys())[0]
                 tdata = change.new
             elif isinstance(change.new, list) or isinstance(change.new, tuple):
-                fn = tuple(change.new[0].keys())[0]
                 tdata = change.new[0]
+
+            fn, content = upload_content(tdata)
             self.last_data = tdata
 
-            # process data separately
-            th = threading.Thread(target=self.process_newfile, args=[fn, tdata])
-            th.setDaemon(True)
-            th.start()
+            # process data separately, the upload supersedes loads still running
+            self.jobs.submit(self.process_newfile, fn, content, group="load")
 
             widget.unobserve(update, value)
 
@@ -571,44 +917,100 @@ class Starter:
         while True:
             x = await self.wait_for_filename_change(self.btn_filename, 'value')
 
-    def process_newfile(self, fn, data):
+    def process_newfile(self, fn, content, job=None):
         """
         Processes filename change and the data content
         :param fn:
-        :param data:
+        :param content: file content as bytes or memoryview
+        :param job: background job, the load stops between stages once the job is superseded
         :return:
         """
+        key = content_key(content)
+        self._check_job(job)
+
+        stack = self.images.get(("content", key))
+        if stack is None:
+            # decoding in memory, temporary file is used only as a fallback
+            stack = FrameStack.from_content(content, filename=fn, tmp_dir=self.tmp_dir, content_key=key)
+            # kept even if superseded, the same upload is not decoded again
+            self.images.put(stack.key, stack)
+        self.process_stack(fn, stack, job=job)
+
+    def open_file(self, fn):
+        """
+        Opens an image from the disk, frames of multi-frame files are read when shown.
+        A list of filenames is opened as a series of frames, e.g. cbf files of a scan
+        :param fn: filename or a list of filenames
+        :return:
+        """
+        stack = self.images.get(FrameStack.key_of(fn))
+        if stack is None:
+            if isinstance(fn, (list, tuple)):
+                stack = FrameStack.from_series(fn)
+            else:
+                stack = FrameStack.from_file(fn)
+            self.images.put(stack.key, stack)
+        self.process_stack(stack.filename, stack)
 
-        with open(self.tmp_file, "wb") as fh:
-            fh.write(data['content'])
-
-        #self.debug(f"Writing a temporary file {self.tmp_file}")
-
-        # tif = fabio.tifimage.TifImage()
-        with fabio.openimage.openimage(self.tmp_file) as fh:
-            img_data = fh.data
+    def process_stack(self, fn, stack, job=None):
+        """
+        Shows the first frame of a new image stack
+        :param fn:
+        :param stack: FrameStack
+        :param job: background job, nothing is committed to the interface once the job is superseded
+        :return:
+        """
+        self._check_job(job)
+        image = stack.get(0)
+        img_data = image.data
+
+        # streaming statistics, cached on the image for its lifetime
+        self._check_job(job)
+        stats = self.image_stats(image)
+        ave, test_ave = stats.mean, stats.below_mean
+        mi, ma = stats.min, stats.max
+
+        if stack.fallback is not None:
+            self.debug(f"Stream decoding of {fn} failed, a temporary file is used: {stack.fallback}")
+        if stack.decoder is not None:
+            self.debug(f"Opened {fn}: {stack.format_timings()}")
+        self.debug(f"Decoded {fn} ({len(stack)} frames): {image.format_timings()}")
+        self.debug(f"Image cache: {self.images.format_info()}")
 
-        #img_data = tif.read(self.tmp_file)
+        palette = self.DEF_PALETTE
+        binvert_colormap = self.cb_pallete.value
 
-        ave = np.average(img_data.data)
+        with self.lock:
+            # a newer upload cancels this job before its own job is queued, so the check under the lock
+            # guarantees that a superseded load never overwrites the latest one
+            self._check_job(job)
 
-        test_ave = np.copy(img_data)
-        test_ave[test_ave > ave] = 0
-        test_ave = np.average(test_ave)
+            self.block_update = True
 
-        mi, ma = np.min(img_data.data), np.max(img_data.data)
+            # stacks kept by the image cache are closed when evicted
+            if self.stack is not None and self.stack is not stack and not self.images.holds(self.stack):
+                self.stack.close()
+            self.stack = stack
+            self.frame_index = 0
+            self.last_image = image
 
+            self.shown_kind = None
+            for el in (self.sld_frame, self.cmb_projection, self.rng_frames):
+                if el is not None:
+                    el.disabled = len(stack) < 2
+                    el.layout.display = None if len(stack) > 1 else 'none'
 
-        palette = self.DEF_PALETTE
-        binvert_colormap = self.cb_pallete.value
+            if isinstance(self.sld_frame, IntSlider):
+                self.sld_frame.value = 0
+                self.sld_frame.max = max(0, len(stack) - 1)
 
-        self.block_update = True
-        with self.lock:
-            self.last_image = img_data
+            if isinstance(self.rng_frames, IntRangeSlider):
+                self.rng_frames.max = max(0, len(stack) - 1)
+                self.rng_frames.value = [0, max(0, len(stack) - 1)]
 
             self.last_filename = fn
             self.lbl_filename.value = f"""
-                <div>Filename: {fn}</div><div>Image dimensions: {img_data.shape}</div>
+                <div>Filename: {fn}</div><div>Image dimensions: {img_data.shape}; Frames: {len(stack)}</div>
                 <div>Min: {mi}; Max: {ma}; Average: {ave};</div>
                 """
 
@@ -616,16 +1018,7 @@ class Starter:
                 self._enable_graph_controls(True)
 
             # update range intensity
-            if isinstance(self.range_intensity, FloatRangeSlider):
-                self.range_intensity.min, self.range_intensity.max = mi, test_ave * 10
-
-                if self.range_intensity_min is None or self.range_intensity_min<mi:
-                    self.range_intensity_min = mi
-
-                if self.range_intensity_max is None or self.range_intensity_max > ave:
-                    self.range_intensity_max = test_ave * 10
-
-                self.range_intensity.value = [self.range_intensity_min, self.range_intensity_max]
+            self._scale_intensity(stats)
 
             if isinstance(self.cmb_palette, Dropdown):
                 palette = self.cmb_palette.value
@@ -641,57 +1034,279 @@ class Starter:
 
         self.block_update = False
 
-    def reload_graph(self,*args, **kwargs):
+    def _check_job(self, job):
+        """
+        Stage boundary of a background load
+        :param job: Job or None for loads in the calling thread
+        :return:
+        """
+        if job is not None:
+            job.check()
+
+    def _image_evicted(self, key, stack):
+        """
+        Releases a stack dropped from the image cache unless it is shown
+        :param key:
+        :param stack: FrameStack
+        :return:
+        """
+        if stack is not self.stack:
+            stack.close()
+
+    def _scale_intensity(self, stats, reset=False):
+        """
+        Adjusts the intensity range slider to the image statistics, has to be called with the lock
+        :param stats: ImageStats
+        :param reset: forget the previous range, e.g. when switching between frames and projections
+        :return:
+        """
+        ave, test_ave = stats.mean, stats.below_mean
+        mi = stats.min
+
+        if not isinstance(self.range_intensity, FloatRangeSlider):
+            return
+
+        if reset:
+            self.range_intensity_min = self.range_intensity_max = None
+
+        # the slider refuses a minimum above its maximum, the order of changes matters
+        if mi > self.range_intensity.max:
+            self.range_intensity.max, self.range_intensity.min = test_ave * 10, mi
+        else:
+            self.range_intensity.min, self.range_intensity.max = mi, test_ave * 10
+
+        if self.range_intensity_min is None or self.range_intensity_min<mi:
+            self.range_intensity_min = mi
+
+        if self.range_intensity_max is None or self.range_intensity_max > ave:
+            self.range_intensity_max = test_ave * 10
+
+        self.range_intensity.value = [self.range_intensity_min, self.range_intensity_max]
+
+    def get_mask(self, shape):
+        """
+        Returns the mask applied to images of the shape
+        :param shape:
+        :return: DetectorMask or None if masking is off or nothing is masked
+        """
+        if self.cb_mask is not None and not self.cb_mask.value:
+            return None
+
+        mask = self.masks.get(shape, create=False)
+        if mask is None or mask.is_empty:
+            return None
+        return mask
+
+    def image_stats(self, image):
+        """
+        Statistics of the image without masked pixels
+        :param image: LoadedImage
+        :return: ImageStats
+        """
+        return image.masked_stats(self.get_mask(image.shape), offload=self.offload)
+
+    def _mask_changed(self):
+        """
+        Rescales the intensity range with the new statistics and updates the image
+        :return:
+        """
+        image = self.last_image
+        if image is None:
+            return
+
+        stats = self.image_stats(image)
+        self.block_update = True
+        try:
+            with self.lock:
+                self._scale_intensity(stats, reset=True)
+        finally:
+            self.block_update = False
+
+        self.reload_graph()
+
+    def action_mask_apply(self, change):
+        """
+        Switches masking on and off
+        :param change:
+        :return:
+        """
+        self._mask_changed()
+
+    def action_mask_hot(self, *args, **kwargs):
+        """
+        Masks hot pixels of the shown image
+        :return:
+        """
+        image = self.last_image
+        if image is None:
+            return
+
+        threshold = self.ft_hot_threshold.value
+        mask = self.masks.get(image.shape)
+        count = mask.add_hot_pixels(image.data, threshold=threshold if threshold > 0 else None,
+                                    nsigma=self.HOT_PIXEL_NSIGMA)
+        self.debug(f"Masked {count} hot pixels, {mask.count} pixels are masked")
+        self._mask_changed()
+
+    def action_mask_selection(self, *args, **kwargs):
+        """
+        Masks the last box or lasso selection drawn on the figure
+        :return:
+        """
+        image = self.last_image
+        geometry = None if self.bc is None else self.bc.selection_geometry
+        if image is None or geometry is None:
+            self.debug("Select a region with the box or lasso selection tool first")
+            return
+
+        # the figure shows the oriented image, the mask keeps detector coordinates
+        orientation = Orientation(image.shape, int(self.img_rotation.value), self.img_flip.value)
+        xs, ys = orientation.invert_points(*geometry)
+
+        mask = self.masks.get(image.shape)
+        count = mask.add_polygon(xs, ys)
+        self.bc.selection_geometry = None
+        self.debug(f"Masked {count} pixels of the selection, {mask.count} pixels are masked")
+        self._mask_changed()
+
+    def action_mask_load(self, *args, **kwargs):
+        """
+        Loads a mask file
+        :return:
+        """
+        fn = self.txt_mask_file.value
+        try:
+            mask = self.masks.load(fn)
+        except Exception as e:
+            self.debug(f"Mask {fn} could not be loaded: {e}")
+            return
+
+        self.debug(f"Loaded mask {fn}: {mask.shape}, {mask.count} pixels are masked")
+        self._mask_changed()
+
+    def action_mask_save(self, *args, **kwargs):
+        """
+        Saves the mask of the current detector
+        :return:
+        """
+        image = self.last_image
+        if image is None:
+            return
+
+        fn = self.txt_mask_file.value
+        try:
+            self.masks.get(image.shape).save(fn)
+        except Exception as e:
+            self.debug(f"Mask {fn} could not be saved: {e}")
+            return
+        self.debug(f"Saved mask {fn}")
+
+    def action_mask_clear(self, *args, **kwargs):
+        """
+        Clears the mask of the current detector
+        :return:
+        """
+        image = self.last_image
+        if image is None:
+            return
+
+        self.masks.get(image.shape).clear()
+        self._mask_changed()
+
+    def reload_graph(self, *args, **kwargs):
+        """
+        Requests an update of the image, requests arriving in a burst are merged
+        :return:
+        """
+        if self.last_image is not None:
+            self.scheduler.request()
+
+    def _render_graph(self, generation):
         """
         Processes the values set by interface and update the image
+        :param generation: generation of the render request
         :return:
         """
         img_data = None
         palette = self.DEF_PALETTE
         imin, imax = None, None
         binvert_colormap = None
+        blog = False
         filter_captions = None
 
         with self.lock:
-            img_data = self.last_image.data
+            image = self.last_image
+            stack, frame = self.stack, self.frame_index
+            projection, (first, last) = self.cmb_projection.value, self.rng_frames.value
+
+        if stack is not None and len(stack) > 1:
+            try:
+                if projection == self.PROJECTIONS[0]:
+                    # frames are decoded on demand, neighbours are already prefetched while scrolling
+                    kind = projection
+                    image = stack.get(frame)
+                else:
+                    # projections are cached, the range is reduced once
+                    kind = (projection, first, last)
+                    image = self.projector.project(stack, first, last + 1, projection.lower())
+                    self.debug(f"Projection {image.filename}: {image.format_timings()}")
+            except Exception as e:
+                self.debug(f"Frame {frame} ({projection}) could not be read: {e}")
+                return
+
+            # superseded while decoding, the newer render reads the state again
+            if not self.scheduler.is_current(generation):
+                return
+
+            with self.lock:
+                self.last_image = image
+
+                # projections have a different scale than single frames
+                if kind != self.shown_kind and (self.shown_kind is not None or kind != self.PROJECTIONS[0]):
+                    self.block_update = True
+                    try:
+                        self._scale_intensity(self.image_stats(image), reset=True)
+                    finally:
+                        self.block_update = False
+                self.shown_kind = kind
+
+        with self.lock:
             palette = self.cmb_palette.value
             imin, imax = self.range_intensity_min, self.range_intensity_max
             binvert_colormap = self.cb_pallete.value
+            blog = self.cb_log.value
             filter_captions = self.range_peakintensity.value
 
-        # adjusting rotation
-        rotation = int(self.img_rotation.value)
-        if rotation > 0:
-            img_data = np.rot90(img_data, k=int(rotation/90.))
-
-        # flipping the dataif necessary
-        flip = self.img_flip.value
-        if "v" in flip.lower():
-            img_data = np.flipud(img_data)
-        elif "h" in flip.lower():
-            img_data = np.fliplr(img_data)
+        # oriented image and its pyramid are cached with the image, unchanged orientation does not touch the array
+        rotation, flip = int(self.img_rotation.value), self.img_flip.value
+        img_data = image.pyramid(rotation, flip, offload=self.offload)
+        if not self.scheduler.is_current(generation):
+            return
 
         #self.debug(f"Rotation: {rotation}; Flip: {flip}")
 
         if self.bc is not None:
-            # show points if there is data to show
-            if len(self.point_storage) > 0:
-                # collect data from caption and symbol styles
-                sym_data = (self.sym_type.value, self.sym_size.value, self.sym_linesize.value, self.sym_linecolor.value, self.sym_bkgcolor.value,
-                            self.sym_visible.value)
+            bpoints = len(self.point_storage) > 0
+            if bpoints:
+                self._set_styles()
 
-                self.bc.set_symbol_style(*sym_data)
+            # masked pixels are shown as an overlay, the image is passed unchanged
+            mask = self.get_mask(image.shape)
+            mask = None if mask is None else mask.oriented(rotation, flip)
 
-                cap_data = (
-                self.cap_xoffset.value, self.cap_yoffset.value, self.cap_font.value, self.cap_fontsize.value,
-                self.cap_color.value, self.cap_bkgcolor.value, self.cap_visible.value)
+            # document callbacks read the state with the lock, all of it changes at once
+            with self.bc.lock:
+                # show points if there is data to show
+                if bpoints:
+                    self.bc.points = self.point_storage
+                    self.bc.points_diff = self.point_diff
+                    self.bc.orientation = Orientation(image.shape, rotation, flip)
 
-                self.bc.set_caption_style(*cap_data)
-                self.bc.points = self.point_storage
+                    self.bc.filter_captions = filter_captions
+                else:
+                    self.bc.points = []
 
-                self.bc.filter_captions = filter_captions
-            else:
-                self.bc.points = []
+                self.bc.mask = mask
 
             #self.debug("Sending data into a graph")
             #self.debug(f"Data added {img_data.shape}")
@@ -699,7 +1314,14 @@ class Starter:
             #self.debug(f"Min/Max: {imin}/{imax}")
             #self.debug(f"Colormap inversion: {binvert_colormap}")
 
-            self.bc.add_graph(np.copy(img_data), palette, imin, imax, binvert_colormap)
+            # the cached array is passed while the orientation is unchanged, pixels are not re-sent
+            self.bc.add_graph(img_data, palette, imin, imax, binvert_colormap, generation=generation,
+                              log_scale=blog)
+
+        # derived data of cached images grows as they are shown
+        self.images.trim()
+
+        self._schedule_output()
 
     def debug(self, msg):
         """
@@ -710,17 +1332,41 @@ class Starter:
         if not self.DEBUG:
             return
 
+        with self._output_lock:
+            self._output.append(msg)
+        self._schedule_output()
+
+    def _schedule_output(self):
+        """
+        Requests an update of the output and of the timings panel, requests are merged within DEBUG_INTERVAL
+        :return:
+        """
+        with self._output_lock:
+            if self._th_output is not None:
+                return
+            self._th_output = threading.Timer(self.DEBUG_INTERVAL, self._update_output)
+            self._th_output.daemon = True
+            self._th_output.start()
+
+    def _update_output(self):
+        """
+        Shows collected messages with a single widget update and refreshes the timings panel
+        :return:
+        """
+        with self._output_lock:
+            self._th_output = None
+            text = "".join([f"{el}\n" for el in self._output])
+
         if self.lbl_output is None:
             self.lbl_output = Output()
             display(self.lbl_output)    # kind of issue in jupyter+asyncio - it is safer to declare upon start
 
-        self._output.append(msg)
-        if len(self._output) > self.OUTPUT_LINES:
-            self._output.pop(0)
+        self.lbl_output.outputs = (dict(output_type="stream", name="stdout", text=text),)
 
-        self.clear_output_widget(self.lbl_output)
-        for tmsg in self._output:
-            self.lbl_output.append_stdout(tmsg+"\n")
+        version = TIMINGS.version
+        if self.lbl_timings is not None and version != self._timings_version:
+            self._timings_version = version
+            self.lbl_timings.value = f"<pre>{html.escape(TIMINGS.format_table())}</pre>"
 
     def clear_output_widget(self, widget):
         """
@@ -735,7 +1381,9 @@ class Starter:
         :param data:
         :return:
         """
-        data, min_value, max_value = data
+        # difference to the previous table if available
+        diff = data[3] if len(data) > 3 else None
+        data, min_value, max_value = data[:3]
 
         min_value, max_value = min(min_value, max_value), max(min_value, max_value)
 
@@ -744,8 +1392,11 @@ class Starter:
 
         # self.debug(f"Got data {(len(data), min_value, max_value)}")
 
-        if isinstance(data, list) or isinstance(data, tuple):
-            self.point_storage = copy.deepcopy(data)
+        if isinstance(data, PeakTable):
+            # tables are immutable, a snapshot is free
+            self.point_storage = data.snapshot()
+            self.point_diff = diff
+            self._update_groups(self.point_storage)
             # show the control when the data arrives
 
             if isinstance(self.range_peakintensity, FloatSlider):
@@ -0,0 +1,60 @@
+"""
+Compares the vectorized peak table parser with the former regex based path.
+Tables are generated by repeating example/example_data.txt
+
+    python -m benchmarks.bench_parser [rows ...]
+"""
+import os
+import re
+import sys
+import time
+
+from app.core.peaks import CrysalisPeak, parse_peak_table
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example", "example_data.txt")
+
+ROWS = (1000, 100000, 1000000)
+
+
+def make_table(rows):
+    """
+    Generates a peak table text of the given length
+    :param rows:
+    :return:
+    """
+    with open(EXAMPLE, "r") as fh:
+        lines = [el for el in fh.read().splitlines() if len(el.strip()) > 0]
+
+    res = (lines * (rows // len(lines) + 1))[:rows]
+    return "\n".join(res) + "\n"
+
+
+def parse_regex(text):
+    """
+    Former parsing path - regex findall and one CrysalisPeak object per row
+    :param text:
+    :return:
+    """
+    p = re.compile("^" + r"\s+([^\s]+)" * 11 + r"[\r\n\ \t]+$", re.I + re.MULTILINE)
+    return [CrysalisPeak(el) for el in p.findall(text)]
+
+
+def timeit(func, *args):
+    ts = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - ts, res
+
+
+def main(rows=ROWS):
+    print(f"{'rows':>10} {'regex, s':>10} {'vectorized, s':>14} {'speedup':>8}")
+    for n in rows:
+        text = make_table(n)
+        t_regex, peaks = timeit(parse_regex, text)
+        t_vec, (table, malformed) = timeit(parse_peak_table, text)
+
+        assert len(peaks) == len(table) and len(malformed) == 0
+        print(f"{n:>10} {t_regex:>10.3f} {t_vec:>14.3f} {t_regex / t_vec:>8.1f}")
+
+
+if __name__ == "__main__":
+    main([int(el) for el in sys.argv[1:]] or ROWS)
@@ -0,0 +1,322 @@
+"""
+Times the stages of the image and peak pipeline on synthetic data and compares the results with a saved baseline.
+Peak tables are generated by repeating example/example_data.txt, detector frames are synthetic TIFF files
+with a poisson background and gaussian peaks
+
+    python -m benchmarks.bench_pipeline --output results.json
+    python -m benchmarks.bench_pipeline --baseline baseline.json --tolerance 0.25
+    python -m benchmarks.bench_pipeline --quick
+
+Stages:
+    import    - import time of core and GUI modules in a fresh interpreter, numpy is the reference
+    parse     - CrysalisPeaksCW.preprocess() of a copied peak table
+    decode    - decoding of the uploaded file content as done by Starter.process_newfile()
+    stats     - image statistics used for the data range
+    orient    - rotation and flip of the image as done by Starter.reload_graph()
+    pyramid   - downsampled levels of the image
+    figure    - BokehCtrl._add_graph() building the figure with the image and peaks
+    update    - BokehCtrl._add_graph() for a changed color range, the figure exists
+    docsize   - bokeh document as sent to the browser, bytes
+
+The script exits with status 1 if any stage is slower (larger) than the baseline by more than the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+import fabio.tifimage
+
+from benchmarks.bench_parser import make_table
+
+ROWS = (1000, 10000, 100000, 1000000)
+SIZES = (1024, 2048, 4096)
+DTYPES = ("int32", "float32")
+FIGURE_ROWS = 10000     # peaks shown on figures of every frame size
+
+# modules timed on import, the core is expected to add well under 100 ms to numpy
+MODULES = ("numpy", "app.core.peaks", "app.core.images", "app.core.stack", "app.core.render",
+           "app.imports.clipboard", "app.bokeh.app_peaks", "app.starter.starter_peaks2image")
+
+REPEAT = 3
+TOLERANCE = 0.25        # allowed relative increase over the baseline
+MIN_TIME = 1e-3         # differences of times below this value in seconds are noise
+
+SEED = 1234
+
+
+def make_frame(size, dtype, peaks=500, seed=SEED):
+    """
+    Generates a detector frame - poisson background and gaussian Bragg peaks with a few saturated ones
+    :param size: width and height
+    :param dtype: "int32" or "float32"
+    :param peaks: number of peaks
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    res = rng.poisson(20., (size, size)).astype(np.float32)
+
+    # peaks are stamped as small gaussian spots
+    r = 4
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    spot = np.exp(-(dx ** 2 + dy ** 2) / 4.).astype(np.float32)
+    ys = rng.integers(r, size - r, peaks)
+    xs = rng.integers(r, size - r, peaks)
+    amplitudes = rng.lognormal(7., 1.5, peaks).astype(np.float32)
+    for x, y, a in zip(xs.tolist(), ys.tolist(), amplitudes.tolist()):
+        res[y - r:y + r + 1, x - r:x + r + 1] += a * spot
+
+    np.minimum(res, 2 ** 20, out=res)
+    return res.astype(dtype)
+
+
+def tif_content(data):
+    """
+    Encodes a frame as a TIFF file as it would be uploaded
+    :param data:
+    :return: bytes
+    """
+    fd, fn = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        fabio.tifimage.TifImage(data=data).write(fn)
+        with open(fn, "rb") as fh:
+            return fh.read()
+    finally:
+        os.remove(fn)
+
+
+def document_size(doc):
+    """
+    Size of a bokeh document as sent to the browser - json and binary buffers of arrays
+    :param doc:
+    :return: bytes
+    """
+    from bokeh.core.json_encoder import serialize_json
+
+    res = doc.to_json()
+    return len(serialize_json(res.content)) + sum([memoryview(el.data).nbytes for el in res.buffers or []])
+
+
+def timeit(func, repeat=REPEAT):
+    """
+    Returns the shortest time of several runs and the result of the last one
+    :param func: callable without arguments
+    :param repeat:
+    :return: (seconds, result)
+    """
+    best, res = None, None
+    for _ in range(max(1, repeat)):
+        ts = time.perf_counter()
+        res = func()
+        dt = time.perf_counter() - ts
+        best = dt if best is None else min(best, dt)
+    return best, res
+
+
+class Pipeline:
+    """
+    Runs the stages and collects results as {name: {"value": ..., "unit": ...}}
+    """
+
+    def __init__(self, repeat=REPEAT, report=print):
+        super(Pipeline, self).__init__()
+
+        self.repeat = repeat
+        self.report = report
+        self.results = {}
+
+    def add(self, name, value, unit="s"):
+        self.results[name] = dict(value=float(value), unit=unit)
+        if self.report is not None:
+            tvalue = f"{value * 1e3:10.2f} ms" if unit == "s" else f"{value:10.0f} {unit}"
+            self.report(f"{name:<32} {tvalue}")
+
+    def run_imports(self, modules=MODULES):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for name in modules:
+            code = f"import time; ts = time.perf_counter(); import {name}; print(time.perf_counter() - ts)"
+
+            best = None
+            for _ in range(max(1, self.repeat)):
+                out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True,
+                                     check=True).stdout
+                t = float(out.strip().splitlines()[-1])
+                best = t if best is None else min(best, t)
+            self.add(f"import/{name}", best)
+
+    def run_parse(self, rows):
+        from app.imports.clipboard import CrysalisPeaksCW
+
+        watchdog = CrysalisPeaksCW(source="memory")
+        for n in rows:
+            text = make_table(n)
+            t, res = timeit(lambda: watchdog.preprocess(text), self.repeat)
+            assert res is not None and len(res[0]) == n
+            self.add(f"parse/{n}", t)
+
+    def run_frame(self, size, dtype, table):
+        from app.core.stack import FrameStack
+        from app.core.images import LoadedImage
+        from app.core.stats import ImageStats
+        from app.core.pyramid import ImagePyramid
+
+        tag = f"{size}-{dtype}"
+        content = tif_content(make_frame(size, dtype))
+
+        def decode():
+            stack = FrameStack.from_content(content, filename="frame.tif", prefetch=0)
+            try:
+                return stack.get(0)
+            finally:
+                stack.close()
+
+        t, image = timeit(decode, self.repeat)
+        self.add(f"decode/{tag}", t)
+
+        t, _ = timeit(lambda: ImageStats(image.data), self.repeat)
+        self.add(f"stats/{tag}", t)
+
+        # a new image every run - oriented copies are cached on the image
+        t, data = timeit(lambda: LoadedImage(image.data).oriented(90, "H"), self.repeat)
+        self.add(f"orient/{tag}", t)
+
+        t, _ = timeit(lambda: ImagePyramid(data), self.repeat)
+        self.add(f"pyramid/{tag}", t)
+
+        self.run_figure(tag, data, table)
+
+    def run_figure(self, tag, data, table):
+        from bokeh.document import Document
+
+        import app.bokeh.app_peaks as ap
+
+        mean = float(np.mean(data, dtype=np.float64))
+
+        def render(doc, bc, maximum):
+            bc.add_graph(data, "Greys256", 0., maximum, True)
+            for cb in list(doc.callbacks.session_callbacks):
+                doc.remove_next_tick_callback(cb)
+                cb.callback()
+
+        def build():
+            doc = Document()
+            ap.bokeh_app(doc)
+            bc = ap.BokehCtrl.get_instance()
+            bc.set_symbol_style("circle", 10, 2, "rgba(255,255,255,0.9)", "rgba(255,255,255,0)", True)
+            bc.set_caption_style(5, 5, "Arial", "1em", "rgba(255,255,255,1)", "rgba(0,0,0,0.1)", True)
+            bc.points = table
+            bc.orientation = None
+            render(doc, bc, 3 * mean)
+            return doc, bc
+
+        t, (doc, bc) = timeit(build, self.repeat)
+        self.add(f"figure/{tag}", t)
+
+        t, _ = timeit(lambda: render(doc, bc, 2 * mean), self.repeat)
+        self.add(f"update/{tag}", t)
+
+        self.add(f"docsize/{tag}", document_size(doc), unit="bytes")
+
+    def run(self, rows=ROWS, sizes=SIZES, dtypes=DTYPES, figure_rows=FIGURE_ROWS):
+        from app.core.peaks import PeakTable
+
+        self.run_imports()
+        self.run_parse(rows)
+
+        table, _ = PeakTable.from_text(make_table(figure_rows))
+        for size in sizes:
+            for dtype in dtypes:
+                self.run_frame(size, dtype, table)
+        return self.results
+
+
+def environment():
+    """
+    Describes the machine, results are comparable only on the same one
+    :return:
+    """
+    import bokeh
+    import fabio
+
+    return dict(python=platform.python_version(), platform=platform.platform(), machine=platform.machine(),
+                cpus=os.cpu_count(), numpy=np.__version__, bokeh=bokeh.__version__, fabio=fabio.version,
+                date=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_time=MIN_TIME):
+    """
+    Compares results with a baseline
+    :param results: {name: {"value": ..., "unit": ...}}
+    :param baseline: the same layout
+    :param tolerance: allowed relative increase
+    :param min_time: smaller absolute increases of times are ignored
+    :return: list of (name, baseline value, new value, ratio, regression flag)
+    """
+    res = []
+    for name, el in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        value, tbase = el["value"], base["value"]
+        ratio = value / tbase if tbase > 0 else float("inf") if value > 0 else 1.
+        bregression = ratio > 1. + tolerance
+        if el.get("unit") == "s" and value - tbase < min_time:
+            bregression = False
+        res.append((name, tbase, value, ratio, bregression))
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the image and peak pipeline")
+    parser.add_argument("-o", "--output", help="json file for the results")
+    parser.add_argument("-b", "--baseline", help="json file with results to compare with")
+    parser.add_argument("-t", "--tolerance", type=float, default=TOLERANCE,
+                        help=f"allowed relative increase over the baseline (default {TOLERANCE})")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT, help=f"runs of every stage (default {REPEAT})")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(ROWS), help="sizes of peak tables")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="sizes of frames")
+    parser.add_argument("--dtypes", nargs="+", default=list(DTYPES), help="data types of frames")
+    parser.add_argument("--quick", action="store_true", help="smallest table and frame only")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.rows, args.sizes, args.dtypes = args.rows[:1], args.sizes[:1], args.dtypes[:1]
+
+    pipeline = Pipeline(repeat=args.repeat)
+    results = pipeline.run(rows=args.rows, sizes=args.sizes, dtypes=args.dtypes,
+                           figure_rows=min(FIGURE_ROWS, max(args.rows)))
+
+    doc = dict(environment=environment(), repeat=args.repeat, results=results)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(doc, fh, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, "r") as fh:
+        baseline = json.load(fh)
+
+    if baseline.get("environment", {}).get("platform") != doc["environment"]["platform"]:
+        print("Warning: the baseline was recorded on a different platform")
+
+    regressions = 0
+    print(f"\n{'stage':<32} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, base, value, ratio, bregression in compare(results, baseline.get("results", {}), args.tolerance):
+        regressions += int(bregression)
+        print(f"{name:<32} {base:>12.4g} {value:>12.4g} {ratio:>7.2f}{'  REGRESSION' if bregression else ''}")
+
+    print(f"{regressions} regressions, tolerance {args.tolerance:.0%}")
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import os
+
+import pytest
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example", "example_data.txt")
+
+
+@pytest.fixture(scope="session")
+def example_text():
+    with open(EXAMPLE, "r") as fh:
+        return fh.read()
@@ -0,0 +1,120 @@
+import numpy as np
+
+from bokeh.document import Document
+from bokeh.models import ColumnDataSource
+
+import app.bokeh.app_peaks as ap
+
+
+def run_callbacks(doc):
+    for cb in list(doc.callbacks.session_callbacks):
+        doc.remove_next_tick_callback(cb)
+        cb.callback()
+
+
+def make_ctrl():
+    doc = Document()
+    ap.bokeh_app(doc)
+    return doc, ap.BokehCtrl.get_instance()
+
+
+def render(doc, bc, data, mask=None):
+    bc.mask = mask
+    bc.add_graph(data, "Greys256", 0., 10., False, generation=1)
+    run_callbacks(doc)
+
+
+def test_mask_cleared_by_unmasked_image():
+    doc, bc = make_ctrl()
+
+    first = np.ones((512, 512), dtype=np.float32)
+    mask = np.zeros(first.shape, dtype=bool)
+    mask[:10, :10] = True
+    render(doc, bc, first, mask)
+    assert len(bc.mask_source.data["image"]) == 1
+
+    render(doc, bc, np.ones((512, 512), dtype=np.float32) * 2)
+    assert bc.mask_pyramid is None
+    assert len(bc.mask_source.data["image"]) == 0
+    assert len(bc.mask_source.data["dw"]) == 0
+
+
+def test_mask_follows_new_image():
+    doc, bc = make_ctrl()
+
+    mask = np.zeros((256, 256), dtype=bool)
+    render(doc, bc, np.ones((256, 256), dtype=np.float32), mask)
+    old = bc.mask_pyramid
+
+    render(doc, bc, np.ones((256, 256), dtype=np.float32), mask.copy())
+    assert bc.mask_pyramid is not old
+    assert len(bc.mask_source.data["image"]) == 1
+
+
+def live_columns(bc):
+    """
+    Rows of the point source holding peaks, ordered by the peak index
+    """
+    live = np.flatnonzero(~bc._pts_free)
+    live = live[np.argsort(bc._pts_rows[live])]
+    data = bc.pts_source.data
+    return {k: [data[k][i] for i in live.tolist()] for k in ("x", "y", "names", "intensity", "group")}
+
+
+def test_points_patched_in_place(example_text, monkeypatch):
+    from app.core.peaks import PeakTable
+
+    doc, bc = make_ctrl()
+    image = np.ones((1024, 1024), dtype=np.float32)
+
+    table, _ = PeakTable.from_text(example_text)
+    bc.add_points(table)
+    render(doc, bc, image)
+    assert len(bc.pts_source.data["x"]) == len(table)
+
+    calls = {"set": 0, "patch": 0, "stream": 0}
+
+    def counted(name, func):
+        def wrapper(self, *args, **kwargs):
+            if self is bc or self is bc.pts_source:
+                calls[name] += 1
+            return func(self, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(ap.BokehCtrl, "_set_points", counted("set", ap.BokehCtrl._set_points))
+    monkeypatch.setattr(ColumnDataSource, "patch", counted("patch", ColumnDataSource.patch))
+    monkeypatch.setattr(ColumnDataSource, "stream", counted("stream", ColumnDataSource.stream))
+
+    rng = np.random.default_rng(6)
+    source, next_index = bc.pts_source, int(table["index"].max()) + 1
+    for _ in range(40):
+        data = table.data.copy()
+
+        # edited, removed and added peaks
+        edit = rng.choice(len(data), int(rng.integers(0, 10)), replace=False)
+        data["intensity"][edit] += rng.uniform(1., 100., len(edit))
+        data["detx"][edit] += rng.integers(-3, 4, len(edit))
+        keep = np.ones(len(data), dtype=bool)
+        keep[rng.choice(len(data), int(rng.integers(0, 15)), replace=False)] = False
+        added = data[rng.choice(len(data), int(rng.integers(0, 15)), replace=False)].copy()
+        added["index"] = np.arange(len(added)) + next_index
+        next_index += len(added)
+        data = np.concatenate([data[keep], added])
+        rng.shuffle(data)
+
+        table = PeakTable(data)
+        bc.add_points(table)
+        render(doc, bc, image)
+
+        expected = table[np.argsort(table["index"], kind="stable")].columns()
+        res = live_columns(bc)
+        assert np.array_equal(res["x"], expected["x"]) and np.array_equal(res["y"], expected["y"])
+        assert np.array_equal(res["intensity"], expected["intensity"])
+        assert res["names"] == expected["names"] and res["group"] == expected["group"]
+
+        # rows of removed peaks are hidden
+        free = np.flatnonzero(bc._pts_free)
+        assert np.isnan(np.asarray(bc.pts_source.data["x"])[free]).all()
+
+    assert bc.pts_source is source
+    assert calls["set"] == 0 and calls["patch"] > 0 and calls["stream"] > 0
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from app.core.autoscale import IntensityHistogram, autoscale, PRESETS
+
+
+def make_frame(seed=8, shape=(700, 900), dtype=np.float64):
+    rng = np.random.default_rng(seed)
+    data = rng.poisson(30, shape).astype(dtype)
+
+    # bright peaks and the gaps between detector modules
+    ys, xs = rng.integers(0, shape[0], 200), rng.integers(0, shape[1], 200)
+    data[ys, xs] += rng.exponential(5e4, 200).astype(dtype)
+    data[:, 300:310] = 0
+    data[400:405, :] = -1
+    return data
+
+
+def bin_width(hist, value):
+    i = np.clip(np.searchsorted(hist.bin_edges, value) - 1, 0, hist.bins - 1)
+    return hist.bin_edges[i + 1] - hist.bin_edges[i]
+
+
+def test_refine_counts_every_valid_pixel():
+    data = make_frame()
+    data[10:20, 10:20] = np.nan
+    data[30, 30] = np.inf
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[100:150, :] = True
+
+    hist = IntensityHistogram(data, mask=mask, max_samples=10000)
+    assert not hist.is_complete and hist.count < data.size
+
+    assert not hist.refine(steps=1)
+    assert hist.refine()
+    assert hist.is_complete and hist.fraction == 1.
+
+    valid = np.isfinite(data) & ~mask
+    assert hist.count == valid.sum()
+    assert hist.counts.sum() == hist.count
+    assert hist.mean == pytest.approx(data[valid].mean())
+    assert (hist.min, hist.max) == (data[valid].min(), data[valid].max())
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.int32])
+def test_percentiles_within_a_bin(dtype):
+    data = make_frame(dtype=dtype)
+    hist = IntensityHistogram(data, max_samples=20000)
+    hist.refine()
+
+    for q in (1., 10., 50., 90., 99., 99.9):
+        expected = np.percentile(data, q)
+        assert abs(hist.percentile(q) - expected) <= bin_width(hist, expected)
+
+    res = hist.percentile([5., 95.])
+    assert res.shape == (2,) and res[0] <= res[1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_log_preset_is_positive(seed):
+    rng = np.random.default_rng(seed)
+    data = make_frame(seed=seed)
+
+    # mostly empty frames with gaps - the mode and the median are not positive
+    sparse = np.zeros((300, 300))
+    sparse[::7, ::5] = rng.poisson(3, sparse[::7, ::5].shape)
+    sparse[:, :20] = -2
+
+    for frame in (data, sparse, np.zeros((50, 50)), -np.ones((50, 50))):
+        hist = IntensityHistogram(frame, max_samples=5000)
+        for steps in (0, None):
+            if steps is None:
+                hist.refine()
+            lo, hi, blog = autoscale(hist, "log")
+            assert blog and 0 < lo < hi
+
+
+def test_presets():
+    hist = IntensityHistogram(make_frame(), max_samples=20000)
+    for preset in PRESETS:
+        lo, hi, blog = autoscale(hist, preset)
+        assert lo < hi
+
+    with pytest.raises(ValueError):
+        autoscale(hist, "unknown")
@@ -0,0 +1,110 @@
+import threading
+
+from app.imports.clipboard import CrysalisPeaksCW
+from app.imports.sources import PeakSource
+
+
+class Parent:
+    def __init__(self):
+        self.received = []
+        self.event = threading.Event()
+
+    def debug(self, msg):
+        pass
+
+    def process_cbdata(self, data):
+        self.received.append(data)
+        self.event.set()
+
+
+def change_intensity(text, row, value):
+    lines = text.splitlines()
+    cols = lines[row].split()
+    cols[7] = str(value)
+    lines[row] = "  ".join(cols)
+    return "\n".join(lines) + "\n"
+
+
+def test_memory_source_delivers_table_and_diff(example_text):
+    parent = Parent()
+    watchdog = CrysalisPeaksCW(parent=parent, source="memory")
+    watchdog.DELAY = 0.05
+    watchdog.start_polling()
+    try:
+        watchdog.source.push(example_text)
+        assert parent.event.wait(5.)
+        table, imin, imax, diff = parent.received[0]
+        assert len(table) == 1499
+        assert diff is None
+        assert (imin, imax) == table.intensity_range()
+
+        parent.event.clear()
+        watchdog.source.push(change_intensity(example_text, 10, 12345))
+        assert parent.event.wait(5.)
+        diff = parent.received[1][3]
+        assert len(diff.changed) == 1 and len(diff.added) == 0 and len(diff.removed) == 0
+        assert diff.changed["index"][0] == 11
+        assert diff.changed["intensity"][0] == 12345
+    finally:
+        watchdog.stop_polling()
+
+
+def test_unchanged_fingerprint_is_ignored(example_text):
+    parent = Parent()
+    watchdog = CrysalisPeaksCW(parent=parent, source="memory")
+
+    watchdog.process_data(example_text)
+    watchdog.process_data(example_text)
+    assert len(parent.received) == 1
+
+
+def test_empty_diff_is_ignored(example_text):
+    parent = Parent()
+    watchdog = CrysalisPeaksCW(parent=parent, source="memory")
+
+    watchdog.process_data(example_text)
+
+    # different text, the same peaks
+    reformatted = "\n".join(["\t".join(el.split()) for el in example_text.splitlines()])
+    watchdog.process_data(reformatted)
+    assert watchdog.data == reformatted
+    assert len(parent.received) == 1
+
+
+class PolledSource(PeakSource):
+    """
+    Polled source returning new content on selected cycles
+    """
+
+    def __init__(self, contents):
+        super(PolledSource, self).__init__()
+        self.contents = contents
+        self.cycle = 0
+
+    def read(self, timeout=None):
+        res = self.contents.get(self.cycle)
+        self.cycle += 1
+        return res
+
+
+def test_idle_backoff(example_text):
+    watchdog = CrysalisPeaksCW(source=PolledSource({4: example_text}))
+
+    delays = []
+
+    def wait_quit(timeout):
+        delays.append(timeout)
+        return len(delays) >= 9
+
+    watchdog.wait_quit = wait_quit
+    watchdog._track_clipboard()
+
+    d, b, m = watchdog.DELAY, watchdog.BACKOFF, watchdog.MAX_DELAY
+    expected = [min(m, d * b), min(m, d * b ** 2), min(m, d * b ** 3), min(m, d * b ** 4),
+                d, min(m, d * b), min(m, d * b ** 2), min(m, d * b ** 3), min(m, d * b ** 4)]
+
+    # the measured cycle time is subtracted from the delay
+    assert len(delays) == len(expected)
+    for a, e in zip(delays, expected):
+        assert e - 0.5 < a <= e
+    assert delays[4] < delays[3]
@@ -0,0 +1,95 @@
+import numpy as np
+
+from app.core.declutter import LabelDeclutter, font_size_px
+
+FONT_SIZE = 12.
+SCREEN = (800, 600)
+
+
+def make_layout(rng, n):
+    x = rng.uniform(-50, 1050, n)
+    y = rng.uniform(-50, 1050, n)
+    if rng.random() < 0.5:
+        # clustered peaks
+        x[:n // 2] = rng.normal(rng.uniform(0, 1000), 20, n // 2)
+        y[:n // 2] = rng.normal(rng.uniform(0, 1000), 20, n // 2)
+    priority = rng.exponential(100., n)
+    names = [f"{int(h)} {int(k)} {int(l)}" for h, k, l in rng.integers(-20, 20, (n, 3))]
+    return x, y, priority, names
+
+
+def boxes(x, y, names, viewport, xoffset=5, yoffset=5):
+    x0, x1, y0, y1 = viewport
+    sx = (np.asarray(x) - x0) * (SCREEN[0] / (x1 - x0)) + xoffset
+    sy = (np.asarray(y) - y0) * (SCREEN[1] / (y1 - y0)) + yoffset
+    widths = np.array([len(el) for el in names]) * FONT_SIZE * LabelDeclutter.CHAR_WIDTH
+    return sx, sy, widths, FONT_SIZE * 1.2
+
+
+def select(declutter, viewport, max_labels=None):
+    return declutter.select(*viewport, *SCREEN, font_size=FONT_SIZE, xoffset=5, yoffset=5, max_labels=max_labels)
+
+
+def test_selected_labels_do_not_overlap():
+    rng = np.random.default_rng(4)
+
+    for _ in range(200):
+        x, y, priority, names = make_layout(rng, int(rng.integers(1, 800)))
+        x0, y0 = rng.uniform(-100, 600, 2)
+        viewport = (x0, x0 + rng.uniform(50, 1000), y0, y0 + rng.uniform(50, 1000))
+
+        res = select(LabelDeclutter(x, y, priority, names), viewport)
+        assert len(set(res.tolist())) == len(res)
+
+        sx, sy, widths, height = boxes(x, y, names, viewport)
+
+        # the best visible label is always shown
+        visible = np.flatnonzero((sx + widths > 0) & (sx < SCREEN[0]) & (sy + height > 0) & (sy < SCREEN[1]))
+        if len(visible) > 0:
+            assert visible[np.argmax(priority[visible])] in res.tolist()
+
+        sx, sy, widths = sx[res], sy[res], widths[res]
+        overlap = (sx[:, None] < sx[None, :] + widths[None, :]) & (sx[None, :] < sx[:, None] + widths[:, None]) & \
+                  (sy[:, None] < sy[None, :] + height) & (sy[None, :] < sy[:, None] + height)
+        np.fill_diagonal(overlap, False)
+        assert not overlap.any()
+
+
+def test_max_labels():
+    rng = np.random.default_rng(5)
+    x, y, priority, names = make_layout(rng, 2000)
+    declutter = LabelDeclutter(x, y, priority, names)
+    viewport = (0, 1000, 0, 1000)
+
+    assert len(select(declutter, viewport, max_labels=10)) == 10
+    assert len(select(declutter, viewport, max_labels=1)) == 1
+    assert len(select(declutter, viewport)) <= LabelDeclutter.MAX_LABELS
+
+    # the limit takes the labels of the highest priority
+    res = select(declutter, viewport, max_labels=5)
+    assert np.array_equal(res, select(declutter, viewport, max_labels=50)[:5])
+
+
+def test_uncontested_label_is_selected():
+    # an isolated weak label next to a contested group of strong ones
+    x = [100., 101., 102., 600.]
+    y = [100., 100.5, 101., 400.]
+    priority = [50., 40., 30., 1.]
+    names = ["1 2 3", "4 5 6", "7 8 9", "0 0 1"]
+
+    res = select(LabelDeclutter(x, y, priority, names), (0, 800, 0, 600)).tolist()
+    assert 0 in res and 3 in res
+    assert 1 not in res and 2 not in res
+
+
+def test_invalid_labels_skipped():
+    declutter = LabelDeclutter([np.nan, 10., 20.], [5., 5., np.inf], [3., 2., 1.], ["a", "", "c"])
+    assert len(declutter) == 0
+    assert len(select(declutter, (0, 100, 0, 100))) == 0
+
+
+def test_font_size_px():
+    assert font_size_px("12px") == 12.
+    assert font_size_px("1em") == 16.
+    assert font_size_px("9pt") == 12.
+    assert font_size_px("large") == 16.
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ("fabio", "bokeh", "ipywidgets", "IPython")
+
+
+def loaded_modules(statement):
+    """
+    Heavy modules loaded by a statement in a fresh interpreter
+    :param statement:
+    :return:
+    """
+    code = f"import sys; {statement}; print(','.join(sorted(set([el.split('.')[0] for el in sys.modules]))))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return [el for el in out.strip().split(",") if el in HEAVY]
+
+
+@pytest.mark.parametrize("statement", [
+    "from app.imports import *",
+    "import app.core.images, app.core.stack, app.core.projection, app.core.masks, app.core.render",
+    "import app.imports.clipboard",
+])
+def test_core_import_is_light(statement):
+    assert loaded_modules(statement) == []
+
+
+def test_lazy_name_is_loaded_on_access():
+    assert loaded_modules("import app.imports as m; m.fabio") == ["fabio"]
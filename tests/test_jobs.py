@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from app.bokeh.jobs import JobQueue, JobCancelled
+
+TIMEOUT = 5.
+
+
+def test_new_job_of_a_group_cancels_the_older():
+    queue = JobQueue(workers=2)
+    started, release = threading.Event(), threading.Event()
+    stages = []
+
+    def load(name, job=None):
+        stages.append((name, "decode"))
+        if name == "first":
+            started.set()
+            assert release.wait(TIMEOUT)
+        # stage boundary
+        job.check()
+        stages.append((name, "commit"))
+        return name
+
+    try:
+        first = queue.submit(load, "first", group="load")
+        assert started.wait(TIMEOUT)
+        second = queue.submit(load, "second", group="load")
+        assert first.cancelled and not second.cancelled
+
+        with pytest.raises(JobCancelled):
+            first.check()
+
+        release.set()
+        assert first.future.result(TIMEOUT) is None
+        assert second.future.result(TIMEOUT) == "second"
+        assert ("first", "commit") not in stages and ("second", "commit") in stages
+    finally:
+        release.set()
+        queue.shutdown(wait=True)
+
+
+def test_queued_job_does_not_run():
+    queue = JobQueue(workers=1)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def block(job=None):
+        started.set()
+        assert release.wait(TIMEOUT)
+
+    def work(name, job=None):
+        calls.append(name)
+
+    try:
+        blocker = queue.submit(block)
+        assert started.wait(TIMEOUT)
+
+        # the only worker is busy, both jobs wait in the queue
+        queued = queue.submit(work, "queued", group="load")
+        latest = queue.submit(work, "latest", group="load")
+        assert queued.future.cancelled()
+
+        release.set()
+        latest.future.result(TIMEOUT)
+        blocker.future.result(TIMEOUT)
+        assert calls == ["latest"]
+        assert queue.active == []
+    finally:
+        release.set()
+        queue.shutdown(wait=True)
+
+
+def test_is_latest_per_group():
+    queue = JobQueue(workers=1)
+    try:
+        a1 = queue.submit(lambda job=None: None, group="a")
+        b1 = queue.submit(lambda job=None: None, group="b")
+        assert queue.is_latest(a1) and queue.is_latest(b1)
+
+        a2 = queue.submit(lambda job=None: None, group="a")
+        assert a2.id > a1.id
+        assert queue.is_latest(a2) and not queue.is_latest(a1)
+        assert queue.is_latest(b1) and not b1.cancelled
+    finally:
+        queue.shutdown(wait=True)
+
+
+def test_cancel_all_and_shutdown():
+    queue = JobQueue(workers=1)
+    started, release = threading.Event(), threading.Event()
+
+    def block(job=None):
+        started.set()
+        assert release.wait(TIMEOUT)
+        job.check()
+
+    job = queue.submit(block, group="load")
+    other = queue.submit(block, group="render")
+    assert started.wait(TIMEOUT)
+
+    queue.cancel()
+    assert job.cancelled and other.cancelled
+    release.set()
+    queue.shutdown(wait=True)
+    assert queue.active == []
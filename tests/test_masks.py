@@ -0,0 +1,52 @@
+import numpy as np
+
+from app.core.masks import detect_hot_pixels
+
+
+def make_background(shape=(200, 300), seed=7):
+    rng = np.random.default_rng(seed)
+    return rng.poisson(50, shape).astype(np.float64)
+
+
+def add_spot(data, y, x, amplitude, width=1.):
+    r = 4
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    data[y - r:y + r + 1, x - r:x + r + 1] += amplitude * np.exp(-(dx ** 2 + dy ** 2) / (2 * width ** 2))
+
+
+def test_spike_is_hot_and_peak_survives():
+    data = make_background()
+    add_spot(data, 50, 60, 20000.)
+    add_spot(data, 120, 200, 5000., width=0.8)
+    data[150, 40] += 20000.
+    data[20, 250] += 3000.
+
+    hot = detect_hot_pixels(data.astype(np.int32), nsigma=10.)
+
+    assert hot[150, 40] and hot[20, 250]
+    assert not hot[45:56, 55:66].any()
+    assert not hot[115:126, 195:206].any()
+    assert hot.sum() == 2
+
+
+def test_spikes_across_chunks():
+    data = make_background()
+    spikes = [(2, 150), (3, 170), (5, 40), (6, 60), (100, 3)]
+    for y, x in spikes:
+        data[y, x] += 10000.
+
+    # chunks of 3 rows, the neighbourhood and the background ring reach into the next chunks
+    hot = detect_hot_pixels(data, nsigma=10., chunk_size=900)
+    assert sorted(zip(*np.nonzero(hot))) == sorted(spikes)
+
+
+def test_threshold_and_mask():
+    data = make_background()
+    data[10, 10] = 1e6
+
+    mask = np.zeros(data.shape, dtype=bool)
+    assert detect_hot_pixels(data, threshold=1e5)[10, 10]
+
+    mask[10, 10] = True
+    assert not detect_hot_pixels(data, threshold=1e5, mask=mask).any()
+
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from app.core.images import LoadedImage
+from app.core.masks import DetectorMask
+from app.core.offload import OffloadEngine
+
+
+@pytest.fixture(scope="module")
+def engine():
+    res = OffloadEngine(workers=1)
+    yield res
+    res.close()
+
+
+def make_data():
+    rng = np.random.default_rng(1)
+    return rng.poisson(20, (301, 257)).astype(np.int32)
+
+
+@pytest.mark.parametrize("rotation,flip", [(0, "None"), (90, "H"), (180, "V"), (270, "None")])
+def test_pyramid_matches_local(engine, rotation, flip):
+    data = make_data()
+    local = LoadedImage(data.copy()).pyramid(rotation, flip)
+
+    image = LoadedImage(data.copy())
+    shared = image.pyramid(rotation, flip, offload=engine)
+
+    assert len(local.levels) == len(shared.levels)
+    for a, b in zip(local.levels, shared.levels):
+        assert np.array_equal(a, b)
+
+    # cached - the same object is returned without the worker
+    assert image.pyramid(rotation, flip, offload=engine) is shared
+    assert np.array_equal(image.oriented(rotation, flip), local.levels[0])
+
+
+def test_stats_match_local(engine):
+    data = make_data()
+    mask = DetectorMask(data.shape)
+    mask.data[:50] = True
+
+    local = LoadedImage(data.copy())
+    image = LoadedImage(data.copy())
+
+    for a, b in ((local.stats, image.full_stats(engine)),
+                 (local.masked_stats(mask), image.masked_stats(mask, offload=engine))):
+        assert (a.size, a.min, a.max, a.mean) == (b.size, b.min, b.max, b.mean)
+        assert a.below_mean == pytest.approx(b.below_mean)
+        assert np.array_equal(a.histogram, b.histogram)
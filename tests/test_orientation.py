@@ -0,0 +1,32 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from app.core.orientation import Orientation, OrientationCache
+
+
+@pytest.mark.parametrize("rotation, flip", list(itertools.product(Orientation.ROTATIONS, Orientation.FLIPS)))
+def test_points_follow_the_image(rotation, flip):
+    ny, nx = 5, 7
+    data = np.arange(ny * nx).reshape(ny, nx)
+    orientation = Orientation(data.shape, rotation, flip)
+    image = orientation.apply_image(data)
+    assert image.shape == orientation.shape
+
+    # pixel centres land on the pixel holding the same value
+    row, col = np.mgrid[:ny, :nx]
+    x, y = orientation.apply_points(col.ravel() + 0.5, row.ravel() + 0.5)
+    assert np.array_equal(image[np.floor(y).astype(int), np.floor(x).astype(int)], data.ravel())
+
+    bx, by = orientation.invert_points(x, y)
+    assert np.allclose(bx, col.ravel() + 0.5) and np.allclose(by, row.ravel() + 0.5)
+
+
+def test_equivalent_orientations_share_the_copy():
+    data = np.arange(12).reshape(3, 4)
+    cache = OrientationCache(data)
+
+    assert cache.get(0, "None") is data
+    assert cache.get(180, "H") is cache.get(0, "V")
+    assert cache.peek(90, "None") is None
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from app.core.peaks import PeakTable, PEAK_DTYPE, parse_peak_table
+
+
+def brute_force_diff(new, old):
+    """
+    Reference difference of two tables by peak index
+    :return: (added indices, removed indices, changed indices)
+    """
+    new_rows = {int(el["index"]): el.tolist() for el in new.data}
+    old_rows = {int(el["index"]): el.tolist() for el in old.data}
+
+    added = sorted(set(new_rows) - set(old_rows))
+    removed = sorted(set(old_rows) - set(new_rows))
+    changed = sorted([k for k in set(new_rows) & set(old_rows) if new_rows[k] != old_rows[k]])
+    return added, removed, changed
+
+
+def test_parse_example(example_text):
+    table, malformed = PeakTable.from_text(example_text)
+
+    assert len(table) == 1499
+    assert malformed == []
+    assert table["index"][0] == 1
+    assert table["detx"][0] == 195 and table["dety"][0] == 547
+    assert table.groups() == ["g1"]
+
+
+def test_parse_malformed_line(example_text):
+    lines = example_text.splitlines()
+    lines.insert(5, "   6   this line is not a peak")
+    lines.insert(0, "Peak table header")
+
+    data, malformed = parse_peak_table("\n".join(lines))
+
+    assert len(data) == 1499
+    assert [el[0] for el in malformed] == [1, 7]
+    assert malformed[1][1].strip().startswith("6   this")
+
+
+def test_groups():
+    text = "\n".join([
+        f"{i + 1} 1 2 3 {10 * i} {20 * i} 1.5 {100 * i} i g{1 + i % 3} 1" for i in range(9)
+    ])
+    table, _ = PeakTable.from_text(text)
+    assert table.groups() == ["g1", "g2", "g3"]
+    assert table.columns()["group"][:3] == ["g1", "g2", "g3"]
+
+
+def test_caller_array_stays_writeable():
+    data = np.zeros(3, dtype=PEAK_DTYPE)
+    table = PeakTable(data)
+
+    data["intensity"][0] = 5.
+    assert not table.data.flags.writeable
+    with pytest.raises(ValueError):
+        table.data["intensity"][0] = 1.
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_diff_matches_brute_force(example_text, seed):
+    rng = np.random.default_rng(seed)
+    old, _ = PeakTable.from_text(example_text)
+
+    data = old.data.copy()
+    data["intensity"][rng.choice(len(data), 20, replace=False)] += 1.
+    data["indexing"][rng.choice(len(data), 5, replace=False)] = "s"
+
+    # removed rows and new rows with fresh indices
+    keep = np.ones(len(data), dtype=bool)
+    keep[rng.choice(len(data), 30, replace=False)] = False
+    extra = data[:10].copy()
+    extra["index"] = np.arange(10) + 10000
+    data = np.concatenate([data[keep], extra])
+    rng.shuffle(data)
+
+    new = PeakTable(data)
+    diff = new.diff(old)
+    added, removed, changed = brute_force_diff(new, old)
+
+    assert sorted(diff.added["index"].tolist()) == added
+    assert sorted(diff.removed.tolist()) == removed
+    assert sorted(diff.changed["index"].tolist()) == changed
+    assert len(diff) == len(added) + len(removed) + len(changed)
+
+
+def test_diff_identical_and_duplicate_keys(example_text):
+    table, _ = PeakTable.from_text(example_text)
+    assert table.diff(PeakTable(table.data.copy())).is_empty
+
+    data = table.data.copy()
+    data["index"][1] = data["index"][0]
+    assert PeakTable(data).diff(table) is None
+
+
+def test_indexing_and_intensity_masks():
+    data = np.zeros(4, dtype=PEAK_DTYPE)
+    data["index"] = np.arange(1, 5)
+    data["indexing"] = ["i", "s", "W", "ws"]
+    data["intensity"] = [10., 20., 30., 40.]
+    table = PeakTable(data)
+
+    assert table.skipped_mask().tolist() == [False, True, False, True]
+    assert table.wrong_mask().tolist() == [False, False, True, True]
+    assert table.bad_mask().tolist() == [False, True, True, True]
+    assert table.intensity_mask(20.).tolist() == [False, False, True, True]
+    assert table.intensity_mask(None).all()
+    assert len(table[table.bad_mask()]) == 3
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+import fabio.tifimage
+
+from app.core.projection import ProjectionEngine, reduce_frames, _merge
+from app.core.stack import FrameStack
+
+REFERENCE = {"sum": np.sum, "max": np.max, "mean": np.mean}
+
+
+def make_frames(n=12, shape=(40, 30)):
+    rng = np.random.default_rng(3)
+    return [rng.poisson(10, shape).astype(np.int32) for _ in range(n)]
+
+
+@pytest.mark.parametrize("operator", ["sum", "max"])
+def test_reduce_and_merge(operator):
+    frames = make_frames()
+
+    acc, count = reduce_frames(frames, operator)
+    assert count == len(frames)
+    assert np.array_equal(acc, REFERENCE[operator](np.stack(frames), axis=0))
+
+    # partial reductions merged in any order give the same result
+    parts = [reduce_frames(frames[a:b], operator) for a, b in ((5, 12), (0, 2), (2, 5))]
+    res = (None, 0)
+    for el in parts:
+        res = _merge(res, el, operator)
+    assert res[1] == len(frames)
+    assert np.array_equal(res[0], acc)
+
+
+@pytest.fixture(scope="module")
+def series(tmp_path_factory):
+    path = tmp_path_factory.mktemp("series")
+    frames = make_frames()
+    filenames = []
+    for i, el in enumerate(frames):
+        fn = os.path.join(str(path), f"frame_{i:03d}.tif")
+        fabio.tifimage.TifImage(data=el).write(fn)
+        filenames.append(fn)
+
+    stack = FrameStack.from_series(filenames, prefetch=0)
+    yield frames, stack
+    stack.close()
+
+
+@pytest.fixture(scope="module")
+def engine():
+    res = ProjectionEngine(workers=2)
+    res.MIN_PARALLEL = 2
+    yield res
+    res.close()
+
+
+@pytest.mark.parametrize("operator", ["sum", "max", "mean"])
+@pytest.mark.parametrize("start,stop", [(0, 12), (3, 10)])
+def test_parallel_projection(series, engine, operator, start, stop):
+    frames, stack = series
+
+    image = engine.project(stack, start, stop, operator)
+    expected = REFERENCE[operator](np.stack(frames[start:stop]), axis=0)
+    assert np.allclose(image.data, expected)
+    assert engine._pool is not None
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from app.core.pyramid import ImagePyramid
+
+
+@pytest.mark.parametrize("shape", [(1001, 1535), (257, 256), (3, 999), (100, 100)])
+def test_level_shapes(shape):
+    data = np.random.default_rng(1).random(shape)
+    pyramid = ImagePyramid(data, min_size=64)
+
+    assert [el.shape for el in pyramid.levels[1:]] == ImagePyramid.level_shapes(shape, min_size=64)
+    assert max(pyramid.levels[-1].shape) <= 64
+
+    # max pooling keeps the brightest pixel on every level
+    for el in pyramid.levels:
+        assert el.max() == data.max()
+
+
+def test_single_peak_survives():
+    data = np.zeros((517, 333), dtype=np.int32)
+    data[401, 17] = 1000
+
+    for el in ImagePyramid(data, min_size=16).levels:
+        assert el.max() == 1000
+
+
+def test_tile_and_covers():
+    rng = np.random.default_rng(2)
+    ny, nx = 1001, 1535
+    pyramid = ImagePyramid(rng.random((ny, nx)), min_size=100)
+
+    for _ in range(2000):
+        x0, x1 = rng.uniform(-800, nx + 800, 2)
+        y0, y1 = rng.uniform(-800, ny + 800, 2)
+        sw, sh = rng.integers(100, 800, 2)
+
+        level, data, x, y, dw, dh = pyramid.tile(x0, x1, y0, y1, sw, sh)
+        s = 2 ** level
+        assert x % s == 0 and y % s == 0
+        assert np.array_equal(data, pyramid.levels[level][y // s:(y + dh) // s, x // s:(x + dw) // s])
+
+        assert pyramid.covers((level, x, y, dw, dh), x0, x1, y0, y1, sw, sh)
+
+
+def test_covers_rejects_other_level_and_position():
+    pyramid = ImagePyramid(np.zeros((1024, 1024)), min_size=128)
+
+    level, data, x, y, dw, dh = pyramid.tile(0, 1024, 0, 1024, 256, 256)
+    assert level == 2
+    tile = (level, x, y, dw, dh)
+
+    # zoomed in - more detail is needed
+    assert not pyramid.covers(tile, 0, 256, 0, 256, 256, 256)
+
+    level, data, x, y, dw, dh = pyramid.tile(0, 100, 0, 100, 400, 400)
+    tile = (level, x, y, dw, dh)
+    assert level == 0 and pyramid.covers(tile, 20, 120, 10, 110, 400, 400)
+    assert not pyramid.covers(tile, 500, 600, 500, 600, 400, 400)
+
+
+def test_select_level():
+    pyramid = ImagePyramid(np.zeros((4096, 4096)), min_size=256)
+    assert len(pyramid.levels) == 5
+    assert pyramid.select_level(1000, 1000, 1000, 1000) == 0
+    assert pyramid.select_level(4096, 4096, 1024, 1024) == 2
+    assert pyramid.select_level(4096, 4096, 10, 10) == 4
@@ -0,0 +1,59 @@
+import warnings
+
+import numpy as np
+
+from app.core.render import RenderStyle, render_overlay, render_png
+
+
+def lut_of(style):
+    from app.core.render import prep_palette, parse_color
+    return np.array([parse_color(el)[:3] for el in prep_palette(style.DEF_PALETTE, style.INVERT_PALETTE)],
+                    dtype=np.uint8)
+
+
+def test_nan_pixels_take_low_edge_color():
+    style = RenderStyle(intensity_min=0., intensity_max=10.)
+    lut = lut_of(style)
+
+    data = np.full((4, 5), 20., dtype=np.float32)
+    data[1, 2] = np.nan
+    data[2, 3] = np.inf
+    data[3, 0] = -np.inf
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        rgb, _ = render_overlay(data, None, style)
+
+    # the first row is drawn at the bottom
+    rgb = rgb[::-1]
+    assert (rgb[1, 2] == lut[0]).all()
+    assert (rgb[2, 3] == lut[-1]).all()
+    assert (rgb[3, 0] == lut[0]).all()
+    assert (rgb[0, 0] == lut[-1]).all()
+
+
+def test_autoscale_ignores_nan():
+    style = RenderStyle()
+    data = np.full((8, 8), 4., dtype=np.float64)
+    data[0, :] = np.nan
+
+    assert style.intensity_range(data) == (0., 12.)
+
+    data[:] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mi, ma = style.intensity_range(data)
+        rgb, _ = render_overlay(data, None, style)
+    assert (mi, ma) == (0., 0.)
+    assert (rgb == lut_of(style)[0]).all()
+
+
+def test_zero_span():
+    style = RenderStyle(intensity_min=5., intensity_max=5.)
+    data = np.arange(12, dtype=np.int32).reshape(3, 4)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        rgb, _ = render_overlay(data, None, style)
+    assert (rgb == lut_of(style)[0]).all()
+    assert render_png(data, None, style)[:4] == b"\x89PNG"
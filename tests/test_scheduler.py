@@ -0,0 +1,50 @@
+import threading
+import time
+
+from app.bokeh.scheduler import RenderScheduler
+
+
+def test_renders_do_not_overlap():
+    state = dict(active=0, overlap=False, generations=[])
+    lock = threading.Lock()
+
+    def render(generation):
+        with lock:
+            state["active"] += 1
+            state["overlap"] |= state["active"] > 1
+        time.sleep(0.05)
+        with lock:
+            state["active"] -= 1
+            state["generations"].append(generation)
+
+    scheduler = RenderScheduler(render, min_interval=0.)
+    for _ in range(20):
+        scheduler.request()
+        time.sleep(0.01)
+    last = scheduler.generation
+
+    deadline = time.monotonic() + 5.
+    while time.monotonic() < deadline and (scheduler.pending or scheduler.running or
+                                           state["generations"][-1:] != [last]):
+        time.sleep(0.01)
+
+    assert not state["overlap"]
+    assert state["generations"][-1] == last
+    # bursts are merged
+    assert len(state["generations"]) < 20
+
+
+def test_request_after_error_is_served():
+    calls = []
+
+    def render(generation):
+        calls.append(generation)
+        if len(calls) == 1:
+            raise RuntimeError("render failed")
+
+    scheduler = RenderScheduler(render, min_interval=0.)
+    scheduler.request()
+    time.sleep(0.1)
+    scheduler.request()
+    time.sleep(0.1)
+    assert calls == [1, 2]
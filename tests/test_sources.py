@@ -0,0 +1,58 @@
+import pytest
+
+from app.imports.sources import PeakSource, Win32ClipboardSource, MemorySource, make_source
+
+
+class FakeClipboard:
+    """
+    Minimal win32clipboard replacement holding content which is not text
+    """
+
+    def __init__(self):
+        self.sequence = 1
+        self.opened = 0
+        self.data = None
+
+    def GetClipboardSequenceNumber(self):
+        return self.sequence
+
+    def OpenClipboard(self):
+        self.opened += 1
+
+    def CloseClipboard(self):
+        pass
+
+    def GetClipboardData(self):
+        if self.data is None:
+            raise TypeError("Specified clipboard format is not available")
+        return self.data
+
+
+def test_source_is_abstract():
+    with pytest.raises(TypeError):
+        PeakSource()
+
+
+def test_clipboard_without_text_is_read_once():
+    cb = FakeClipboard()
+    source = Win32ClipboardSource()
+    source.win32clipboard = cb
+
+    assert source.read() is None
+    assert source.read() is None
+    assert cb.opened == 1
+
+    cb.sequence, cb.data = 2, "text"
+    assert source.read() == "text"
+    assert source.read() is None
+    assert cb.opened == 2
+
+
+def test_memory_source_returns_latest():
+    source = make_source("memory")
+    assert isinstance(source, MemorySource)
+
+    source.push("a")
+    source.push("b")
+    assert source.read(timeout=0.1) == "b"
+    assert source.read(timeout=0.01) is None
@@ -0,0 +1,97 @@
+import numpy as np
+
+from app.core.spatial import PeakIndex, points_in_polygon
+
+
+def make_points(seed=3, n=2000):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, 2000, n)
+    y = rng.uniform(0, 1500, n)
+
+    # dense clusters and a few points without coordinates
+    centers = rng.uniform(100, 1400, (5, 2))
+    cx = (centers[:, 0][:, None] + rng.normal(0, 5, (5, 100))).ravel()
+    cy = (centers[:, 1][:, None] + rng.normal(0, 5, (5, 100))).ravel()
+    x, y = np.concatenate([x, cx, [np.nan, 10.]]), np.concatenate([y, cy, [5., np.inf]])
+    return x, y
+
+
+def make_queries(x, y, seed=5, n=3000):
+    rng = np.random.default_rng(seed)
+    qx = rng.uniform(-300, 2300, n)
+    qy = rng.uniform(-300, 1800, n)
+
+    # half of the queries sit next to points of the clusters
+    pick = rng.integers(2000, 2500, n // 2)
+    qx[:n // 2] = x[pick] + rng.normal(0, 3, n // 2)
+    qy[:n // 2] = y[pick] + rng.normal(0, 3, n // 2)
+    return qx, qy
+
+
+def distances(x, y, qx, qy):
+    d = np.hypot(x - qx, y - qy)
+    return np.where(np.isfinite(d), d, np.inf)
+
+
+def test_nearest():
+    x, y = make_points()
+    index = PeakIndex(x, y)
+
+    for qx, qy in zip(*make_queries(x, y)):
+        d = distances(x, y, qx, qy)
+        res = index.nearest(qx, qy)
+        assert res >= 0 and d[res] == d.min()
+
+        res = index.nearest(qx, qy, max_distance=20.)
+        if d.min() <= 20.:
+            assert d[res] == d.min()
+        else:
+            assert res == -1
+
+
+def test_box_and_radius():
+    x, y = make_points()
+    index = PeakIndex(x, y)
+    rng = np.random.default_rng(11)
+
+    for qx, qy in zip(*make_queries(x, y)):
+        w, h = rng.uniform(0, 200, 2)
+        res = index.box(qx + w, qx - w, qy - h, qy + h)
+        expected = np.flatnonzero((x >= qx - w) & (x <= qx + w) & (y >= qy - h) & (y <= qy + h))
+        assert np.array_equal(np.sort(res), expected)
+
+        r = float(rng.uniform(0, 100))
+        res = index.radius(qx, qy, r)
+        expected = np.flatnonzero(distances(x, y, qx, qy) <= r)
+        assert np.array_equal(np.sort(res), expected)
+
+
+def test_lasso():
+    x, y = make_points()
+    index = PeakIndex(x, y)
+
+    # concave polygon crossing a cluster
+    px = np.array([100., 1900., 1900., 1000., 600., 100.])
+    py = np.array([100., 100., 1400., 300., 1400., 1400.])
+
+    res = index.lasso(px, py)
+    with np.errstate(invalid="ignore"):
+        expected = np.flatnonzero(points_in_polygon(x, y, px, py))
+    assert len(expected) > 0
+    assert np.array_equal(np.sort(res), expected)
+
+    assert len(index.lasso(px[:2], py[:2])) == 0
+
+
+def test_points_in_polygon():
+    px, py = [0., 4., 4., 0.], [0., 0., 4., 4.]
+    res = points_in_polygon([1., 5., 2., -1.], [1., 1., 3.9, 2.], px, py)
+    assert res.tolist() == [True, False, True, False]
+
+
+def test_empty():
+    index = PeakIndex([], [])
+    assert len(index) == 0
+    assert index.nearest(0., 0.) == -1
+    assert len(index.box(0., 10., 0., 10.)) == 0
+    assert len(index.radius(0., 0., 5.)) == 0
@@ -0,0 +1,129 @@
+import os
+
+import numpy as np
+
+import fabio.edfimage
+import fabio.tifimage
+
+from app.core.stack import FrameStack
+
+
+def file_content(image, tmp_path, name):
+    fn = os.path.join(str(tmp_path), name)
+    image.write(fn)
+    with open(fn, "rb") as fh:
+        return fh.read()
+
+
+def test_content_decoded_from_stream(tmp_path):
+    data = np.arange(64 * 48, dtype=np.int32).reshape(64, 48)
+    content = file_content(fabio.tifimage.TifImage(data=data), tmp_path, "frame.tif")
+
+    stack = FrameStack.from_content(content, filename="frame.tif", prefetch=0)
+    try:
+        assert stack.decoder == "stream"
+        assert stack.fallback is None
+        assert set(stack.timings) == {"buffer", "open"}
+        assert np.array_equal(stack.get(0).data, data)
+    finally:
+        stack.close()
+
+
+def test_content_falls_back_to_file(tmp_path):
+    data = np.arange(32 * 32, dtype=np.float32).reshape(32, 32)
+    content = file_content(fabio.edfimage.EdfImage(data=data), tmp_path, "frame.edf")
+
+    stack = FrameStack.from_content(content, filename="frame.edf", tmp_dir=str(tmp_path), prefetch=0)
+    try:
+        # the edf reader of fabio keeps a lock on a real file object
+        assert stack.decoder == "file"
+        assert stack.fallback is not None
+        assert {"decode_failed", "write", "open"} <= set(stack.timings)
+        assert np.array_equal(stack.get(0).data, data)
+    finally:
+        stack.close()
+    assert [el for el in os.listdir(str(tmp_path)) if el != "frame.edf"] == []
+
+
+def test_cache_counts_stream_content(tmp_path):
+    from app.core.cache import ImageCache
+
+    data = np.arange(256 * 256, dtype=np.int32).reshape(256, 256)
+    stacks = []
+    for i in range(2):
+        content = file_content(fabio.tifimage.TifImage(data=data + i), tmp_path, f"frame{i}.tif")
+        stack = FrameStack.from_content(content, filename=f"frame{i}.tif", prefetch=0)
+        assert stack.decoder == "stream"
+        assert stack.nbytes == len(content) + data.nbytes
+        stacks.append(stack)
+
+    # the decoded frames alone fit into the budget, together with the retained content they do not
+    evicted = []
+    cache = ImageCache(max_bytes=3 * data.nbytes, on_evict=lambda key, value: evicted.append(value))
+    try:
+        cache.put("first", stacks[0])
+        cache.put("second", stacks[1])
+        assert evicted == [stacks[0]]
+        assert "second" in cache
+    finally:
+        for el in stacks:
+            el.close()
+    assert stacks[0].nbytes == 0
+
+
+def wait_for(test, timeout=5.):
+    import time
+
+    end = time.monotonic() + timeout
+    while not test():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_series_cache_and_prefetch(tmp_path):
+    frames = [np.full((16, 24), i, dtype=np.int32) for i in range(10)]
+    filenames = []
+    for i, el in enumerate(frames):
+        fn = os.path.join(str(tmp_path), f"frame_{i:02d}.tif")
+        fabio.tifimage.TifImage(data=el).write(fn)
+        filenames.append(fn)
+
+    stack = FrameStack.from_series(filenames[::-1], cache_frames=4, prefetch=2)
+    thread = stack._th_prefetch
+
+    # largest size of the LRU, also while the prefetch thread stores frames
+    sizes = []
+    store = stack._store
+
+    def tracked(index, image):
+        store(index, image)
+        sizes.append(len(stack._cache))
+
+    stack._store = tracked
+    try:
+        assert len(stack) == 10 and stack.paths == filenames
+        assert thread is not None and thread.is_alive()
+
+        for index in (5, 6, 0, 9, 3):
+            assert np.array_equal(stack.get(index).data, frames[index])
+
+            # the cache keeps the requested frame and one neighbour on each side
+            neighbours = [el for el in (index - 1, index + 1) if 0 <= el < len(stack)]
+            assert wait_for(lambda: all([stack._cached(el, count=False) is not None for el in neighbours]))
+            assert len(stack._cache) <= stack.cache_frames
+            assert stack._cached(index, count=False) is not None
+
+        assert len(sizes) > 5 and max(sizes) <= stack.cache_frames
+
+        # prefetched neighbours are hits
+        hits = stack.hits
+        stack.get(4)
+        assert stack.hits == hits + 1
+        assert sorted([el.data[0, 0] for el in stack._cache.values()]) == sorted(stack._cache)
+    finally:
+        stack.close()
+
+    assert not thread.is_alive()
+    assert stack.nbytes == 0
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from app.core.stats import ImageStats
+
+
+def make_frame(dtype, shape=(2048, 2048)):
+    rng = np.random.default_rng(5)
+    data = rng.integers(0, 1 << 20, shape).astype(dtype)
+    data[::7, ::5] = 2 ** 20 - 1
+    return data
+
+
+@pytest.mark.parametrize("dtype", [np.int32, np.float32, np.float64])
+def test_below_mean(dtype):
+    data = make_frame(dtype)
+    stats = ImageStats(data)
+
+    values = data.astype(np.float64)
+    mean = values.mean()
+    assert stats.mean == pytest.approx(mean, rel=1e-12)
+    assert stats.below_mean == pytest.approx(values[values <= mean].sum() / values.size, rel=1e-9)
+
+
+def test_masked_and_nan():
+    data = make_frame(np.float32, shape=(300, 200))
+    data[0, :10] = np.nan
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[100:150] = True
+
+    stats = ImageStats(data, mask=mask, chunk_size=1000)
+    values = data[~mask & np.isfinite(data)].astype(np.float64)
+
+    assert stats.size == values.size
+    assert (stats.min, stats.max) == (values.min(), values.max())
+    assert stats.below_mean == pytest.approx(values[values <= values.mean()].sum() / values.size, rel=1e-9)
+    assert stats.histogram.sum() == values.size